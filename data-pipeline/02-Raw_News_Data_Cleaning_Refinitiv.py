@@ -2,13 +2,20 @@
 # !pip install unidecode
 # !pip install Levenshtein
 
+import os
 import re
+import sys
 import pandas as pd
-import yfinance as yf
 from cleantext import clean
 from Levenshtein import ratio
 from datetime import datetime, timedelta
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from puppy.price_store import PriceStore
+
+# local trading calendar, missing ranges are downloaded from Yahoo Finance once and cached
+price_store = PriceStore.default()
+
 def extract_update_number(headline):
     """
     Extracts the update number from the beginning of a news headline.
@@ -175,7 +182,7 @@ def drop_similar_records(df, column_name, r):
 def adjust_trading_days(start_day, end_day, ticker, df):
     """
     Adjusts the dates in a DataFrame to the nearest following trading days 
-    based on stock data from Yahoo Finance.
+    based on the stock data in the local price store.
 
     This function takes a DataFrame and modifies its date column to ensure that 
     each date falls on a trading day. Non-trading days are adjusted to the next 
@@ -185,7 +192,7 @@ def adjust_trading_days(start_day, end_day, ticker, df):
     Input:
         start_day (str): The start date for the trading day range in 'YYYY-MM-DD' format.
         end_day (str): The end date for the trading day range in 'YYYY-MM-DD' format.
-        ticker (str): The stock ticker symbol used to fetch trading day data from Yahoo Finance.
+        ticker (str): The stock ticker symbol used to look up the trading days.
         df (pandas.DataFrame): The DataFrame containing a 'date' column to be adjusted.
 
     Output:
@@ -195,34 +202,18 @@ def adjust_trading_days(start_day, end_day, ticker, df):
     Notes:
         - The function assumes 'df' has a column named 'date'.
         - Non-trading days in 'df' are shifted forward to the next trading day.
-        - The function relies on Yahoo Finance for trading day data and requires internet access.
-        - The function will not work correctly if the Yahoo Finance API changes or becomes unavailable.
+        - Trading days come from the local price store, Yahoo Finance is only used
+          when the store does not cover the date range yet.
+        - Dates after the last trading day in the range become NaT.
     """
 
-    # Download stock data from Yahoo Finance
-    df_yf = yf.download(ticker, start=start_day, end=end_day)
-    df_yf = df_yf.reset_index()
-    df_yf['Date'] = pd.to_datetime(df_yf['Date'])
-
     # Convert the 'date' column of the input dataframe to datetime
     df['date'] = pd.to_datetime(df['date'])
 
-    # Get the trading dates from the Yahoo Finance data
-    yf_date = df_yf['Date'].tolist()
-
-    # Initialize an empty list to hold the adjusted dates
-    trading = []
-
-    # Loop over each date in the input dataframe
-    for day in df['date']:
-        # While the day is not a trading day, add one day
-        while day not in yf_date:
-            day += timedelta(days=1)
-        # Append the adjusted trading day to the list
-        trading.append(day)
-
-    # Assign the adjusted trading days back to the dataframe
-    df['date'] = trading
+    # Shift every date to the first trading day on or after it
+    df['date'] = pd.to_datetime(
+        price_store.next_trading_day(ticker, df['date'].to_numpy(), start_day, end_day)
+    )
     return df
 
 def main(df, ticker, save_path, start_day, end_day):
@@ -232,7 +223,7 @@ def main(df, ticker, save_path, start_day, end_day):
     This function performs several operations on a news dataset:
     - Extracts update numbers and creates new headlines.
     - Removes duplicates and cleans the text.
-    - Adjusts the dates to the nearest trading days based on stock data from Yahoo Finance.
+    - Adjusts the dates to the nearest trading days based on the local price store.
     - Saves the cleaned and adjusted DataFrame to a CSV file.
 
     Input:
@@ -1,13 +1,20 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
-import yfinance as yf
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from puppy.price_store import PriceStore
+
+# local prices, missing ranges are downloaded from Yahoo Finance once and cached
+price_store = PriceStore.default()
+
 def get_data(Start: str, End: str, ticker: str, df_dict: dict, col: list):
     """
-    Downloads stock data from Yahoo Finance and filters dataframes based on the given date range.
+    Reads stock data from the local price store and filters dataframes based on the given date range.
 
     Parameters:
         Start (str): Start date for the data range in 'YYYY-MM-DD' format.
@@ -20,8 +27,8 @@ def get_data(Start: str, End: str, ticker: str, df_dict: dict, col: list):
         tuple: A tuple containing the adjusted closing prices of the stock, 
                list of model names, and a list of filtered data corresponding to each model.
     """
-    # Download stock data from Yahoo Finance
-    df = yf.download(ticker, start=Start, end=End)
+    # Read stock data from the local price store
+    _, price = price_store.get_prices(ticker, Start, End)
 
     # Dictionary to hold filtered data
     model_name = []
@@ -32,7 +39,7 @@ def get_data(Start: str, End: str, ticker: str, df_dict: dict, col: list):
         dataframe[col[0]] = pd.to_datetime(dataframe[col[0]])
         filtered_data.append(dataframe[(dataframe[col[0]] >= Start) & (dataframe[col[0]] < End)][col[1]].tolist())
 
-    return df['Adj Close'].tolist(), model_name, filtered_data
+    return price.tolist(), model_name, filtered_data
     
 
 def reward_list(price: list, actions: list):
@@ -146,10 +153,7 @@ def main(Ticker, start_time, end_time, df_dict, col, image_save_path, Start_Date
         rw = reward_list(price, actions)
         return_lists.append(rw)
     # Prepare data for plotting
-    data = yf.download(Ticker, start=start_time, end=end_time)
-    data = data.reset_index()
-    # data['Date'] = data['Date'].dt.date
-    Date = data[(data['Date'] >= start_time) & (data['Date'] < end_time)]['Date'].tolist()
+    Date = price_store.trading_days(Ticker, start_time, end_time)
     dates = pd.to_datetime(Date).tolist()
     # print(len(Date), len(B_H_rw))
     colors = ['#000', '#d14749', '#59a14f', '#4e89e0', '#ee4199', '#f28e2b', '#8F337F'] # match the lenth of len(df_dict)+1
@@ -1,11 +1,18 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
-import yfinance as yf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from puppy.price_store import PriceStore
+
+# local prices, missing ranges are downloaded from Yahoo Finance once and cached
+price_store = PriceStore.default()
 
 # Get daily stock price
 def get_price(Start, End, Ticker):
     """
-    Fetch daily adjusted closing prices of a stock from Yahoo Finance.
+    Fetch daily adjusted closing prices of a stock from the local price store.
 
     Parameters:
     Start (str): Start date for the price data.
@@ -15,8 +22,8 @@ def get_price(Start, End, Ticker):
     Returns:
     list: List of daily adjusted closing prices.
     """
-    df = yf.download(ticker, start=Start, end=End)
-    return df['Adj Close'].tolist()
+    _, price = price_store.get_prices(Ticker, Start, End)
+    return price.tolist()
 
 # Get actions for different models
 def get_action(start, end, ticker, file_path, col):
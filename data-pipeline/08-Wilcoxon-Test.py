@@ -1,14 +1,21 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
-import yfinance as yf
 from scipy.stats import wilcoxon
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from puppy.price_store import PriceStore
+
+# local prices, missing ranges are downloaded from Yahoo Finance once and cached
+price_store = PriceStore.default()
+
 def get_price(start, end, ticker):
     """
-    Fetch daily adjusted closing prices of a stock from Yahoo Finance.
+    Fetch daily adjusted closing prices of a stock from the local price store.
     """
-    df = yf.download(ticker, start=start, end=end)
-    return df['Adj Close'].to_numpy()
+    _, price = price_store.get_prices(ticker, start, end)
+    return price
 
 def get_action(start, end, file_path, col):
     """
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import os
+import pickle
+import argparse
+import numpy as np
+import polars as pl
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from puppy.metrics import (
+    actions_from_portfolio,
+    build_action_matrix,
+    cumulative_rewards,
+    load_actions_csv,
+    metrics_frame,
+    pairwise_wilcoxon,
+)
+from puppy.price_store import PriceStore
+
+
+def _find_runs(paths: List[Path]) -> List[Tuple[Path, str]]:
+    # (path, kind) for every checkpoint or exported actions csv under the paths
+    runs: List[Tuple[Path, str]] = []
+    for path in paths:
+        if path.is_file():
+            runs.append((path, "pickle" if path.suffix == ".pkl" else "csv"))
+            continue
+        runs.extend(
+            (i, "pickle") for i in sorted(path.glob("**/agent_1/state_dict.pkl"))
+        )
+        runs.extend((i, "csv") for i in sorted(path.glob("**/actions_*.csv")))
+    return runs
+
+
+def _run_name(path: Path, kind: str) -> str:
+    if kind == "pickle":
+        # <run>/<ticker>/agent_1/state_dict.pkl
+        return str(path.parent.parent)
+    return str(path.with_suffix(""))
+
+
+def _load_run(path: Path, kind: str) -> Tuple[str, np.ndarray, np.ndarray]:
+    if kind == "pickle":
+        with path.open("rb") as f:
+            portfolio = pickle.load(f)["portfolio"]
+        return (portfolio.symbol, *actions_from_portfolio(portfolio))
+    symbol = pl.read_csv(path, n_rows=1).get_column("symbol")
+    symbol = symbol[0] if len(symbol) else path.stem.replace("actions_", "")
+    return (symbol, *load_actions_csv(str(path)))
+
+
+def _evaluate_symbol(
+    symbol: str,
+    runs: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    price_store: PriceStore,
+    start: Optional[str],
+    end: Optional[str],
+    fill: str,
+    output_dir: Path,
+    wilcoxon: bool,
+) -> pl.DataFrame:
+    all_dates = np.concatenate([dates for dates, _ in runs.values()])
+    start_date = np.datetime64(start, "D") if start else all_dates.min()
+    end_date = np.datetime64(end, "D") if end else all_dates.max()
+    price_dates, price = price_store.get_prices(
+        symbol, start_date, end_date + np.timedelta64(1, "D")
+    )
+    if len(price) < 3:
+        raise ValueError(f"Not enough price data for {symbol}")
+
+    run_names, action_matrix = build_action_matrix(runs, price_dates, fill=fill)
+    run_names = ["Buy & Hold"] + run_names
+    action_matrix = np.vstack([np.ones((1, len(price_dates))), action_matrix])
+
+    result = metrics_frame(run_names, action_matrix, price).with_columns(
+        pl.lit(symbol).alias("symbol")
+    )
+    result.write_csv(output_dir / f"metrics_{symbol}.csv")
+    if wilcoxon:
+        pairwise_wilcoxon(
+            run_names, cumulative_rewards(action_matrix, price)
+        ).write_csv(output_dir / f"wilcoxon_{symbol}.csv")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compute backtest metrics for many FinMem runs at once."
+    )
+    parser.add_argument(
+        "runs",
+        nargs="*",
+        default=[os.path.join("data", "07_test_model_output")],
+        help="Checkpoint folders, exported actions csv files or folders containing them.",
+    )
+    parser.add_argument(
+        "--price-path",
+        default=os.path.join("data", "03_primary", "price_data.parquet"),
+        help="Price parquet written by generate_price_data.py, missing ranges are downloaded.",
+    )
+    parser.add_argument("--start", default=None, help="Start date, e.g. 2022-10-06.")
+    parser.add_argument("--end", default=None, help="End date, e.g. 2023-04-10.")
+    parser.add_argument(
+        "--fill",
+        default="zero",
+        choices=["zero", "forward"],
+        help="Position on days without an action: flat, or hold the last action.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join("data", "09_results"),
+        help="Output directory for the metrics and test csv files.",
+    )
+    parser.add_argument(
+        "--no-wilcoxon",
+        action="store_true",
+        help="Skip the pairwise Wilcoxon signed-rank tests.",
+    )
+    args = parser.parse_args()
+
+    for cur_date in (args.start, args.end):
+        if cur_date:
+            datetime.strptime(cur_date, "%Y-%m-%d")
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    runs_by_symbol: Dict[str, Dict[str, Tuple[np.ndarray, np.ndarray]]] = {}
+    for path, kind in _find_runs([Path(i) for i in args.runs]):
+        try:
+            symbol, dates, actions = _load_run(path, kind)
+        except Exception as e:
+            print(f"[WARN] Failed {path}: {e}")
+            continue
+        if len(dates) == 0:
+            continue
+        runs_by_symbol.setdefault(symbol, {})[_run_name(path, kind)] = (
+            dates,
+            actions,
+        )
+    if not runs_by_symbol:
+        print("[WARN] No runs were found.")
+        return
+
+    price_store = PriceStore(args.price_path)
+    results = []
+    for symbol, runs in sorted(runs_by_symbol.items()):
+        try:
+            results.append(
+                _evaluate_symbol(
+                    symbol=symbol,
+                    runs=runs,
+                    price_store=price_store,
+                    start=args.start,
+                    end=args.end,
+                    fill=args.fill,
+                    output_dir=output_dir,
+                    wilcoxon=not args.no_wilcoxon,
+                )
+            )
+        except Exception as e:
+            print(f"[WARN] Failed {symbol}: {e}")
+    if results:
+        summary = pl.concat(results)
+        summary.write_csv(output_dir / "metrics_summary.csv")
+        print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,25 @@
-from .environment import MarketEnvironment
-from .agent import LLMAgent
-from .run_type import RunMode
+import importlib
+from typing import Any, List
+
+# the agent pulls in faiss, guardrails and langchain, so the package exports are
+# imported on first use and tools that only need e.g. puppy.metrics start fast
+_EXPORTS = {
+    "MarketEnvironment": ".environment",
+    "LLMAgent": ".agent",
+    "RunMode": ".run_type",
+    "DecisionCalendar": ".decision_calendar",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(list(globals()) + __all__)
@@ -1,26 +1,87 @@
 import os
+import time
 import shutil
 import pickle
 import logging
+import threading
 from datetime import date
 from .run_type import RunMode
 from .memorydb import BrainDB
 from .portfolio import Portfolio
 from abc import ABC, abstractmethod
-from .chat import ChatOpenAICompatible
+from .chat import ChatOpenAICompatible, HTTP_CLIENT_KEYS
+from .rate_limit import RATE_LIMIT_KEYS
+from .credentials import CREDENTIAL_KEYS
+from .response_cache import ResponseCache, CACHE_KEYS
 from .environment import market_info_type
-from typing import Dict, Union, Any, List
-from .reflection import trading_reflection
-from transformers import AutoTokenizer
+from typing import Dict, Union, Any, List, Callable, Tuple
+from .reflection import trading_reflection, ReflectionStats, ReflectionSchemaCache
+from .reflection_memo import ReflectionMemo
+from .model_router import TieredRouter, ROUTER_KEYS
+from .deadline import (
+    DEADLINE_KEYS,
+    FALLBACK_POLICIES,
+    StepBudgetStats,
+    time_budget,
+)
+from .prompt_budget import PromptBudget, PROMPT_BUDGET_KEYS, LAYERS
+
+# tokenizers shared by the agents in the process, loaded on first use
+_tokenizers: Dict[str, Any] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(tokenization_model_name: str, auth_token: Union[str, None] = None):
+    # transformers takes about a second to import, only the tgi truncation needs it
+    with _tokenizers_lock:
+        if tokenization_model_name not in _tokenizers:
+            if "gpt" in tokenization_model_name:
+                # openai tokenizers are not on the hub, tiktoken has them
+                import tiktoken
+
+                _tokenizers[tokenization_model_name] = tiktoken.encoding_for_model(
+                    tokenization_model_name
+                )
+            else:
+                from transformers import AutoTokenizer
+
+                _tokenizers[tokenization_model_name] = AutoTokenizer.from_pretrained(
+                    tokenization_model_name, auth_token=auth_token
+                )
+        return _tokenizers[tokenization_model_name]
 
 
 class TextTruncator:
     def __init__(self, tokenization_model_name):
         self.tokenization_model_name = tokenization_model_name
         self.token = os.environ.get("HF_TOKEN", None)
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.tokenization_model_name, auth_token=self.token
-        )
+        self.use_tiktoken = "gpt" in self.tokenization_model_name
+        self._loaded_tokenizer = None
+
+    def _load(self):
+        if self._loaded_tokenizer is None:
+            self._loaded_tokenizer = get_tokenizer(
+                self.tokenization_model_name, auth_token=self.token
+            )
+        return self._loaded_tokenizer
+
+    @property
+    def encoding(self):
+        return self._load() if self.use_tiktoken else None
+
+    @property
+    def tokenizer(self):
+        return None if self.use_tiktoken else self._load()
+
+    def _encode(self, input_text: str) -> List[int]:
+        if self.encoding is not None:
+            return self.encoding.encode(input_text, disallowed_special=())
+        return self.tokenizer(input_text)["input_ids"]
+
+    def _decode(self, input_ids: List[int]) -> str:
+        if self.encoding is not None:
+            return self.encoding.decode(input_ids)
+        return self.tokenizer.decode(input_ids, skip_special_tokens=True)
 
     def _tokenize_cnt_texts(self, input_text):
         # Tokenize the text
@@ -29,14 +90,33 @@ class TextTruncator:
         num_tokens = len(encoded_input["input_ids"])
         return encoded_input, num_tokens
 
-    def process_list_of_texts(self, list_of_texts, max_total_tokens=320):
+    def count_tokens(self, list_of_texts: List[str]) -> List[int]:
+        # one batch call, the fast tokenizers encode the texts in parallel
+        if not list_of_texts:
+            return []
+        if self.encoding is not None:
+            return [
+                len(i)
+                for i in self.encoding.encode_batch(
+                    list_of_texts, disallowed_special=()
+                )
+            ]
+        return [len(i) for i in self.tokenizer(list_of_texts)["input_ids"]]
+
+    def process_list_of_texts(
+        self, list_of_texts, max_total_tokens=320, token_counts=None
+    ):
         if "gpt" in self.tokenization_model_name:
             return list_of_texts
 
         truncated_list = []
         total_tokens = 0
-        for text in list_of_texts:
-            encoded_input, num_tokens = self._tokenize_cnt_texts(text)
+        for i, text in enumerate(list_of_texts):
+            # stored counts of the memories, only texts without one are tokenized
+            encoded_input = None
+            num_tokens = token_counts[i] if token_counts is not None else None
+            if num_tokens is None:
+                encoded_input, num_tokens = self._tokenize_cnt_texts(text)
 
             if total_tokens + num_tokens <= max_total_tokens:
                 truncated_list.append(text)
@@ -45,6 +125,8 @@ class TextTruncator:
                 # Calculate remaining tokens
                 remaining_tokens = max_total_tokens - total_tokens
                 if remaining_tokens > 0:
+                    if encoded_input is None:
+                        encoded_input, _ = self._tokenize_cnt_texts(text)
                     # Truncate the current text to fit the remaining token count
                     truncated_input_ids = encoded_input["input_ids"][:remaining_tokens]
                     truncated_text = self.tokenizer.decode(
@@ -61,14 +143,12 @@ class TextTruncator:
     # for single text case
     def truncate_text(self, input_text, max_tokens):
         # Tokenize the text
-        encoded_input, num_tokens = self.tokenize_cnt_texts(input_text)
-
-        if len(encoded_input["input_ids"]) <= max_tokens:
-            return input_text, len(encoded_input["input_ids"])
-        encoded_input["input_ids"] = encoded_input["input_ids"][:max_tokens]
-        encoded_input["attention_mask"] = encoded_input["attention_mask"][:max_tokens]
-        # Optionally, decode the tokens back to a string
-        output_text = self.tokenizer.decode(encoded_input["input_ids"])
+        input_ids = self._encode(input_text)
+
+        if len(input_ids) <= max_tokens:
+            return input_text, len(input_ids)
+        # decode the kept tokens back to a string
+        output_text = self._decode(input_ids[:max_tokens])
         num_tokens = max_tokens
         return output_text, num_tokens
 
@@ -94,6 +174,7 @@ class LLMAgent(Agent):
         chat_config: Dict[str, Any],
         top_k: int = 1,
         look_back_window_size: int = 7,
+        reflection_memo_config: Union[Dict[str, Any], None] = None,
     ):
         # base
         self.counter = 1
@@ -125,7 +206,10 @@ class LLMAgent(Agent):
         self.portfolio = Portfolio(
             symbol=self.trading_symbol, lookback_window_size=self.look_back_window_size
         )
-        self.chat_config_save = chat_config.copy()
+        # the response cache is a setting of the run, not saved with the agent
+        self.chat_config_save = {
+            k: v for k, v in chat_config.items() if k not in CACHE_KEYS
+        }
         chat_config = chat_config.copy()
         end_point = chat_config["end_point"]
         model = chat_config["model"]
@@ -138,19 +222,125 @@ class LLMAgent(Agent):
         del chat_config["end_point"]
         del chat_config["model"]
         del chat_config["system_message"]
-        if self.max_token_short:
+        http_config = {
+            k: chat_config.pop(k) for k in HTTP_CLIENT_KEYS if k in chat_config
+        }
+        rate_limit_config = {
+            k: chat_config.pop(k) for k in RATE_LIMIT_KEYS if k in chat_config
+        }
+        self.response_cache = ResponseCache.from_config(
+            {k: chat_config.pop(k) for k in CACHE_KEYS if k in chat_config}
+        )
+        credential_config = {
+            k: chat_config.pop(k) for k in CREDENTIAL_KEYS if k in chat_config
+        }
+        # rate limited requests run on an event loop shared by the agents in the process
+        use_async_endpoint = chat_config.pop("async_endpoint", bool(rate_limit_config))
+        router_config = {k: chat_config.pop(k) for k in ROUTER_KEYS if k in chat_config}
+        constrained_output = chat_config.pop("constrained_output", False)
+        # wall clock budget of one step, the reflection falls back when it runs out
+        deadline_config = {
+            k: chat_config.pop(k) for k in DEADLINE_KEYS if k in chat_config
+        }
+        self.step_time_budget = deadline_config.get("step_time_budget")
+        self.deadline_fallback = deadline_config.get("deadline_fallback", "hold")
+        if self.deadline_fallback not in FALLBACK_POLICIES:
+            raise ValueError(
+                f"deadline_fallback must be one of {', '.join(FALLBACK_POLICIES)}"
+            )
+        self.prompt_layout = chat_config.pop("prompt_layout", "default")
+        if self.prompt_layout not in ReflectionSchemaCache.LAYOUTS:
+            raise ValueError(
+                f"prompt_layout must be one of {', '.join(ReflectionSchemaCache.LAYOUTS)}"
+            )
+        # one token budget for the memories of all layers instead of max_token_*
+        self.prompt_budget = PromptBudget.from_config(
+            {k: chat_config.pop(k) for k in PROMPT_BUDGET_KEYS if k in chat_config}
+        )
+        if self.max_token_short or (self.prompt_budget is not None):
             self.truncator = TextTruncator(
                 tokenization_model_name=chat_config["tokenization_model_name"]
             )
-        self.guardrail_endpoint = ChatOpenAICompatible(
+            # new memories are counted once when they are added
+            self.brain.set_token_counter(self.truncator.count_tokens)
+        self.chat = ChatOpenAICompatible(
             end_point=end_point,
             model=model,
             system_message=system_message,
             other_parameters=chat_config,
-        ).guardrail_endpoint()
+            http_config=http_config,
+            rate_limit_config=rate_limit_config,
+            cache=self.response_cache,
+            constrained_output=constrained_output,
+            credential_config=credential_config,
+        )
+        self.guardrail_endpoint = (
+            self.chat.rate_limited_endpoint()
+            if use_async_endpoint
+            else self.chat.guardrail_endpoint()
+        )
+        # cheaper models first, the configured model is the last tier
+        self.router = None
+        if router_config.get("tiers"):
+            tiers = []
+            for tier_config in router_config["tiers"]:
+                tier_config = tier_config.copy()
+                tier_chat = ChatOpenAICompatible(
+                    end_point=tier_config.pop("end_point"),
+                    model=tier_config.pop("model"),
+                    system_message=system_message,
+                    other_parameters=tier_config,
+                    http_config=http_config,
+                    rate_limit_config=rate_limit_config,
+                    cache=self.response_cache,
+                    constrained_output=constrained_output,
+                    credential_config=credential_config,
+                )
+                tiers.append(
+                    (
+                        tier_chat.model,
+                        (
+                            tier_chat.rate_limited_endpoint()
+                            if use_async_endpoint
+                            else tier_chat.guardrail_endpoint()
+                        ),
+                    )
+                )
+            tiers.append((model, self.guardrail_endpoint))
+            self.router = TieredRouter(
+                tiers=tiers,
+                min_confidence=router_config.get("tier_min_confidence"),
+                escalate_against_momentum=router_config.get(
+                    "tier_escalate_against_momentum", True
+                ),
+            )
+            self.guardrail_endpoint = self.router.endpoint()
+        # reuse the last reflection, or ask a cheaper model, when the memories repeat
+        self.reflection_memo_config = reflection_memo_config or {}
+        self.reflection_memo = ReflectionMemo.from_config(self.reflection_memo_config)
+        if self.reflection_memo.mode == "cheap_model":
+            memo_chat = ChatOpenAICompatible(
+                end_point=self.reflection_memo.end_point,  # type: ignore
+                model=self.reflection_memo.model,  # type: ignore
+                system_message=system_message,
+                http_config=http_config,
+                rate_limit_config=rate_limit_config,
+                cache=self.response_cache,
+                constrained_output=constrained_output,
+                credential_config=credential_config,
+            )
+            self.memo_endpoint = (
+                memo_chat.rate_limited_endpoint()
+                if use_async_endpoint
+                else memo_chat.guardrail_endpoint()
+            )
         # records
         self.reflection_result_series_dict = {}
         self.access_counter = {}
+        self.reflection_stats = ReflectionStats()
+        self.step_budget_stats = StepBudgetStats(budget=self.step_time_budget)
+        # memories waiting to be embedded, filled on non-decision days
+        self.pending_memories = {"short": [], "mid": [], "long": []}
 
     @classmethod
     def from_config(cls, config: Dict[str, Any]) -> "LLMAgent":
@@ -162,19 +352,14 @@ class LLMAgent(Agent):
             top_k=config["general"].get("top_k", 5),
             chat_config=config["chat"],
             look_back_window_size=config["general"]["look_back_window_size"],
+            reflection_memo_config=config.get("reflection_memo"),
         )
 
     def _handling_filings(self, cur_date: date, filing_q: str, filing_k: str) -> None:
         if filing_q:
-            self.brain.add_memory_mid(
-                symbol=self.trading_symbol, date=cur_date, text=filing_q
-            )
+            self.pending_memories["mid"].append((cur_date, filing_q))
         if filing_k:
-            self.brain.add_memory_long(
-                symbol=self.trading_symbol,
-                date=cur_date,
-                text=filing_k,
-            )
+            self.pending_memories["long"].append((cur_date, filing_k))
 
     def _handling_news(self, cur_date: date, news: List[str]) -> None:
         if not news:
@@ -182,19 +367,68 @@ class LLMAgent(Agent):
         if isinstance(news, str):
             if news.strip() == "":
                 return
-            self.brain.add_memory_short(
-                symbol=self.trading_symbol, date=cur_date, text=news
-            )
+            self.pending_memories["short"].append((cur_date, news))
             return
         cleaned_news = [item for item in news if isinstance(item, str) and item.strip()]
         if not cleaned_news:
             return
-        self.brain.add_memory_short(
-            symbol=self.trading_symbol, date=cur_date, text=cleaned_news
+        self.pending_memories["short"].extend((cur_date, item) for item in cleaned_news)
+
+    def ingest(self, market_info: market_info_type) -> None:
+        # buffer filings and news of a non-decision day, embedded at the next decision
+        self._handling_filings(
+            cur_date=market_info[0], filing_q=market_info[3], filing_k=market_info[2]  # type: ignore
         )
+        self._handling_news(cur_date=market_info[0], news=market_info[4])  # type: ignore
+
+    def flush_pending_memories(self) -> None:
+        # one embedding call for everything buffered since the last decision
+        self.brain.add_memories_bulk(
+            symbol=self.trading_symbol,
+            memories=[
+                (layer, cur_date, text)
+                for layer in ("mid", "long", "short")
+                for cur_date, text in self.pending_memories[layer]
+            ],
+        )
+        self.pending_memories = {"short": [], "mid": [], "long": []}
+
+    def __query_info_with_budget(self, run_mode: RunMode):
+        # the memories of all layers share one token budget, filled by score
+        self.logger.info(f"Symbol: {self.trading_symbol}\n")
+        candidates = {}
+        for layer in LAYERS:
+            texts, ids, scores = self.brain.query_with_scores(
+                layer,
+                query_text=self.character_string,
+                top_k=self.top_k,
+                symbol=self.trading_symbol,
+            )
+            token_counts = self.brain.get_token_counts(layer, self.trading_symbol, ids)
+            candidates[layer] = list(zip(ids, texts, scores, token_counts))
+        picked, used = self.prompt_budget.allocate(  # type: ignore
+            candidates, self.truncator.truncate_text
+        )
+        ret = []
+        for layer in LAYERS:
+            for cur_id, cur_memory in picked[layer]:
+                self.logger.info(
+                    f"Top-k {layer.capitalize()}: {cur_id}: {cur_memory}\n"
+                )
+            self.logger.info(f"Total tokens of {layer} memory: {used[layer]}\n")
+            ret.extend([[i[1] for i in picked[layer]], [i[0] for i in picked[layer]]])
+        self.logger.info(
+            f"Total tokens of **ALL** Memory: {sum(used.values())} of {self.prompt_budget.total_tokens}\n"  # type: ignore
+        )
+        if run_mode == RunMode.Test:
+            cur_moment_ret = self.portfolio.get_moment(moment_window=3)
+            ret.append(cur_moment_ret["moment"] if cur_moment_ret is not None else None)
+        return tuple(ret)
 
     def __query_info_for_reflection(self, run_mode: RunMode):
         # sourcery skip: low-code-quality
+        if self.prompt_budget is not None:
+            return self.__query_info_with_budget(run_mode)
         self.logger.info(f"Symbol: {self.trading_symbol}\n")
         cur_short_queried, cur_short_memory_id = self.brain.query_short(
             query_text=self.character_string,
@@ -204,7 +438,11 @@ class LLMAgent(Agent):
         if self.model_name.startswith("tgi"):
             cur_short_queried_truc, cur_short_num_tokens = (
                 self.truncator.process_list_of_texts(
-                    cur_short_queried, max_total_tokens=self.max_token_short
+                    cur_short_queried,
+                    max_total_tokens=self.max_token_short,
+                    token_counts=self.brain.get_token_counts(
+                        "short", self.trading_symbol, cur_short_memory_id
+                    ),
                 )
             )
             cur_short_memory_id_truc = [
@@ -227,7 +465,11 @@ class LLMAgent(Agent):
         if self.model_name.startswith("tgi"):
             cur_mid_queried_truc, cur_mid_num_tokens = (
                 self.truncator.process_list_of_texts(
-                    cur_mid_queried, max_total_tokens=self.max_token_mid
+                    cur_mid_queried,
+                    max_total_tokens=self.max_token_mid,
+                    token_counts=self.brain.get_token_counts(
+                        "mid", self.trading_symbol, cur_mid_memory_id
+                    ),
                 )
             )
             cur_mid_memory_id_truc = [
@@ -248,7 +490,11 @@ class LLMAgent(Agent):
         if self.model_name.startswith("tgi"):
             cur_long_queried_truc, cur_long_num_tokens = (
                 self.truncator.process_list_of_texts(
-                    cur_long_queried, max_total_tokens=self.max_token_long
+                    cur_long_queried,
+                    max_total_tokens=self.max_token_long,
+                    token_counts=self.brain.get_token_counts(
+                        "long", self.trading_symbol, cur_long_memory_id
+                    ),
                 )
             )
             cur_long_memory_id_truc = [
@@ -274,7 +520,11 @@ class LLMAgent(Agent):
         if self.model_name.startswith("tgi"):
             cur_reflection_queried_truc, cur_reflection_num_tokens = (
                 self.truncator.process_list_of_texts(
-                    cur_reflection_queried, max_total_tokens=self.max_token_reflection
+                    cur_reflection_queried,
+                    max_total_tokens=self.max_token_reflection,
+                    token_counts=self.brain.get_token_counts(
+                        "reflection", self.trading_symbol, cur_reflection_memory_id
+                    ),
                 )
             )
             cur_reflection_memory_id_truc = [
@@ -382,22 +632,8 @@ class LLMAgent(Agent):
             ) = self.__query_info_for_reflection(  # type: ignore
                 run_mode=run_mode
             )
-            reflection_result = trading_reflection(
-                cur_date=cur_date,
-                symbol=self.trading_symbol,
-                run_mode=run_mode,
-                endpoint_func=self.guardrail_endpoint,
-                short_memory=cur_short_queried,
-                short_memory_id=cur_short_memory_id,
-                mid_memory=cur_mid_queried,
-                mid_memory_id=cur_mid_memory_id,
-                long_memory=cur_long_queried,
-                long_memory_id=cur_long_memory_id,
-                reflection_memory=cur_reflection_queried,
-                reflection_memory_id=cur_reflection_memory_id,
-                future_record=cur_record,  # type: ignore
-                logger=self.logger,
-            )
+            mode_kwargs = {"future_record": cur_record}
+            memo_bucket = 1 if cur_record > 0 else -1  # type: ignore
         elif run_mode == RunMode.Test:
             (
                 cur_short_queried,
@@ -412,11 +648,43 @@ class LLMAgent(Agent):
             ) = self.__query_info_for_reflection(  # type: ignore
                 run_mode=run_mode
             )
-            reflection_result = trading_reflection(
+            mode_kwargs = {"momentum": cur_moment}
+            memo_bucket = cur_moment
+
+        memo_key = self.reflection_memo.make_key(
+            run_mode=run_mode,
+            id_lists={
+                "short_memory_index": cur_short_memory_id,
+                "middle_memory_index": cur_mid_memory_id,
+                "long_memory_index": cur_long_memory_id,
+                "reflection_memory_index": cur_reflection_memory_id,
+            },
+            bucket=memo_bucket,
+        )
+        memo_result = (
+            self.reflection_memo.lookup(memo_key)
+            if self.reflection_memo.enabled
+            else None
+        )
+        if (memo_result is not None) and (self.reflection_memo.mode == "reuse"):
+            # same memories as the last reflection, its summary is already in memory
+            self.reflection_memo.saved_calls += 1
+            self.logger.info(f"Reused reflection, memo: {self.reflection_memo}\n")
+            return memo_result
+
+        def _deadline_count() -> int:
+            return self.reflection_stats.counts.get("deadline", 0)
+
+        deadlines_before = _deadline_count()
+
+        def _run_reflection(endpoint_func: Callable) -> Tuple[Dict[str, Any], bool]:
+            failed_before = self.reflection_stats.counts["failed"]
+            deadline_before = _deadline_count()
+            result = trading_reflection(
                 cur_date=cur_date,
                 symbol=self.trading_symbol,
                 run_mode=run_mode,
-                endpoint_func=self.guardrail_endpoint,
+                endpoint_func=endpoint_func,
                 short_memory=cur_short_queried,
                 short_memory_id=cur_short_memory_id,
                 mid_memory=cur_mid_queried,
@@ -425,10 +693,35 @@ class LLMAgent(Agent):
                 long_memory_id=cur_long_memory_id,
                 reflection_memory=cur_reflection_queried,
                 reflection_memory_id=cur_reflection_memory_id,
-                momentum=cur_moment,
                 logger=self.logger,
+                stats=self.reflection_stats,
+                prompt_layout=self.prompt_layout,
+                ask_confidence=(self.router is not None)
+                and (self.router.min_confidence is not None),
+                deadline_fallback=self.deadline_fallback,
+                **mode_kwargs,  # type: ignore
             )
-
+            return result, (
+                self.reflection_stats.counts["failed"] == failed_before
+            ) and (_deadline_count() == deadline_before)
+
+        reflection_ok = False
+        if memo_result is not None:
+            # same memories as the last reflection, ask the cheap model
+            self.reflection_memo.cheap_calls += 1
+            reflection_result, reflection_ok = _run_reflection(self.memo_endpoint)
+            self.logger.info(
+                f"Reflection on the cheap model, memo: {self.reflection_memo}\n"
+            )
+        if not reflection_ok:
+            reflection_result, reflection_ok = _run_reflection(self.guardrail_endpoint)
+            if reflection_ok and self.reflection_memo.enabled:
+                self.reflection_memo.store(memo_key, reflection_result)
+
+        if _deadline_count() != deadlines_before:
+            # the fallback policy decided, nothing to remember
+            self.logger.info("Reflection out of time, not added to memory\n")
+            return reflection_result
         if (reflection_result is not {}) and ("summary_reason" in reflection_result):
             self.brain.add_memory_reflection(
                 symbol=self.trading_symbol,
@@ -456,6 +749,13 @@ class LLMAgent(Agent):
                 cur_date=cur_date, run_mode=run_mode
             )
         self.reflection_result_series_dict[cur_date] = reflection_result_cur_date
+        self.logger.info(f"Reflection stats: {self.reflection_stats}\n")
+        if self.router is not None:
+            self.logger.info(f"Model router: {self.router}\n")
+        if self.chat.prompt_cache_hit_rate is not None:
+            self.logger.info(
+                f"Prompt cache: {self.chat.cached_prompt_tokens} of {self.chat.prompt_tokens} prompt tokens cached ({self.chat.prompt_cache_hit_rate:.1%})\n"
+            )
         if run_mode == RunMode.Train:
             self.logger.info(
                 f"{self.trading_symbol}-Day {cur_date}\nreflection summary: {reflection_result_cur_date.get('summary_reason')}\n\n"
@@ -581,6 +881,23 @@ class LLMAgent(Agent):
         # mode assertion
         if run_mode not in [RunMode.Train, RunMode.Test]:
             raise ValueError("run_mode should be either Train or Test")
+        step_start = time.monotonic()
+        with time_budget(self.step_time_budget):
+            self._step(market_info=market_info, run_mode=run_mode)
+        step_seconds = time.monotonic() - step_start
+        self.step_budget_stats.record(step_seconds)
+        if self.step_time_budget is not None:
+            if step_seconds > self.step_time_budget:
+                self.logger.warning(
+                    f"Step of {market_info[0]} took {step_seconds:.1f}s, over the {self.step_time_budget}s budget\n"
+                )
+            self.logger.info(f"Step time: {self.step_budget_stats}\n")
+
+    def _step(
+        self,
+        market_info: market_info_type,
+        run_mode: RunMode,
+    ) -> None:
         # market info
         cur_date = market_info[0]
         cur_price = market_info[1]
@@ -594,6 +911,7 @@ class LLMAgent(Agent):
         )
         # 2. handling news
         self._handling_news(cur_date=cur_date, news=cur_news)
+        self.flush_pending_memories()
         # 3. update the price to portfolio
         self.portfolio.update_market_info(
             new_market_price_info=cur_price,
@@ -639,13 +957,19 @@ class LLMAgent(Agent):
             "chat_config": self.chat_config_save,
             "reflection_result_series_dict": self.reflection_result_series_dict,  #
             "access_counter": self.access_counter,
+            "reflection_stats": self.reflection_stats,
+            "reflection_memo_config": self.reflection_memo_config,
+            "reflection_memo": self.reflection_memo,
+            "step_budget_stats": self.step_budget_stats,
         }
         with open(os.path.join(path, "state_dict.pkl"), "wb") as f:
             pickle.dump(state_dict, f)
         self.brain.save_checkpoint(path=os.path.join(path, "brain"), force=force)
 
     @classmethod
-    def load_checkpoint(cls, path: str) -> "LLMAgent":
+    def load_checkpoint(
+        cls, path: str, chat_config_update: Union[Dict[str, Any], None] = None
+    ) -> "LLMAgent":
         # load state dict
         with open(os.path.join(path, "state_dict.pkl"), "rb") as f:
             state_dict = pickle.load(f)
@@ -657,7 +981,8 @@ class LLMAgent(Agent):
             character_string=state_dict["character_string"],
             brain_db=brain,
             top_k=state_dict["top_k"],
-            chat_config=state_dict["chat_config"],
+            chat_config={**state_dict["chat_config"], **(chat_config_update or {})},
+            reflection_memo_config=state_dict.get("reflection_memo_config"),
         )
         class_obj.portfolio = state_dict["portfolio"]
         class_obj.reflection_result_series_dict = state_dict[
@@ -665,4 +990,15 @@ class LLMAgent(Agent):
         ]
         class_obj.access_counter = state_dict["access_counter"]
         class_obj.counter = state_dict["counter"]
+        class_obj.reflection_stats = state_dict.get(
+            "reflection_stats", ReflectionStats()
+        )
+        class_obj.reflection_memo = state_dict.get(
+            "reflection_memo", class_obj.reflection_memo
+        )
+        class_obj.step_budget_stats = state_dict.get(
+            "step_budget_stats", class_obj.step_budget_stats
+        )
+        # the budget may have changed with the chat config update
+        class_obj.step_budget_stats.budget = class_obj.step_time_budget
         return class_obj
@@ -1,13 +1,106 @@
 import os
 import httpx
 import json
-import subprocess
+import atexit
+import asyncio
+import weakref
+import logging
+import threading
 from abc import ABC
-from typing import Callable, Union, Dict, Any, Union
+from urllib.parse import urlparse
+from typing import Callable, Union, Dict, Any, Union, Tuple
+from .response_cache import ResponseCache
+from .credentials import CachedToken, get_gemini_token
+from .rate_limit import get_provider_limiter, parse_retry_after, run_sync
+from .deadline import (
+    DeadlineExceeded,
+    check_deadline,
+    current_deadline,
+    remaining_time,
+    run_with_deadline,
+)
 
 ### when use tgi model
 api_key = "-"
 
+logger = logging.getLogger(__name__)
+
+# [chat] keys that configure the http client instead of the request payload
+HTTP_CLIENT_KEYS = (
+    "http2",
+    "max_connections",
+    "max_keepalive_connections",
+    "keepalive_expiry",
+    "timeout",
+    "connect_timeout",
+)
+
+# keep-alive clients shared by every chat object in the process
+_http_clients: Dict[Tuple, httpx.Client] = {}
+# async clients are bound to the event loop they were created on
+_async_http_clients = weakref.WeakKeyDictionary()
+_http_clients_lock = threading.Lock()
+
+# responses worth retrying on the async endpoint
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def _http_client_kwargs(
+    http2: bool = False,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 60.0,
+    timeout: float = 600.0,
+    connect_timeout: Union[float, None] = None,
+) -> Dict[str, Any]:
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("http2 needs the h2 package, falling back to http/1.1")
+            http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        "timeout": httpx.Timeout(
+            timeout, connect=timeout if connect_timeout is None else connect_timeout
+        ),
+    }
+
+
+def get_http_client(**http_config: Any) -> httpx.Client:
+    # pid in the key, so a forked worker never reuses the parent's sockets
+    key = (os.getpid(), tuple(sorted(http_config.items())))
+    with _http_clients_lock:
+        client = _http_clients.get(key)
+        if (client is None) or client.is_closed:
+            client = httpx.Client(**_http_client_kwargs(**http_config))
+            _http_clients[key] = client
+        return client
+
+
+def get_async_http_client(**http_config: Any) -> httpx.AsyncClient:
+    key = tuple(sorted(http_config.items()))
+    with _http_clients_lock:
+        loop_clients = _async_http_clients.setdefault(asyncio.get_running_loop(), {})
+        client = loop_clients.get(key)
+        if (client is None) or client.is_closed:
+            client = httpx.AsyncClient(**_http_client_kwargs(**http_config))
+            loop_clients[key] = client
+        return client
+
+
+@atexit.register
+def close_http_clients() -> None:
+    with _http_clients_lock:
+        for client in _http_clients.values():
+            client.close()
+        _http_clients.clear()
+
 
 def build_llama2_prompt(messages):
     startPrompt = "<s>[INST] "
@@ -35,6 +128,12 @@ class ChatOpenAICompatible(ABC):
         model="gemini-pro",
         system_message: str = "You are a helpful assistant.",
         other_parameters: Union[Dict[str, Any], None] = None,
+        http_config: Union[Dict[str, Any], None] = None,
+        rate_limit_config: Union[Dict[str, Any], None] = None,
+        cache: Union[ResponseCache, None] = None,
+        constrained_output: bool = False,
+        credential_config: Union[Dict[str, Any], None] = None,
+        credentials: Union[CachedToken, None] = None,
     ):
         # Use OPENROUTER_API_KEY when calling OpenRouter, otherwise fall back to OPENAI_API_KEY
         if "openrouter" in end_point:
@@ -46,16 +145,23 @@ class ChatOpenAICompatible(ABC):
         self.end_point = end_point
         self.model = model
         self.system_message = system_message
+        self.http_config = http_config or {}
+        self.rate_limit_config = rate_limit_config or {}
+        self.cache = cache
+        # send the response json schema as a tgi grammar / openai response_format
+        self.constrained_output = constrained_output
+        # prompt tokens and provider prefix cache hits, where the provider reports them
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self._usage_lock = threading.Lock()
+        self.client = get_http_client(**self.http_config)
+        # bearer token added when a request is sent, refreshed before it expires
+        self.credentials = credentials
 
         if self.model.startswith("gemini-pro"):
-            proc_result = subprocess.run(
-                ["gcloud", "auth", "print-access-token"], capture_output=True, text=True
-            )
-            access_token = proc_result.stdout.strip()
-            self.headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            }
+            if self.credentials is None:
+                self.credentials = get_gemini_token(**(credential_config or {}))
+            self.headers = {"Content-Type": "application/json"}
         elif self.model.startswith("tgi"):
             self.headers = {"Content-Type": "application/json"}
         else:
@@ -69,7 +175,7 @@ class ChatOpenAICompatible(ABC):
                     "https://github.com/pipiku915/FinMem-LLM-StockTrading"
                 )
                 self.headers["X-Title"] = "FinMem-LLM-StockTrading"
-            self.other_parameters = {} if other_parameters is None else other_parameters
+        self.other_parameters = {} if other_parameters is None else other_parameters
 
     def parse_response(self, response: httpx.Response) -> str:
         print(f"Raw response: {response.text}")
@@ -83,86 +189,311 @@ class ChatOpenAICompatible(ABC):
             response_out = response.json()
             return response_out["choices"][0]["message"]["content"]
 
-    def guardrail_endpoint(self) -> Callable:
-        def end_point(input: str, **kwargs) -> str:
-            input_str = [
-                # {"role": "system", "content": f"{self.system_message}"},
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant only capable of communicating with valid JSON, and no other text.",
+    def build_request(
+        self, input: str, response_schema: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, Any]:
+        # keyword arguments of client.post for one prompt
+        if not self.constrained_output:
+            response_schema = None
+        input_str = [
+            # {"role": "system", "content": f"{self.system_message}"},
+            {
+                "role": "system",
+                "content": "You are a helpful assistant only capable of communicating with valid JSON, and no other text.",
+            },
+            {"role": "user", "content": f"{input}"},
+        ]
+
+        if self.model.startswith("gemini-pro"):
+            input_prompts = {
+                "role": "USER",
+                "parts": {"text": input_str[1]["content"]},
+            }
+            payload = {
+                "contents": input_prompts,
+                "generation_config": {
+                    "temperature": 0.2,
+                    "top_p": 0.1,
+                    "top_k": 16,
+                    "max_output_tokens": 2048,
+                    "candidate_count": 1,
+                    "stop_sequences": [],
+                },
+                "safety_settings": {
+                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                    "threshold": "BLOCK_LOW_AND_ABOVE",
                 },
-                {"role": "user", "content": f"{input}"},
-            ]
+            }
+            return {"url": self.end_point, "headers": self.headers, "json": payload}
 
-            if self.model.startswith("gemini-pro"):
-                input_prompts = {
-                    "role": "USER",
-                    "parts": {"text": input_str[1]["content"]},
-                }
-                payload = {
-                    "contents": input_prompts,
-                    "generation_config": {
-                        "temperature": 0.2,
-                        "top_p": 0.1,
-                        "top_k": 16,
-                        "max_output_tokens": 2048,
-                        "candidate_count": 1,
-                        "stop_sequences": [],
-                    },
-                    "safety_settings": {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_LOW_AND_ABOVE",
-                    },
-                }
-                response = httpx.post(
-                    url=self.end_point,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=600.0,
-                )
+        elif self.model.startswith("tgi"):
+            llama_input_str = build_llama2_prompt(input_str)
+            # print(llama_input_str)
 
-            elif self.model.startswith("tgi"):
-                llama_input_str = build_llama2_prompt(input_str)
-                # print(llama_input_str)
-
-                payload = {
-                    "inputs": llama_input_str,
-                    "parameters": {
-                        "do_sample": True,
-                        "top_p": 0.6,
-                        "temperature": 0.8,
-                        "top_k": 50,
-                        "max_new_tokens": 256,
-                        "repetition_penalty": 1.03,
-                        "stop": ["</s>"],
+            payload = {
+                "inputs": llama_input_str,
+                "parameters": {
+                    "do_sample": True,
+                    "top_p": 0.6,
+                    "temperature": 0.8,
+                    "top_k": 50,
+                    "max_new_tokens": 256,
+                    "repetition_penalty": 1.03,
+                    "stop": ["</s>"],
+                },
+            }
+            if response_schema is not None:
+                payload["parameters"]["grammar"] = {
+                    "type": "json",
+                    "value": response_schema,
+                }
+            return {"url": self.end_point, "headers": self.headers, "json": payload}
+        else:
+            payload = {
+                "model": self.model,  # or another model like "gpt-4.0-turbo"
+                "messages": input_str,
+            }
+            if response_schema is not None:
+                payload["response_format"] = {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "investment_info",
+                        "strict": True,
+                        "schema": response_schema,
                     },
                 }
+            payload.update(self.other_parameters)
+            return {
+                "url": self.end_point,
+                "headers": self.headers,
+                "content": json.dumps(payload),
+            }
 
-                # payload = json.dumps(payload)
-                response = httpx.post(
-                    self.end_point, headers=self.headers, json=payload, timeout=600.0  # type: ignore
-                )
+    def _raise_for_status(self, response: httpx.Response) -> None:
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            if (response.status_code == 422) and (
+                "must have less than" in response.text
+            ):
+                raise LongerThanContextError
             else:
-                payload = {
-                    "model": self.model,  # or another model like "gpt-4.0-turbo"
-                    "messages": input_str,
-                }
-                payload.update(self.other_parameters)
-                payload = json.dumps(payload)
+                raise e
 
-                response = httpx.post(
-                    self.end_point, headers=self.headers, data=payload, timeout=600.0  # type: ignore
-                )
+    def _estimate_tokens(self, request: Dict[str, Any]) -> float:
+        # about 4 characters per token for the prompt, plus the completion budget
+        body = request.get("content") or json.dumps(request.get("json"))
+        if self.model.startswith("gemini-pro"):
+            max_output = 2048
+        elif self.model.startswith("tgi"):
+            max_output = 256
+        else:
+            max_output = self.other_parameters.get(
+                "max_tokens", self.other_parameters.get("max_completion_tokens", 1024)
+            )
+        return len(body) / 4 + max_output
+
+    @staticmethod
+    def _used_tokens(response: httpx.Response) -> Union[int, None]:
+        try:
+            response_out = response.json()
+        except ValueError:
+            return None
+        if not isinstance(response_out, dict):
+            return None
+        if "usage" in response_out:
+            return response_out["usage"].get("total_tokens")
+        if "usageMetadata" in response_out:
+            return response_out["usageMetadata"].get("totalTokenCount")
+        return None
+
+    @staticmethod
+    def _prompt_cache_usage(
+        response: httpx.Response,
+    ) -> Union[Tuple[int, int], None]:
+        # (prompt tokens, cached prompt tokens), None if the provider does not say
+        try:
+            response_out = response.json()
+        except ValueError:
+            return None
+        if not isinstance(response_out, dict):
+            return None
+        usage = response_out.get("usage")
+        if isinstance(usage, dict) and isinstance(
+            usage.get("prompt_tokens_details"), dict
+        ):
+            cached = usage["prompt_tokens_details"].get("cached_tokens")
+            if cached is not None:
+                return usage.get("prompt_tokens", 0), cached
+        usage = response_out.get("usageMetadata")
+        if isinstance(usage, dict) and ("cachedContentTokenCount" in usage):
+            return usage.get("promptTokenCount", 0), usage["cachedContentTokenCount"]
+        return None
+
+    def _record_prompt_cache_usage(self, response: httpx.Response) -> None:
+        usage = self._prompt_cache_usage(response)
+        if usage is None:
+            return
+        with self._usage_lock:
+            self.prompt_tokens += usage[0]
+            self.cached_prompt_tokens += usage[1]
+
+    @property
+    def prompt_cache_hit_rate(self) -> Union[float, None]:
+        if not self.prompt_tokens:
+            return None
+        return self.cached_prompt_tokens / self.prompt_tokens
+
+    def _cache_lookup(self, request: Dict[str, Any]) -> Union[str, None]:
+        if self.cache is None:
+            return None
+        return self.cache.lookup(self.end_point, self.model, request)
+
+    def _cache_store(self, request: Dict[str, Any], response: str) -> str:
+        if self.cache is None:
+            return response
+        return self.cache.store(self.end_point, self.model, request, response)
+
+    def _deadline_timeout(self) -> Union[httpx.Timeout, Any]:
+        # a request never waits past the step deadline
+        check_deadline()
+        budget = remaining_time()
+        read_timeout = self.client.timeout.read
+        if (budget is None) or (
+            (read_timeout is not None) and (read_timeout <= budget)
+        ):
+            return httpx.USE_CLIENT_DEFAULT
+        connect_timeout = self.client.timeout.connect
+        return httpx.Timeout(
+            budget,
+            connect=budget if connect_timeout is None else min(budget, connect_timeout),
+        )
+
+    def _authorize(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+        # the request with the current token, and the token to invalidate on a 401
+        if self.credentials is None:
+            return request, ""
+        token = self.credentials.token()
+        return {
+            **request,
+            "headers": {**request["headers"], "Authorization": f"Bearer {token}"},
+        }, token
+
+    def _rejected_token(self, response: httpx.Response, token: str) -> bool:
+        # an expired or revoked token, worth one more try with a new one
+        if (self.credentials is None) or (response.status_code != 401):
+            return False
+        logger.warning("Access token rejected, fetching a new one")
+        self.credentials.invalidate(token)
+        return True
+
+    def guardrail_endpoint(self) -> Callable:
+        def end_point(input: str, **kwargs) -> str:
+            request = self.build_request(input, kwargs.get("response_schema"))
+            cached = self._cache_lookup(request)
+            if cached is not None:
+                return cached
+            for attempt in range(2):
+                authorized_request, token = self._authorize(request)
+                try:
+                    response = self.client.post(
+                        **authorized_request, timeout=self._deadline_timeout()
+                    )
+                except httpx.TimeoutException as e:
+                    budget = remaining_time()
+                    if (budget is not None) and (budget <= 0):
+                        raise DeadlineExceeded(
+                            "time budget spent during the request"
+                        ) from e
+                    raise e
+                if (attempt > 0) or not self._rejected_token(response, token):
+                    break
+            self._raise_for_status(response)
+            self._record_prompt_cache_usage(response)
+            return self._cache_store(request, self.parse_response(response))
+
+        return end_point
+
+    def async_guardrail_endpoint(self) -> Callable:
+        """Async endpoint limited per provider.
+
+        Requests to the same host share one semaphore and one requests / tokens per
+        minute budget on the running event loop. 429 and 5xx responses and transport
+        errors are retried with the Retry-After delay or jittered exponential backoff,
+        a 429 also pauses every other request to the provider. Under a step deadline the
+        request, with its waits and retries, is cancelled when the deadline passes.
+        """
+        provider = urlparse(self.end_point).netloc or self.end_point
+
+        async def end_point(input: str, **kwargs) -> str:
+            check_deadline()
+            budget = remaining_time()
+            if budget is None:
+                return await _request(input, **kwargs)
             try:
-                response.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                if (response.status_code == 422) and (
-                    "must have less than" in response.text
+                return await asyncio.wait_for(_request(input, **kwargs), budget)
+            except asyncio.TimeoutError as e:
+                raise DeadlineExceeded("time budget spent during the request") from e
+
+        async def _request(input: str, **kwargs) -> str:
+            limiter = get_provider_limiter(provider, **self.rate_limit_config)
+            client = get_async_http_client(**self.http_config)
+            request = self.build_request(input, kwargs.get("response_schema"))
+            cached = self._cache_lookup(request)
+            if cached is not None:
+                return cached
+            estimated_tokens = self._estimate_tokens(request)
+            token_refreshed = False
+            for attempt in range(limiter.max_retries + 1):
+                last_attempt = attempt == limiter.max_retries
+                if (self.credentials is not None) and not self.credentials.fresh:
+                    # the token refresh may run a subprocess, not on the event loop
+                    await asyncio.to_thread(self.credentials.token)
+                authorized_request, token = self._authorize(request)
+                await limiter.acquire(estimated_tokens)
+                async with limiter.semaphore:
+                    try:
+                        response = await client.post(**authorized_request)
+                    except httpx.TransportError as e:
+                        if last_attempt:
+                            raise e
+                        response = None
+                if (
+                    (response is not None)
+                    and (not token_refreshed)
+                    and (not last_attempt)
+                    and self._rejected_token(response, token)
                 ):
-                    raise LongerThanContextError
+                    token_refreshed = True
+                    continue
+                if response is None:
+                    delay = limiter.backoff(attempt)
+                elif (response.status_code in RETRY_STATUS_CODES) and not last_attempt:
+                    delay = limiter.backoff(
+                        attempt, parse_retry_after(response.headers.get("retry-after"))
+                    )
+                    if response.status_code == 429:
+                        limiter.block(delay)
                 else:
-                    raise e
+                    limiter.record_usage(estimated_tokens, self._used_tokens(response))
+                    break
+                logger.warning(
+                    f"Request to {provider} failed (attempt {attempt + 1}), retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+            self._raise_for_status(response)  # type: ignore
+            self._record_prompt_cache_usage(response)  # type: ignore
+            return self._cache_store(request, self.parse_response(response))  # type: ignore
+
+        return end_point
+
+    def rate_limited_endpoint(self) -> Callable:
+        # guardrail_endpoint compatible, runs the async endpoint on the shared loop
+        async_end_point = self.async_guardrail_endpoint()
 
-            return self.parse_response(response)
+        def end_point(input: str, **kwargs) -> str:
+            return run_sync(
+                run_with_deadline(async_end_point(input, **kwargs), current_deadline())
+            )
 
         return end_point
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Tuple, Union
+
+# [chat] keys that configure the access token cache instead of the request payload
+CREDENTIAL_KEYS = ("token_cache_path", "token_refresh_margin")
+
+logger = logging.getLogger(__name__)
+
+
+class TokenProvider(ABC):
+    @abstractmethod
+    def fetch(self) -> Tuple[str, float]:
+        """A new access token and its expiry as a unix timestamp."""
+        pass
+
+
+class GcloudTokenProvider(TokenProvider):
+    """Access token of the active gcloud account.
+
+    `gcloud config config-helper` reports the expiry of the token; when it fails the
+    token of `gcloud auth print-access-token` is assumed to live `fallback_lifetime`
+    seconds, gcloud may hand out a token it cached earlier.
+    """
+
+    def __init__(
+        self, fallback_lifetime: float = 1800.0, timeout: float = 60.0
+    ) -> None:
+        self.fallback_lifetime = fallback_lifetime
+        self.timeout = timeout
+
+    def _run(self, *args: str) -> str:
+        return subprocess.run(
+            ["gcloud", *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=self.timeout,
+        ).stdout
+
+    def fetch(self) -> Tuple[str, float]:
+        try:
+            credential = json.loads(
+                self._run("config", "config-helper", "--format=json")
+            )["credential"]
+            expiry = datetime.fromisoformat(
+                credential["token_expiry"].replace("Z", "+00:00")
+            )
+            return credential["access_token"], expiry.timestamp()
+        except (subprocess.SubprocessError, ValueError, KeyError, TypeError) as e:
+            logger.warning(
+                f"gcloud config-helper failed ({e}), using print-access-token"
+            )
+        token = self._run("auth", "print-access-token").strip()
+        return token, time.time() + self.fallback_lifetime
+
+
+class StaticTokenProvider(TokenProvider):
+    # fixed token, for tests and endpoints that take a long lived key
+    def __init__(self, token: str, lifetime: float = 3600.0) -> None:
+        self.token = token
+        self.lifetime = lifetime
+        self.fetches = 0
+
+    def fetch(self) -> Tuple[str, float]:
+        self.fetches += 1
+        return self.token, time.time() + self.lifetime
+
+
+class CachedToken:
+    """Access token cached in memory and, with `cache_path`, in a file.
+
+    The token is refreshed `refresh_margin` seconds before it expires, and only one
+    thread refreshes while the others wait for its token. The file lets processes that
+    run side by side share one token.
+
+    Args:
+        provider (TokenProvider): fetches new tokens.
+        cache_path (Union[str, None], optional): token file, written with 0600
+            permissions. Defaults to None, memory only.
+        refresh_margin (float, optional): Defaults to 300.0 seconds.
+    """
+
+    def __init__(
+        self,
+        provider: TokenProvider,
+        cache_path: Union[str, None] = None,
+        refresh_margin: float = 300.0,
+    ) -> None:
+        self.provider = provider
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self._token: Union[str, None] = None
+        self._expires_at = 0.0
+        # a token the endpoint turned down, not taken from the file again
+        self._rejected: Union[str, None] = None
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    def _fresh(self, expires_at: float) -> bool:
+        return expires_at - self.refresh_margin > time.time()
+
+    @property
+    def fresh(self) -> bool:
+        # token() returns without a refresh
+        return (self._token is not None) and self._fresh(self._expires_at)
+
+    def _read_file(self) -> Union[Tuple[str, float], None]:
+        if (self.cache_path is None) or (not os.path.exists(self.cache_path)):
+            return None
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+            return cached["token"], float(cached["expires_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_file(self, token: str, expires_at: float) -> None:
+        if self.cache_path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(directory, exist_ok=True)
+        # write and rename, readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".token-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"token": token, "expires_at": expires_at}, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write the token cache {self.cache_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def token(self) -> str:
+        if (self._token is not None) and self._fresh(self._expires_at):
+            return self._token
+        with self._lock:
+            # another thread may have refreshed while this one waited
+            if (self._token is not None) and self._fresh(self._expires_at):
+                return self._token
+            cached = self._read_file()
+            if (
+                (cached is not None)
+                and (cached[0] != self._rejected)
+                and self._fresh(cached[1])
+            ):
+                self._token, self._expires_at = cached
+                return self._token
+            token, expires_at = self.provider.fetch()
+            self.refreshes += 1
+            self._write_file(token, expires_at)
+            self._token, self._expires_at = token, expires_at
+            return token
+
+    def invalidate(self, token: str) -> None:
+        # after a 401, the next call fetches a new token
+        with self._lock:
+            self._rejected = token
+            if self._token == token:
+                self._token, self._expires_at = None, 0.0
+
+
+# token caches shared by every chat object in the process
+_gemini_tokens: Dict[Tuple, CachedToken] = {}
+_gemini_tokens_lock = threading.Lock()
+
+
+def get_gemini_token(**credential_config: Any) -> CachedToken:
+    key = tuple(sorted(credential_config.items()))
+    with _gemini_tokens_lock:
+        cached_token = _gemini_tokens.get(key)
+        if cached_token is None:
+            cached_token = CachedToken(
+                GcloudTokenProvider(),
+                cache_path=credential_config.get("token_cache_path"),
+                refresh_margin=credential_config.get("token_refresh_margin", 300.0),
+            )
+            _gemini_tokens[key] = cached_token
+        return cached_token
@@ -0,0 +1,102 @@
+import time
+import contextlib
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Iterator, Union
+
+# [chat] keys of the per step time budget
+DEADLINE_KEYS = ("step_time_budget", "deadline_fallback")
+FALLBACK_POLICIES = ("hold", "momentum")
+
+# monotonic time at which the current step has to be done, None without a budget
+_deadline: ContextVar[Union[float, None]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def current_deadline() -> Union[float, None]:
+    return _deadline.get()
+
+
+def remaining_time() -> Union[float, None]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline(what: str = "request") -> None:
+    budget = remaining_time()
+    if (budget is not None) and (budget <= 0):
+        raise DeadlineExceeded(f"time budget spent before the {what}")
+
+
+@contextlib.contextmanager
+def time_budget(seconds: Union[float, None]) -> Iterator[None]:
+    """Everything in the block shares a deadline `seconds` from now.
+
+    Nested budgets never extend the outer deadline, None leaves it unchanged.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(deadline if outer is None else min(deadline, outer))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+async def run_with_deadline(coro: Awaitable[Any], deadline: Union[float, None]) -> Any:
+    # context variables do not follow a coroutine onto another thread's event loop
+    token = _deadline.set(deadline)
+    try:
+        return await coro
+    finally:
+        _deadline.reset(token)
+
+
+def fallback_decision(policy: str, momentum: Union[int, None] = None) -> str:
+    # deterministic decision when the budget runs out before the model answers
+    if (policy == "momentum") and momentum:
+        return "buy" if momentum > 0 else "sell"
+    return "hold"
+
+
+class StepBudgetStats:
+    """Wall clock time of the agent steps against the per step budget.
+
+    Steps can overrun the budget, the embedding requests and the memory updates are not
+    cut short, only the LLM requests are.
+    """
+
+    def __init__(self, budget: Union[float, None] = None) -> None:
+        self.budget = budget
+        self.steps = 0
+        self.overruns = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.steps += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        if (self.budget is not None) and (seconds > self.budget):
+            self.overruns += 1
+
+    def as_dict(self) -> Dict[str, Union[int, float, None]]:
+        return {
+            "budget": self.budget,
+            "steps": self.steps,
+            "overruns": self.overruns,
+            "mean_seconds": self.total_seconds / self.steps if self.steps else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+    def __str__(self) -> str:
+        stats = self.as_dict()
+        return (
+            f"{self.steps} steps, {self.overruns} over the {self.budget}s budget, "
+            f"mean {stats['mean_seconds']:.2f}s, max {self.max_seconds:.2f}s"
+        )
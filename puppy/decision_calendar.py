@@ -0,0 +1,74 @@
+from datetime import date, datetime
+from typing import Dict, Any, List, Union, Set
+
+
+class DecisionCalendar:
+    def __init__(
+        self,
+        trading_dates: List[date],
+        mode: str = "weekly",
+        weekday: int = 0,
+        every_n: int = 5,
+        dates: Union[List[Union[date, str]], None] = None,
+        roll_forward: bool = False,
+    ) -> None:
+        if mode not in {"weekly", "daily", "every_n", "custom"}:
+            raise ValueError("mode must be one of weekly, daily, every_n or custom")
+        if not 0 <= weekday <= 6:
+            raise ValueError("weekday must be between 0 (Monday) and 6 (Sunday)")
+        if every_n < 1:
+            raise ValueError("every_n must be a positive integer")
+        self.mode = mode
+        self.weekday = weekday
+        self.every_n = every_n
+        self.roll_forward = roll_forward
+        self.custom_dates = [self._to_date(i) for i in (dates or [])]
+        self.decision_dates = self._build_decision_dates(sorted(trading_dates))
+
+    @staticmethod
+    def _to_date(value: Union[date, datetime, str]) -> date:
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return datetime.strptime(value, "%Y-%m-%d").date()
+
+    def _build_decision_dates(self, trading_dates: List[date]) -> Set[date]:
+        match self.mode:
+            case "daily":
+                return set(trading_dates)
+            case "every_n":
+                return set(trading_dates[:: self.every_n])
+            case "custom":
+                return set(self.custom_dates) & set(trading_dates)
+            case _:
+                if not self.roll_forward:
+                    # same as the legacy rule: only run on the weekday itself
+                    return {i for i in trading_dates if i.weekday() == self.weekday}
+                # first trading day on or after the weekday in each calendar week
+                decision_dates = set()
+                seen_weeks = set()
+                for cur_date in trading_dates:
+                    cur_week = cur_date.isocalendar()[:2]
+                    if (cur_week in seen_weeks) or (cur_date.weekday() < self.weekday):
+                        continue
+                    seen_weeks.add(cur_week)
+                    decision_dates.add(cur_date)
+                return decision_dates
+
+    @classmethod
+    def from_config(
+        cls, config: Dict[str, Any], trading_dates: List[date]
+    ) -> "DecisionCalendar":
+        calendar_config = config.get("decision_calendar", {})
+        return cls(
+            trading_dates=trading_dates,
+            mode=calendar_config.get("mode", "weekly"),
+            weekday=calendar_config.get("weekday", 0),
+            every_n=calendar_config.get("every_n", 5),
+            dates=calendar_config.get("dates", None),
+            roll_forward=calendar_config.get("roll_forward", False),
+        )
+
+    def is_decision_day(self, cur_date: date) -> bool:
+        return cur_date in self.decision_dates
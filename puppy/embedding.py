@@ -1,14 +1,195 @@
 import os
+import re
+import time
+import hashlib
+import threading
 import numpy as np
-from typing import List, Union
-from langchain_community.embeddings import OpenAIEmbeddings
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple, Union
+from openai import OpenAI
+from tqdm import tqdm
+
+# context window of the openai embedding models, in tokens
+EMBEDDING_CONTEXT_TOKENS = 8191
+# a paragraph whose hash is divisible by this ends a chunk, see `_is_boundary`
+_BOUNDARY_EVERY = 4
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+class ChunkEmbeddingCache:
+    """
+    LRU cache of chunk embeddings keyed by the embedding model and a hash of the chunk text.
+    One cache is shared by all memory layers of the process, so a filing section that was embedded for one layer or one filing is not embedded again.
+    """
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Union[np.ndarray, None]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_chunk_caches: Dict[int, ChunkEmbeddingCache] = {}
+_chunk_caches_lock = threading.Lock()
+
+
+def get_chunk_cache(max_entries: int = 4096) -> ChunkEmbeddingCache:
+    with _chunk_caches_lock:
+        if max_entries not in _chunk_caches:
+            _chunk_caches[max_entries] = ChunkEmbeddingCache(max_entries)
+        return _chunk_caches[max_entries]
+
+
+class EmbeddingDispatcher:
+    """
+    Coalesces the embedding requests of all agents and memory layers of the process.
+    Texts submitted within `window` seconds of the first pending text, or until `max_batch_size` texts are pending, are sent in one request per endpoint and model, and each caller gets a future per text.
+    A text submitted by several callers in the same window is sent once.
+    """
+
+    def __init__(
+        self, window: float = 0.01, max_batch_size: int = 64, max_workers: int = 4
+    ) -> None:
+        self.window = window
+        self.max_batch_size = max_batch_size
+        # (model, api key, base url) -> text -> futures waiting for its embedding
+        self._pending: Dict[Tuple[str, str, str], Dict[str, List[Future]]] = {}
+        self._first_at: Dict[Tuple[str, str, str], float] = {}
+        self._clients: Dict[Tuple[str, str, str], OpenAI] = {}
+        self._cond = threading.Condition()
+        self._thread: Union[threading.Thread, None] = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.submitted = 0
+        self.sent = 0
+        self.requests = 0
+
+    def submit(self, client: OpenAI, model: str, texts: List[str]) -> List[Future]:
+        group = (model, client.api_key, str(client.base_url))
+        futures = []
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="embedding-dispatcher", daemon=True
+                )
+                self._thread.start()
+            pending = self._pending.setdefault(group, {})
+            self._clients.setdefault(group, client)
+            self._first_at.setdefault(group, time.monotonic())
+            for text in texts:
+                future: Future = Future()
+                pending.setdefault(text, []).append(future)
+                futures.append(future)
+            self.submitted += len(texts)
+            self._cond.notify()
+        return futures
+
+    def _due(self, now: float) -> List[Tuple[str, str, str]]:
+        return [
+            group
+            for group, pending in self._pending.items()
+            if len(pending) >= self.max_batch_size
+            or now - self._first_at[group] >= self.window
+        ]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = self._due(now)
+                if not due:
+                    self._cond.wait(
+                        timeout=min(self._first_at.values()) + self.window - now
+                    )
+                    continue
+                batches = []
+                for group in due:
+                    items = list(self._pending.pop(group).items())
+                    del self._first_at[group]
+                    batches.extend(
+                        (group, items[i : i + self.max_batch_size])
+                        for i in range(0, len(items), self.max_batch_size)
+                    )
+            for group, items in batches:
+                self._executor.submit(self._send, group, items)
+
+    def _send(
+        self, group: Tuple[str, str, str], items: List[Tuple[str, List[Future]]]
+    ) -> None:
+        try:
+            response = self._clients[group].embeddings.create(
+                model=group[0], input=[text for text, _ in items]
+            )
+            data = sorted(response.data, key=lambda x: x.index)
+        except Exception as e:
+            for _, futures in items:
+                for future in futures:
+                    future.set_exception(e)
+            return
+        with self._cond:
+            self.sent += len(items)
+            self.requests += 1
+        for (_, futures), cur_data in zip(items, data):
+            vector = np.array(cur_data.embedding, dtype=np.float32)
+            for future in futures:
+                future.set_result(vector)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "requests": self.requests,
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.submitted} texts submitted, {self.sent} sent "
+            f"in {self.requests} requests"
+        )
+
+
+_dispatchers: Dict[Tuple[float, int, int], EmbeddingDispatcher] = {}
+_dispatchers_lock = threading.Lock()
+
+
+def get_embedding_dispatcher(
+    window: float = 0.01, max_batch_size: int = 64, max_workers: int = 4
+) -> EmbeddingDispatcher:
+    key = (window, max_batch_size, max_workers)
+    with _dispatchers_lock:
+        if key not in _dispatchers:
+            _dispatchers[key] = EmbeddingDispatcher(*key)
+        return _dispatchers[key]
 
 
 class OpenAILongerThanContextEmb:
     """
     Embedding function with openai as embedding backend.
-    If the input is larger than the context size, the input is split into chunks of size `chunk_size` and embedded separately.
-    The final embedding is the average of the embeddings of the chunks.
+    If the input is longer than `chunk_size` tokens, it is split into chunks at paragraph breaks and the chunks are embedded separately, in parallel batched requests.
+    The final embedding is the average of the embeddings of the chunks, weighted by their token counts, normalized to unit length.
+    Chunk embeddings are cached, so filings that share sections (a 10-Q and the 10-K) only embed the new chunks.
     Details see: https://github.com/openai/openai-cookbook/blob/main/examples/Embedding_long_inputs.ipynb
     """
 
@@ -18,6 +199,11 @@ class OpenAILongerThanContextEmb:
         embedding_model: str = "text-embedding-ada-002",
         chunk_size: int = 5000,
         verbose: bool = False,
+        batch_size: int = 16,
+        max_workers: int = 4,
+        cache_size: int = 4096,
+        coalesce_window_ms: Union[float, None] = None,
+        coalesce_max_batch: int = 64,
     ) -> None:
         """
         Initializes the Embedding object.
@@ -25,43 +211,216 @@ class OpenAILongerThanContextEmb:
         Args:
             openai_api_key (str): The API key for OpenAI.
             embedding_model (str, optional): The model to use for embedding. Defaults to "text-embedding-ada-002".
-            chunk_size (int, optional): The maximum number of token to send to openai embedding model at one time. Defaults to 5000.
+            chunk_size (int, optional): The maximum number of token of a chunk sent to openai embedding model. Defaults to 5000.
             verbose (bool, optional): Whether to show progress bar during embedding. Defaults to False.
+            batch_size (int, optional): The maximum number of chunks in one embedding request. Defaults to 16.
+            max_workers (int, optional): The number of embedding requests sent at the same time. Defaults to 4.
+            cache_size (int, optional): The number of chunk embeddings kept in the cache, 0 disables the cache. Defaults to 4096.
+            coalesce_window_ms (float, optional): Send the chunks through the process wide `EmbeddingDispatcher`, which waits this long for requests of other callers. Defaults to None, every call sends its own requests.
+            coalesce_max_batch (int, optional): The number of texts that sends a coalesced request before the window ends. Defaults to 64.
 
         Returns:
             None
         """
         self.openai_api_key = openai_api_key or os.environ.get("OPENAI_API_KEY")
-        self.emb_model = OpenAIEmbeddings(
-            model=embedding_model,
-            api_key=openai_api_key or os.environ.get("OPENAI_API_KEY"),
-            chunk_size=chunk_size,
-            show_progress_bar=verbose,
+        self.embedding_model = embedding_model
+        self.chunk_size = min(chunk_size, EMBEDDING_CONTEXT_TOKENS)
+        self.verbose = verbose
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.cache = get_chunk_cache(cache_size) if cache_size > 0 else None
+        self.dispatcher = (
+            get_embedding_dispatcher(
+                coalesce_window_ms / 1000, coalesce_max_batch, max_workers
+            )
+            if coalesce_window_ms is not None
+            else None
         )
+        # OPENAI_API_BASE as with langchain, e.g. for the stub server
+        self.client = OpenAI(
+            api_key=self.openai_api_key,
+            base_url=os.environ.get("OPENAI_API_BASE") or None,
+        )
+        self._encoding = None
+        self.chunks_embedded = 0
+        self.chunks_cached = 0
+
+    @property
+    def encoding(self) -> Any:
+        # tiktoken downloads the encoding on first use
+        if self._encoding is None:
+            import tiktoken
 
-    def _emb(self, text: Union[List[str], str]) -> List[List[float]]:
+            self._encoding = tiktoken.encoding_for_model(self.embedding_model)
+        return self._encoding
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    @staticmethod
+    def _is_boundary(paragraph: str) -> bool:
+        # chunk ends depend on the paragraph text and not on its offset, so two filings
+        # that share a run of paragraphs split it into the same chunks
+        digest = hashlib.sha256(paragraph.encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") % _BOUNDARY_EVERY == 0
+
+    def _chunk(self, text: str) -> List[Tuple[str, int]]:
         """
-        Asynchronously performs embedding on a list of text.
+        Splits a text into chunks of at most `chunk_size` tokens.
 
-        This method calls the `aembed_documents` method of the `emb_model` object to embed the input text.
+        A text that fits is one chunk and is sent unchanged. Longer texts are split at paragraph breaks; a chunk is closed when the next paragraph does not fit, or, once it has a quarter of `chunk_size`, after a boundary paragraph. Paragraphs longer than `chunk_size` are cut into token windows.
+
+        Args:
+            text (str): The text to be split.
+
+        Returns:
+            List[Tuple[str, int]]: The chunks and their token counts.
+        """
+        n_tokens = self._count_tokens(text)
+        if n_tokens <= self.chunk_size:
+            return [(text, n_tokens)]
+        chunks = []
+        current: List[str] = []
+        current_tokens = 0
+
+        def close() -> None:
+            nonlocal current, current_tokens
+            if current:
+                chunks.append(("\n\n".join(current), current_tokens))
+            current, current_tokens = [], 0
+
+        for paragraph in _PARAGRAPH_BREAK.split(text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            tokens = self.encoding.encode(paragraph, disallowed_special=())
+            if len(tokens) > self.chunk_size:
+                close()
+                for start in range(0, len(tokens), self.chunk_size):
+                    window = tokens[start : start + self.chunk_size]
+                    chunks.append((self.encoding.decode(window), len(window)))
+                continue
+            # the paragraph break between joined paragraphs is one more token
+            if current_tokens + 1 + len(tokens) > self.chunk_size:
+                close()
+            current_tokens += len(tokens) + (1 if current else 0)
+            current.append(paragraph)
+            if current_tokens >= self.chunk_size // 4 and self._is_boundary(paragraph):
+                close()
+        close()
+        return chunks
+
+    def _request(self, texts: List[str]) -> List[np.ndarray]:
+        response = self.client.embeddings.create(
+            model=self.embedding_model, input=texts
+        )
+        data = sorted(response.data, key=lambda x: x.index)
+        return [np.array(i.embedding, dtype=np.float32) for i in data]
+
+    def _embed_chunks(self, chunks: Dict[str, str]) -> Dict[str, np.ndarray]:
+        """
+        Embeds the chunks that are not cached yet.
+
+        Args:
+            chunks (Dict[str, str]): The chunk texts by cache key.
+
+        Returns:
+            Dict[str, np.ndarray]: The embeddings by cache key.
+        """
+        ret = {}
+        missing = []
+        for key, chunk in chunks.items():
+            vector = self.cache.get(key) if self.cache is not None else None
+            if vector is None:
+                missing.append(key)
+            else:
+                ret[key] = vector
+        self.chunks_cached += len(chunks) - len(missing)
+        self.chunks_embedded += len(missing)
+        if not missing:
+            return ret
+        if self.dispatcher is not None:
+            futures = self.dispatcher.submit(
+                self.client, self.embedding_model, [chunks[i] for i in missing]
+            )
+            batches = [missing]
+            results = [[i.result() for i in futures]]
+        else:
+            results, batches = self._send_batches(chunks, missing)
+        for batch, vectors in zip(batches, results):
+            for key, vector in zip(batch, vectors):
+                ret[key] = vector
+                if self.cache is not None:
+                    self.cache.put(key, vector)
+        return ret
+
+    def _send_batches(
+        self, chunks: Dict[str, str], missing: List[str]
+    ) -> Tuple[List[List[np.ndarray]], List[List[str]]]:
+        # requests of this call only, in parallel
+        batches = [
+            missing[i : i + self.batch_size]
+            for i in range(0, len(missing), self.batch_size)
+        ]
+        if len(batches) <= 1:
+            results = [self._request([chunks[i] for i in batch]) for batch in batches]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(batches))
+            ) as executor:
+                results = executor.map(
+                    lambda batch: self._request([chunks[i] for i in batch]), batches
+                )
+                results = list(
+                    tqdm(results, total=len(batches), disable=not self.verbose)
+                )
+        return results, batches
+
+    def _emb(self, text: Union[List[str], str]) -> List[np.ndarray]:
+        """
+        Performs embedding on a list of text.
+
+        The texts are chunked, all chunks of all texts that are not cached are embedded in parallel batches, and the chunk embeddings of each text are averaged weighted by their token counts.
 
         Args:
             self: The instance of the class.
             text (List[str]): A list of text to be embedded.
 
         Returns:
-            List[List[float]]: The embeddings of the input text as a list of lists of floats.
+            List[np.ndarray]: The embeddings of the input text.
 
         """
         if isinstance(text, str):
             text = [text]
-        return self.emb_model.embed_documents(texts=text, chunk_size=None)
+        chunked = [
+            [
+                (ChunkEmbeddingCache.key(self.embedding_model, chunk), chunk, tokens)
+                for chunk, tokens in self._chunk(cur_text)
+            ]
+            for cur_text in text
+        ]
+        # identical chunks of different texts are embedded once
+        vectors = self._embed_chunks(
+            {key: chunk for cur_chunks in chunked for key, chunk, _ in cur_chunks}
+        )
+        ret = []
+        for cur_chunks in chunked:
+            if len(cur_chunks) == 1:
+                ret.append(vectors[cur_chunks[0][0]])
+                continue
+            average = np.average(
+                np.vstack([vectors[key] for key, _, _ in cur_chunks]),
+                axis=0,
+                weights=[tokens for _, _, tokens in cur_chunks],
+            )
+            ret.append(average / np.linalg.norm(average))
+        return ret
 
     def __call__(self, text: Union[List[str], str]) -> np.ndarray:
         """
         Performs embedding on a list of text.
 
-        This method calls the `_emb` method to asynchronously embed the input text using the `emb_model` object.
+        This method calls the `_emb` method to embed the input text using the openai embedding endpoint.
 
         Args:
             self: The instance of the class.
@@ -77,7 +436,7 @@ class OpenAILongerThanContextEmb:
         """
         Returns the dimension of the embedding.
 
-        This method checks the value of `self.emb_model.model` and returns the corresponding embedding dimension. If the model is not implemented, a `NotImplementedError` is raised.
+        This method checks the value of `self.embedding_model` and returns the corresponding embedding dimension. If the model is not implemented, a `NotImplementedError` is raised.
 
         Args:
             self: The instance of the class.
@@ -89,10 +448,10 @@ class OpenAILongerThanContextEmb:
             NotImplementedError: Raised when the embedding dimension for the specified model is not implemented.
 
         """
-        match self.emb_model.model:
+        match self.embedding_model:
             case "text-embedding-ada-002":
                 return 1536
             case _:
                 raise NotImplementedError(
-                    f"Embedding dimension for model {self.emb_model.model} not implemented"
+                    f"Embedding dimension for model {self.embedding_model} not implemented"
                 )
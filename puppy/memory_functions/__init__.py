@@ -9,3 +9,4 @@ from .recency import R_ConstantInitialization
 from .compound_score import LinearCompoundScore
 from .decay import ExponentialDecay
 from .access_counter import LinearImportanceScoreChange
+from .dedup import NearDuplicateFilter
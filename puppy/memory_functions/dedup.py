@@ -0,0 +1,74 @@
+import re
+import hashlib
+import numpy as np
+from typing import Any, Dict, Union
+
+# a and b of the MinHash permutations are below 2**32, so a * x + b fits in uint64
+_PRIME = np.uint64(4294967311)
+
+
+class NearDuplicateFilter:
+    """Tells whether a new memory repeats a recent one.
+
+    A pair is a near duplicate when the cosine similarity of the embeddings and the
+    MinHash estimate of the Jaccard similarity of the word shingles both pass, so
+    different stories on the same topic are kept apart.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: float = 0.95,
+        jaccard_threshold: float = 0.7,
+        window_days: int = 3,
+        importance_bump: float = 0.0,
+        num_perm: int = 64,
+        shingle_size: int = 3,
+    ) -> None:
+        self.similarity_threshold = similarity_threshold
+        self.jaccard_threshold = jaccard_threshold
+        self.window_days = window_days
+        self.importance_bump = importance_bump
+        self.shingle_size = shingle_size
+        # own generator, the importance sampling uses the global one
+        rng = np.random.RandomState(0)
+        self._a = rng.randint(1, 2**32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 2**32, size=num_perm, dtype=np.uint64)
+
+    @classmethod
+    def from_config(
+        cls, config: Union[Dict[str, Any], None]
+    ) -> Union["NearDuplicateFilter", None]:
+        if not config:
+            return None
+        return cls(**config)
+
+    def signature(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        shingles = {
+            " ".join(words[i : i + self.shingle_size])
+            for i in range(max(len(words) - self.shingle_size + 1, 1))
+        }
+        hashes = np.array(
+            [
+                int.from_bytes(
+                    hashlib.blake2b(i.encode("utf-8"), digest_size=4).digest(), "big"
+                )
+                for i in shingles
+            ],
+            dtype=np.uint64,
+        )
+        return ((hashes[:, None] * self._a + self._b) % _PRIME).min(axis=0)
+
+    @staticmethod
+    def jaccard(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+        return float(np.mean(signature_a == signature_b))
+
+    def is_duplicate(
+        self,
+        similarity: float,
+        signature_a: np.ndarray,
+        signature_b: np.ndarray,
+    ) -> bool:
+        return (similarity >= self.similarity_threshold) and (
+            self.jaccard(signature_a, signature_b) >= self.jaccard_threshold
+        )
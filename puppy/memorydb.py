@@ -3,9 +3,10 @@ import faiss
 import pickle
 import faiss
 import logging
+import bisect
 import shutil
 import numpy as np
-from datetime import date
+from datetime import date, timedelta
 from itertools import repeat
 from sortedcontainers import SortedList
 from .embedding import OpenAILongerThanContextEmb
@@ -17,6 +18,7 @@ from .memory_functions import (
     LinearCompoundScore,
     ExponentialDecay,
     LinearImportanceScoreChange,
+    NearDuplicateFilter,
 )
 
 
@@ -46,6 +48,7 @@ class MemoryDB:  # can possibly take multiple symbols
         clean_up_threshold_dict: Dict[
             str, float
         ],  # {"recency_threshold": x, "importance_threshold": y"}
+        dedup_config: Union[Dict[str, Any], None] = None,
     ) -> None:
         # db attributes
         self.db_name = db_name
@@ -64,9 +67,15 @@ class MemoryDB:  # can possibly take multiple symbols
             importance_score_change_access_counter
         )
         self.clean_up_threshold_dict = dict(clean_up_threshold_dict)
+        # merges near duplicate news into one record, off without a config
+        self.dedup_config = dedup_config
+        self.dedup = NearDuplicateFilter.from_config(dedup_config)
+        self._signatures: Dict[int, np.ndarray] = {}
         # records
         self.universe = {}
         self.logger = logger
+        # counts the tokens of new memories for the prompt budget, set by the agent
+        self.token_counter: Union[Callable[[List[str]], List[int]], None] = None
 
     def add_new_symbol(self, symbol: str) -> None:
         cur_index = faiss.IndexFlatIP(
@@ -81,21 +90,57 @@ class MemoryDB:  # can possibly take multiple symbols
         }
         self.universe[symbol] = temp_record
 
-    def add_memory(self, symbol: str, date: date, text: Union[List[str], str]) -> None:
+    def add_memory(
+        self,
+        symbol: str,
+        date: Union[date, List[date]],
+        text: Union[List[str], str],
+    ) -> None:
         # add new symbol if not exist
         if symbol not in self.universe:
             self.add_new_symbol(symbol)
 
         if isinstance(text, str):
             text = [text]
+        # one date for all texts or one date per text
+        dates = date if isinstance(date, list) else list(repeat(date, len(text)))
+        if len(dates) != len(text):
+            raise ValueError("date list must have the same length as text list")
         # get embedding
         emb = self.emb_func(text)
+        self.add_memory_with_embeddings(symbol, dates, text, emb)
+
+    def add_memory_with_embeddings(
+        self, symbol: str, dates: List[date], text: List[str], emb: np.ndarray
+    ) -> None:
+        # texts embedded by the caller, e.g. in one batch with other layers
+        if symbol not in self.universe:
+            self.add_new_symbol(symbol)
         faiss.normalize_L2(emb)
+        repeats = [0] * len(text)
+        if self.dedup is not None:
+            keep, repeats = self._merge_duplicates(symbol, dates, text, emb)
+            if not keep:
+                return
+            dates = [dates[i] for i in keep]
+            text = [text[i] for i in keep]
+            emb = np.ascontiguousarray(emb[keep])
         ids = [self.id_generator() for _ in range(len(text))]
+        # token counts, one batch for all texts
+        token_counts = (
+            self.token_counter(text)
+            if self.token_counter is not None
+            else list(repeat(None, len(text)))
+        )
         # initialize importance score
         importance_scores = [
             self.importance_score_initialization_func() for _ in range(len(text))
         ]
+        if self.dedup is not None:
+            importance_scores = [
+                cur_i + self.dedup.importance_bump * cur_repeats
+                for cur_i, cur_repeats in zip(importance_scores, repeats)
+            ]
         # recency
         recency_scores = [
             self.recency_score_initialization_func() for _ in range(len(text))
@@ -109,18 +154,20 @@ class MemoryDB:  # can possibly take multiple symbols
         ]
         self.universe[symbol]["index"].add_with_ids(emb, np.array(ids))
         for i in range(len(text)):
-            self.universe[symbol]["score_memory"].add(
-                {
-                    "text": text[i],
-                    "id": ids[i],
-                    "important_score": importance_scores[i],
-                    "recency_score": recency_scores[i],
-                    "delta": 0,
-                    "important_score_recency_compound_score": partial_scores[i],
-                    "access_counter": 0,
-                    "date": date,
-                }
-            )
+            record = {
+                "text": text[i],
+                "id": ids[i],
+                "important_score": importance_scores[i],
+                "recency_score": recency_scores[i],
+                "delta": 0,
+                "important_score_recency_compound_score": partial_scores[i],
+                "access_counter": 0,
+                "date": dates[i],
+                "token_count": token_counts[i],
+            }
+            if self.dedup is not None:
+                record["occurrences"] = 1 + repeats[i]
+            self.universe[symbol]["score_memory"].add(record)
             # log
             self.logger.info(
                 {
@@ -131,19 +178,142 @@ class MemoryDB:  # can possibly take multiple symbols
                     "delta": 0,
                     "important_score_recency_compound_score": partial_scores[i],
                     "access_counter": 0,
-                    "date": date,
+                    "date": dates[i],
+                    "token_count": token_counts[i],
                 }
             )
 
+    def _signature(self, record: Dict[str, Any]) -> np.ndarray:
+        if record["id"] not in self._signatures:
+            self._signatures[record["id"]] = self.dedup.signature(  # type: ignore
+                record["text"]
+            )
+        return self._signatures[record["id"]]
+
+    def _drop_signatures(self, ids: List[int]) -> None:
+        # records that were cleaned up or jumped to another layer
+        for i in ids:
+            self._signatures.pop(i, None)
+
+    def _merge_duplicates(
+        self, symbol: str, dates: List[date], text: List[str], emb: np.ndarray
+    ) -> Tuple[List[int], List[int]]:
+        """Merge the near duplicates among the new texts into the memories they repeat.
+
+        A new text is compared with the memories of the symbol from the last
+        `window_days` days and with the earlier texts of the batch. A repeat of a stored
+        memory raises its occurrence count and importance, a repeat of an earlier text
+        is counted for that text.
+
+        Returns:
+            Tuple[List[int], List[int]]: positions of the texts to insert, and the number
+                of repeats merged into each text.
+        """
+        dedup: NearDuplicateFilter = self.dedup  # type: ignore
+        window = timedelta(days=dedup.window_days)
+        score_memory = self.universe[symbol]["score_memory"]
+        earliest = min(dates) - window
+        recent = [record for record in score_memory if record["date"] >= earliest]
+        similarities = (
+            emb
+            @ np.vstack(
+                [self.universe[symbol]["index"].reconstruct(i["id"]) for i in recent]
+            ).T
+            if recent
+            else np.zeros((len(text), 0), dtype=np.float32)
+        )
+        signatures = [dedup.signature(i) for i in text]
+        keep: List[int] = []
+        repeats = [0] * len(text)
+        merged: Dict[int, Dict[str, Any]] = {}
+        for i in range(len(text)):
+            target = None
+            # best matches first, the similarity check is cheaper than the text check
+            for j in np.argsort(-similarities[i]):
+                if similarities[i, j] < dedup.similarity_threshold:
+                    break
+                if abs(dates[i] - recent[j]["date"]) <= window and dedup.is_duplicate(
+                    similarities[i, j], signatures[i], self._signature(recent[j])
+                ):
+                    target = recent[j]
+                    break
+            if target is not None:
+                merged[target["id"]] = target
+                target["occurrences"] = target.get("occurrences", 1) + 1
+                target["important_score"] += dedup.importance_bump
+                self.logger.info(
+                    f"Near duplicate merged into memory {target['id']}: {text[i]}"
+                )
+                continue
+            for k in keep:
+                if abs(dates[i] - dates[k]) <= window and dedup.is_duplicate(
+                    float(emb[i] @ emb[k]), signatures[i], signatures[k]
+                ):
+                    repeats[k] += 1
+                    break
+            else:
+                keep.append(i)
+        if merged and dedup.importance_bump:
+            for record in merged.values():
+                record["important_score_recency_compound_score"] = (
+                    self.compound_score_calculation_func.recency_and_importance_score(
+                        recency_score=record["recency_score"],
+                        importance_score=record["important_score"],
+                    )
+                )
+            # the keys of the sorted list changed
+            self.universe[symbol]["score_memory"] = SortedList(
+                score_memory, key=lambda x: x["important_score_recency_compound_score"]
+            )
+        return keep, [repeats[i] for i in keep]
+
+    def add_records(
+        self, symbol: str, records: List[Dict[str, Any]], emb: np.ndarray
+    ) -> None:
+        # records with their scores already set, e.g. by BrainDB.backfill
+        if symbol not in self.universe:
+            self.add_new_symbol(symbol)
+        faiss.normalize_L2(emb)
+        self.universe[symbol]["score_memory"].update(records)
+        self.universe[symbol]["index"].add_with_ids(
+            emb, np.array([i["id"] for i in records])
+        )
+
+    def get_token_counts(self, symbol: str, ids: List[int]) -> List[Union[int, None]]:
+        # stored counts, records of older checkpoints are counted once here
+        if symbol not in self.universe:
+            return [None] * len(ids)
+        wanted = set(ids)
+        records = {
+            record["id"]: record
+            for record in self.universe[symbol]["score_memory"]
+            if record["id"] in wanted
+        }
+        missing = [
+            record for record in records.values() if record.get("token_count") is None
+        ]
+        if missing and (self.token_counter is not None):
+            for record, count in zip(
+                missing, self.token_counter([record["text"] for record in missing])
+            ):
+                record["token_count"] = count
+        return [records[i].get("token_count") if i in records else None for i in ids]
+
     def query(
         self, query_text: str, top_k: int, symbol: str
     ) -> Tuple[List[str], List[int]]:
+        ret_text_list, ret_ids, _ = self.query_with_scores(query_text, top_k, symbol)
+        return ret_text_list, ret_ids
+
+    def query_with_scores(
+        self, query_text: str, top_k: int, symbol: str
+    ) -> Tuple[List[str], List[int], List[float]]:
         if (
             (symbol not in self.universe)
             or (len(self.universe[symbol]["score_memory"]) == 0)
             or (top_k == 0)
         ):
-            return [], []
+            return [], [], []
         max_len = len(self.universe[symbol]["score_memory"])
         top_k = min(top_k, max_len)
         cur_index = self.universe[symbol]["index"]
@@ -205,17 +375,20 @@ class MemoryDB:  # can possibly take multiple symbols
         temp_ret_text_list = [temp_text_list[i] for i in score_rank]
         temp_ret_date_list = [temp_date_list[i] for i in score_rank]
         temp_ret_ids = [temp_ids[i] for i in score_rank]
+        temp_ret_scores = [temp_score[i] for i in score_rank]
         ret_text_list = []
         ret_date_list = []
         ret_ids = []
+        ret_scores = []
         _, unique_index = np.unique(temp_ret_ids, return_index=True)
         unique_index = unique_index.tolist()
         for i in unique_index:
             ret_text_list.append(temp_ret_text_list[i])
             ret_date_list.append(temp_ret_date_list[i])
             ret_ids.append(temp_ret_ids[i])
+            ret_scores.append(temp_ret_scores[i])
 
-        return ret_text_list, ret_ids
+        return ret_text_list, ret_ids, ret_scores
 
     def update_access_count_with_feed_back(  # test pass
         self, symbol: str, ids: List[int], feedback: List[int]
@@ -292,6 +465,7 @@ class MemoryDB:  # can possibly take multiple symbols
                 self.universe[cur_symbol]["score_memory"] = new_list
                 self.universe[cur_symbol]["index"].remove_ids(np.array(remove_ids))
                 ret_removed_ids.extend(remove_ids)
+        self._drop_signatures(ret_removed_ids)
         return ret_removed_ids
 
     def step(self) -> List[int]:
@@ -331,6 +505,7 @@ class MemoryDB:  # can possibly take multiple symbols
                     )
             temp_delete_ids = temp_delete_ids_up + temp_delete_ids_down
             id_to_remove.extend(temp_delete_ids)
+            self._drop_signatures(temp_delete_ids)
             self.universe[cur_symbol]["index"].remove_ids(np.array(temp_delete_ids))
             new_memory = SortedList(
                 [], key=lambda x: x["important_score_recency_compound_score"]
@@ -397,6 +572,7 @@ class MemoryDB:  # can possibly take multiple symbols
             "decay_function": self.decay_function,
             "importance_score_change_access_counter": self.importance_score_change_access_counter,
             "clean_up_threshold_dict": self.clean_up_threshold_dict,
+            "dedup_config": self.dedup_config,
             "logger": self.logger,
         }
         with open(os.path.join(path, name, "state_dict.pkl"), "wb") as f:
@@ -452,6 +628,7 @@ class MemoryDB:  # can possibly take multiple symbols
             ],
             decay_function=state_dict["decay_function"],
             clean_up_threshold_dict=state_dict["clean_up_threshold_dict"],
+            dedup_config=state_dict.get("dedup_config"),
             logger=state_dict["logger"],
         )
         obj.universe = universe.copy()
@@ -525,6 +702,7 @@ class BrainDB:
                 **config["short"]["decay_params"],
             ),
             clean_up_threshold_dict=config["short"]["clean_up_threshold_dict"],
+            dedup_config=config["short"].get("dedup"),
             logger=logger,
         )
         mid_term_memory = MemoryDB(
@@ -542,6 +720,7 @@ class BrainDB:
             importance_score_change_access_counter=LinearImportanceScoreChange(),
             decay_function=ExponentialDecay(**config["mid"]["decay_params"]),
             clean_up_threshold_dict=config["mid"]["clean_up_threshold_dict"],
+            dedup_config=config["mid"].get("dedup"),
             logger=logger,
         )
         long_term_memory = MemoryDB(
@@ -561,6 +740,7 @@ class BrainDB:
                 **config["long"]["decay_params"],
             ),
             clean_up_threshold_dict=config["long"]["clean_up_threshold_dict"],
+            dedup_config=config["long"].get("dedup"),
             logger=logger,
         )
         reflection_memory = MemoryDB(
@@ -580,6 +760,7 @@ class BrainDB:
                 **config["reflection"]["decay_params"],
             ),
             clean_up_threshold_dict=config["reflection"]["clean_up_threshold_dict"],
+            dedup_config=config["reflection"].get("dedup"),
             logger=logger,
         )
         return cls(
@@ -594,25 +775,240 @@ class BrainDB:
         )
 
     def add_memory_short(
-        self, symbol: str, date: date, text: Union[List[str], str]
+        self,
+        symbol: str,
+        date: Union[date, List[date]],
+        text: Union[List[str], str],
     ) -> None:
         self.short_term_memory.add_memory(symbol, date, text)
 
     def add_memory_mid(
-        self, symbol: str, date: date, text: Union[List[str], str]
+        self,
+        symbol: str,
+        date: Union[date, List[date]],
+        text: Union[List[str], str],
     ) -> None:
         self.mid_term_memory.add_memory(symbol, date, text)
 
     def add_memory_long(
-        self, symbol: str, date: date, text: Union[List[str], str]
+        self,
+        symbol: str,
+        date: Union[date, List[date]],
+        text: Union[List[str], str],
     ) -> None:
         self.long_term_memory.add_memory(symbol, date, text)
 
     def add_memory_reflection(
-        self, symbol: str, date: date, text: Union[List[str], str]
+        self,
+        symbol: str,
+        date: Union[date, List[date]],
+        text: Union[List[str], str],
     ) -> None:
         self.reflection_memory.add_memory(symbol, date, text)
 
+    def add_memories_bulk(
+        self, symbol: str, memories: List[Tuple[str, date, str]]
+    ) -> None:
+        """Add the (layer, date, text) memories of all layers with one embedding call.
+
+        The layers are filled in the order they first appear in `memories`, all
+        layers use the embedding config of the short term memory.
+        """
+        if not memories:
+            return
+        unknown = {i[0] for i in memories} - {"short", "mid", "long", "reflection"}
+        if unknown:
+            raise ValueError(f"unknown memory layers: {', '.join(sorted(unknown))}")
+        emb = self.short_term_memory.emb_func([i[2] for i in memories])
+        for layer in dict.fromkeys(i[0] for i in memories):
+            rows = [i for i, cur in enumerate(memories) if cur[0] == layer]
+            self._layer(layer).add_memory_with_embeddings(
+                symbol,
+                [memories[i][1] for i in rows],
+                [memories[i][2] for i in rows],
+                np.ascontiguousarray(emb[rows]),
+            )
+
+    def backfill(
+        self,
+        symbol: str,
+        memories: List[Tuple[str, date, str]],
+        step_dates: Union[List[date], None] = None,
+    ) -> None:
+        """Warm start the memories of a symbol from a (layer, date, text) table.
+
+        The end state is that of adding every memory on the first step date on or after
+        its date and calling `step` after each step date, without agent feedback. The
+        decay, clean up and jumps of all memories are replayed together on arrays, and
+        only the memories left at the end are embedded, in one call, and indexed. Near
+        duplicates are not merged.
+
+        Args:
+            symbol (str): the symbol, it must not have memories yet.
+            memories (List[Tuple[str, date, str]]): (layer, date, text) of each memory.
+            step_dates (Union[List[date], None], optional): the days the brain steps on.
+                Defaults to None, the dates of the memories.
+        """
+        layers = ("short", "mid", "long", "reflection")
+        unknown = {i[0] for i in memories} - set(layers)
+        if unknown:
+            raise ValueError(f"unknown memory layers: {', '.join(sorted(unknown))}")
+        for layer in layers:
+            universe = self._layer(layer).universe
+            if (symbol in universe) and len(universe[symbol]["score_memory"]):
+                raise ValueError(f"{symbol} already has memories, backfill needs none")
+        if not memories:
+            return
+        steps = sorted(
+            set(step_dates if step_dates is not None else [i[1] for i in memories])
+        )
+        entry = [bisect.bisect_left(steps, i[1]) for i in memories]
+        if max(entry) == len(steps):
+            raise ValueError("memories dated after the last step date")
+        # the order add_memories_bulk adds them in: by step, then by layer
+        rows_by_step: Dict[int, List[int]] = {}
+        for i, cur_entry in enumerate(entry):
+            rows_by_step.setdefault(cur_entry, []).append(i)
+        order = []
+        for cur_entry in sorted(rows_by_step):
+            rows = rows_by_step[cur_entry]
+            for layer in dict.fromkeys(memories[i][0] for i in rows):
+                order.extend(i for i in rows if memories[i][0] == layer)
+        memories = [memories[i] for i in order]
+        entry_step = np.array([entry[i] for i in order])
+        codes = np.array([layers.index(i[0]) for i in memories])
+        ids = [self.id_generator() for _ in memories]
+        # initial scores drawn in the same order as when adding day by day
+        importance = np.array(
+            [
+                self._layer(i[0]).importance_score_initialization_func()
+                for i in memories
+            ],
+            dtype=np.float64,
+        )
+        recency = np.array(
+            [self._layer(i[0]).recency_score_initialization_func() for i in memories],
+            dtype=np.float64,
+        )
+        delta = np.zeros(len(memories), dtype=np.int64)
+        # layer index of each memory, -1 before its step and -2 once removed
+        state = np.full(len(memories), -1)
+        for cur_step in range(len(steps)):
+            new = entry_step == cur_step
+            state[new] = codes[new]
+            # decay and clean up
+            for code, layer in enumerate(layers):
+                memory_db = self._layer(layer)
+                mask = state == code
+                if not mask.any():
+                    continue
+                recency[mask], importance[mask], delta[mask] = memory_db.decay_function(
+                    important_score=importance[mask], delta=delta[mask]
+                )
+                clean_up = mask & (
+                    (recency < memory_db.clean_up_threshold_dict["recency_threshold"])
+                    | (
+                        importance
+                        < memory_db.clean_up_threshold_dict["importance_threshold"]
+                    )
+                )
+                state[clean_up] = -2
+                self.removed_ids.extend(ids[i] for i in np.flatnonzero(clean_up))
+            # jumps do not update the compound score, it keeps the decayed recency
+            decayed_recency = recency.copy()
+            decayed_state = state.copy()
+            # (layer, layer it jumps up to, layer it jumps down to), -2 drops it
+            for _ in range(2):
+                for code, up, down in ((0, 1, -2), (1, 2, 0), (2, -2, 1)):
+                    memory_db = self._layer(layers[code])
+                    mask = state == code
+                    up_mask = mask & (importance >= memory_db.jump_threshold_upper)
+                    down_mask = mask & (importance < memory_db.jump_threshold_lower)
+                    self.removed_ids.extend(ids[i] for i in np.flatnonzero(up_mask))
+                    self.removed_ids.extend(ids[i] for i in np.flatnonzero(down_mask))
+                    state[up_mask] = up
+                    state[down_mask] = down
+                    if up >= 0:
+                        recency[up_mask] = self._layer(
+                            layers[up]
+                        ).recency_score_initialization_func()
+                        delta[up_mask] = 0
+        # embed and index what is left, once
+        kept = np.flatnonzero(state >= 0).tolist()
+        if not kept:
+            self.logger.info(f"Backfill {symbol}: {len(memories)} memories, none kept")
+            return
+        texts = [memories[i][2] for i in kept]
+        emb = self.short_term_memory.emb_func(texts)
+        token_counter = self.short_term_memory.token_counter
+        token_counts = (
+            token_counter(texts)
+            if token_counter is not None
+            else list(repeat(None, len(texts)))
+        )
+        for code, layer in enumerate(layers):
+            rows = [j for j, i in enumerate(kept) if state[i] == code]
+            if not rows:
+                continue
+            records = []
+            for j in rows:
+                i = kept[j]
+                records.append(
+                    {
+                        "text": memories[i][2],
+                        "id": ids[i],
+                        "important_score": importance[i],
+                        "recency_score": recency[i],
+                        "delta": int(delta[i]),
+                        "important_score_recency_compound_score": self._layer(
+                            layers[decayed_state[i]]
+                        ).compound_score_calculation_func.recency_and_importance_score(
+                            recency_score=decayed_recency[i],
+                            importance_score=importance[i],
+                        ),
+                        "access_counter": 0,
+                        "date": memories[i][1],
+                        "token_count": token_counts[j],
+                    }
+                )
+            self._layer(layer).add_records(
+                symbol, records, np.ascontiguousarray(emb[rows])
+            )
+        self.logger.info(
+            f"Backfill {symbol}: {len(memories)} memories over {len(steps)} steps, "
+            f"{len(kept)} kept"
+        )
+
+    def set_token_counter(
+        self, token_counter: Union[Callable[[List[str]], List[int]], None]
+    ) -> None:
+        for memory_db in [
+            self.short_term_memory,
+            self.mid_term_memory,
+            self.long_term_memory,
+            self.reflection_memory,
+        ]:
+            memory_db.token_counter = token_counter
+
+    def _layer(self, layer: str) -> MemoryDB:
+        return {
+            "short": self.short_term_memory,
+            "mid": self.mid_term_memory,
+            "long": self.long_term_memory,
+            "reflection": self.reflection_memory,
+        }[layer]
+
+    def get_token_counts(
+        self, layer: str, symbol: str, ids: List[int]
+    ) -> List[Union[int, None]]:
+        return self._layer(layer).get_token_counts(symbol, ids)
+
+    def query_with_scores(
+        self, layer: str, query_text: str, top_k: int, symbol: str
+    ) -> Tuple[List[str], List[int], List[float]]:
+        # texts, ids and the compound scores that rank them, comparable across layers
+        return self._layer(layer).query_with_scores(query_text, top_k, symbol)
+
     def query_short(
         self, query_text: str, top_k: int, symbol: str
     ) -> Tuple[List[str], List[int]]:
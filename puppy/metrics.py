@@ -0,0 +1,277 @@
+import math
+import numpy as np
+import polars as pl
+from datetime import datetime
+from typing import Dict, List, Tuple, Union, Any
+
+TRADING_DAYS = 252
+
+
+def _as_matrix(actions: np.ndarray) -> np.ndarray:
+    actions = np.asarray(actions, dtype=np.float64)
+    return actions[None, :] if actions.ndim == 1 else actions
+
+
+def daily_rewards(actions: np.ndarray, price: np.ndarray) -> np.ndarray:
+    """Log reward of every run on every day.
+
+    Args:
+        actions (np.ndarray): runs x dates matrix of positions, the action of day i
+            is applied to the price move from day i to day i + 1.
+        price (np.ndarray): price of each date.
+
+    Returns:
+        np.ndarray: runs x (dates - 1) matrix of daily rewards.
+    """
+    actions = _as_matrix(actions)
+    price = np.asarray(price, dtype=np.float64)
+    if actions.shape[1] < len(price) - 1:
+        raise ValueError("actions must cover every price move")
+    log_return = np.diff(np.log(price))
+    return actions[:, : len(log_return)] * log_return[None, :]
+
+
+def cumulative_rewards(actions: np.ndarray, price: np.ndarray) -> np.ndarray:
+    return np.cumsum(daily_rewards(actions, price), axis=1)
+
+
+def max_drawdown(rewards: np.ndarray) -> np.ndarray:
+    rewards = _as_matrix(rewards)
+    wealth = np.cumprod(
+        np.concatenate([np.ones((rewards.shape[0], 1)), 1 + rewards], axis=1), axis=1
+    )
+    peak = np.maximum.accumulate(wealth, axis=1)
+    return ((peak - wealth) / peak).max(axis=1)
+
+
+def compute_metrics(
+    actions: np.ndarray,
+    price: np.ndarray,
+    risk_free_rate: float = 0.0,
+    trading_days: int = TRADING_DAYS,
+) -> Dict[str, np.ndarray]:
+    """Compute the metrics of every run in one pass.
+
+    The definitions follow `data-pipeline/07-metrics.py`. A run with zero volatility
+    gets a NaN Sharpe ratio instead of raising.
+
+    Args:
+        actions (np.ndarray): runs x dates matrix of positions.
+        price (np.ndarray): price of each date.
+        risk_free_rate (float, optional): annualized risk free rate. Defaults to 0.0.
+        trading_days (int, optional): trading days per year. Defaults to 252.
+
+    Returns:
+        Dict[str, np.ndarray]: one array of length runs per metric.
+    """
+    rewards = daily_rewards(actions, price)
+    cum_return = rewards.sum(axis=1)
+    std = (
+        rewards.std(axis=1, ddof=1)
+        if rewards.shape[1] > 1
+        else np.full(rewards.shape[0], np.nan)
+    )
+    ann_vol = std * math.sqrt(trading_days)
+    annual_return = cum_return / (len(price) / trading_days)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpe_ratio = np.where(
+            ann_vol > 0, (annual_return - risk_free_rate) / ann_vol, np.nan
+        )
+    return {
+        "cumulative_return": cum_return,
+        "sharpe_ratio": sharpe_ratio,
+        "standard_deviation": std,
+        "annualized_volatility": ann_vol,
+        "max_drawdown": max_drawdown(rewards),
+    }
+
+
+def metrics_frame(
+    run_names: List[str],
+    actions: np.ndarray,
+    price: np.ndarray,
+    risk_free_rate: float = 0.0,
+    trading_days: int = TRADING_DAYS,
+) -> pl.DataFrame:
+    metrics = compute_metrics(actions, price, risk_free_rate, trading_days)
+    return pl.DataFrame({"run": run_names, **metrics})
+
+
+def _sorted_ranks(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # row-wise sort order, with the average rank (1-based) and the tie group size
+    # at each sorted position, ranks are never scattered back to the input order
+    n_rows, n_cols = values.shape
+    order = np.argsort(values, axis=1)
+    flat_order = (order + np.arange(n_rows)[:, None] * n_cols).ravel()
+    sorted_values = values.ravel()[flat_order].reshape(n_rows, n_cols)
+    new_group = np.ones((n_rows, n_cols), dtype=np.bool_)
+    new_group[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    if new_group.all():
+        ranks = np.broadcast_to(
+            np.arange(1, n_cols + 1, dtype=np.float64), values.shape
+        )
+        return flat_order, ranks, np.ones(values.shape, dtype=np.float64)
+    # tie groups never cross rows, so they can be numbered over the flat array
+    new_group = new_group.ravel()
+    group_id = np.cumsum(new_group) - 1
+    group_size = np.bincount(group_id).astype(np.float64)
+    group_rank = np.flatnonzero(new_group) % n_cols + (group_size - 1) / 2 + 1
+    return (
+        flat_order,
+        group_rank[group_id].reshape(n_rows, n_cols),
+        group_size[group_id].reshape(n_rows, n_cols),
+    )
+
+
+_erfc = np.frompyfunc(math.erfc, 1, 1)
+
+
+def wilcoxon_signed_rank(
+    x: np.ndarray, y: Union[np.ndarray, None] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Two-sided Wilcoxon signed-rank test for every row at once.
+
+    Zero differences are dropped and ties get average ranks, like the default of
+    `scipy.stats.wilcoxon`. The p-value uses the normal approximation with the tie
+    correction, which is what scipy uses for more than 50 pairs.
+
+    Args:
+        x (np.ndarray): rows of paired samples, or the differences if y is None.
+        y (Union[np.ndarray, None], optional): rows of paired samples. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the statistic and the p-value of each row.
+    """
+    diff = _as_matrix(x) if y is None else _as_matrix(x) - _as_matrix(y)
+    flat_order, ranks, ties = _sorted_ranks(np.abs(diff))
+    sorted_diff = diff.ravel()[flat_order].reshape(diff.shape)
+    nonzero = sorted_diff != 0
+    n = nonzero.sum(axis=1)
+    # zeros sort first, shifting leaves the ranks among the nonzero differences
+    ranks = ranks - (diff.shape[1] - n)[:, None]
+    r_plus = np.where(sorted_diff > 0, ranks, 0.0).sum(axis=1)
+    r_minus = n * (n + 1) / 2 - r_plus
+    statistic = np.minimum(r_plus, r_minus)
+    # each tie group of size t adds t ** 3 - t, spread over its t members
+    tie_term = np.where(nonzero, ties**2 - 1, 0.0).sum(axis=1)
+    variance = n * (n + 1) * (2 * n + 1) / 24 - tie_term / 48
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(
+            variance > 0, (statistic - n * (n + 1) / 4) / np.sqrt(variance), 0.0
+        )
+    p_value = np.minimum(_erfc(np.abs(z) / math.sqrt(2)).astype(np.float64), 1.0)
+    p_value = np.where(n > 0, p_value, np.nan)
+    return statistic, p_value
+
+
+def pairwise_wilcoxon(run_names: List[str], series: np.ndarray) -> pl.DataFrame:
+    """Wilcoxon test between every pair of runs.
+
+    Args:
+        run_names (List[str]): name of each run.
+        series (np.ndarray): runs x n matrix, e.g. the cumulative rewards as in
+            `data-pipeline/08-Wilcoxon-Test.py`.
+
+    Returns:
+        pl.DataFrame: one row per pair with the statistic and the p-value.
+    """
+    series = _as_matrix(series)
+    left, right = np.triu_indices(series.shape[0], k=1)
+    statistic, p_value = wilcoxon_signed_rank(series[left], series[right])
+    return pl.DataFrame(
+        {
+            "run_1": [run_names[i] for i in left],
+            "run_2": [run_names[i] for i in right],
+            "statistic": statistic,
+            "p_value": p_value,
+        }
+    )
+
+
+def _to_datetime64(dates: Any) -> np.ndarray:
+    if isinstance(dates, np.ndarray) and np.issubdtype(dates.dtype, np.datetime64):
+        return dates.astype("datetime64[D]")
+    return np.array(
+        [np.datetime64(i.date() if isinstance(i, datetime) else i, "D") for i in dates],
+        dtype="datetime64[D]",
+    )
+
+
+def align_actions(
+    action_dates: Any,
+    actions: np.ndarray,
+    price_dates: Any,
+    fill: str = "zero",
+) -> np.ndarray:
+    """Put one action series on the price dates.
+
+    Args:
+        action_dates (Any): dates of the actions.
+        actions (np.ndarray): action of each date.
+        price_dates (Any): sorted dates of the prices.
+        fill (str, optional): "zero" leaves dates without an action flat, "forward"
+            holds the last action until the next one, e.g. for weekly decisions.
+            Defaults to "zero".
+
+    Returns:
+        np.ndarray: action of each price date.
+    """
+    if fill not in {"zero", "forward"}:
+        raise ValueError("fill must be zero or forward")
+    action_dates = _to_datetime64(action_dates)
+    price_dates = _to_datetime64(price_dates)
+    actions = np.asarray(actions, dtype=np.float64)
+    if fill == "zero":
+        ret = np.zeros(len(price_dates), dtype=np.float64)
+        pos = np.searchsorted(price_dates, action_dates)
+        found = pos < len(price_dates)
+        found[found] = price_dates[pos[found]] == action_dates[found]
+        ret[pos[found]] = actions[found]
+        return ret
+    order = np.argsort(action_dates, kind="stable")
+    action_dates, actions = action_dates[order], actions[order]
+    pos = np.searchsorted(action_dates, price_dates, side="right") - 1
+    return np.where(pos >= 0, actions[np.maximum(pos, 0)], 0.0)
+
+
+def build_action_matrix(
+    runs: Dict[str, Tuple[Any, np.ndarray]],
+    price_dates: Any,
+    fill: str = "zero",
+) -> Tuple[List[str], np.ndarray]:
+    run_names = list(runs)
+    matrix = np.zeros((len(run_names), len(price_dates)), dtype=np.float64)
+    for i, name in enumerate(run_names):
+        action_dates, actions = runs[name]
+        matrix[i] = align_actions(action_dates, actions, price_dates, fill)
+    return run_names, matrix
+
+
+def load_actions_csv(
+    path: str, date_col: str = "date", action_col: str = "direction"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Read an action series, by default the `actions_*.csv` of `export_results.py`.
+
+    The `*_finmem.csv` decision files can be read with date_col="test_date" and
+    action_col="decision", the BUY / HOLD / SELL labels are mapped to 1 / 0 / -1.
+    """
+    df = pl.read_csv(path, columns=[date_col, action_col], try_parse_dates=True)
+    df = df.filter(pl.col(action_col).is_not_null())
+    actions = df[action_col]
+    if actions.dtype == pl.Utf8:
+        actions = actions.str.to_uppercase().replace(
+            {"BUY": "1", "HOLD": "0", "SELL": "-1"}
+        )
+    return (
+        _to_datetime64(df[date_col].cast(pl.Utf8).str.slice(0, 10).to_list()),
+        actions.cast(pl.Float64).to_numpy(),
+    )
+
+
+def actions_from_portfolio(portfolio: Any) -> Tuple[np.ndarray, np.ndarray]:
+    mask = portfolio.action_mask
+    return (
+        portfolio.date_array[mask],
+        portfolio.action_array[mask].astype(np.float64),
+    )
+
@@ -0,0 +1,143 @@
+import time
+import logging
+import threading
+from statistics import median
+from collections import Counter
+from typing import Any, Callable, Dict, List, Tuple, Union
+from .deadline import DeadlineExceeded
+
+# [chat] keys that configure the tiered router instead of the request payload
+ROUTER_KEYS = ("tiers", "tier_min_confidence", "tier_escalate_against_momentum")
+
+logger = logging.getLogger(__name__)
+
+
+class TieredRouter:
+    """Cheap model first routing with escalation to stronger models.
+
+    The reflection passes a `validate_output` callback with its request. It turns a raw
+    answer into {"valid", "confidence", "decision", "momentum"}, and the next tier is
+    asked when the answer is not valid, the reported confidence is below
+    `min_confidence`, or a buy / sell decision goes against the momentum. Requests
+    without the callback, like guardrails re-asks, go to the strongest tier. A tier that
+    fails, e.g. on a connection error, passes the request on to the next one; only an
+    error of the last tier is raised. When the step deadline passes during an
+    escalation, the answer of the cheaper tier is kept.
+
+    Args:
+        tiers (List[Tuple[str, Callable]]): (name, endpoint) pairs, cheapest first.
+        min_confidence (Union[float, None], optional): Defaults to None, not checked.
+        escalate_against_momentum (bool, optional): Defaults to True.
+    """
+
+    def __init__(
+        self,
+        tiers: List[Tuple[str, Callable]],
+        min_confidence: Union[float, None] = None,
+        escalate_against_momentum: bool = True,
+    ) -> None:
+        if not tiers:
+            raise ValueError("TieredRouter needs at least one tier")
+        self.tiers = tiers
+        self.min_confidence = min_confidence
+        self.escalate_against_momentum = escalate_against_momentum
+        self.tier_latencies: Dict[str, List[float]] = {name: [] for name, _ in tiers}
+        self.answered = Counter()
+        self.escalations = Counter()
+        self.latencies: List[float] = []
+        self._lock = threading.Lock()
+
+    def escalation_reason(self, info: Dict[str, Any]) -> Union[str, None]:
+        if not info.get("valid"):
+            return "invalid"
+        confidence = info.get("confidence")
+        if (self.min_confidence is not None) and (
+            (confidence is None) or (confidence < self.min_confidence)
+        ):
+            return "low_confidence"
+        momentum = info.get("momentum")
+        if self.escalate_against_momentum and momentum:
+            decision = info.get("decision")
+            if ((decision == "buy") and (momentum < 0)) or (
+                (decision == "sell") and (momentum > 0)
+            ):
+                return "against_momentum"
+        return None
+
+    def _call_tier(self, index: int, input: str, **kwargs: Any) -> str:
+        name, endpoint_func = self.tiers[index]
+        start = time.perf_counter()
+        try:
+            return endpoint_func(input, **kwargs)
+        finally:
+            with self._lock:
+                self.tier_latencies[name].append(time.perf_counter() - start)
+
+    def endpoint(self) -> Callable:
+        def end_point(
+            input: str,
+            validate_output: Union[Callable[[str], Dict[str, Any]], None] = None,
+            **kwargs: Any,
+        ) -> str:
+            start = time.perf_counter()
+            first_tier = 0 if validate_output is not None else len(self.tiers) - 1
+            output = None
+            answered_by = first_tier
+            for index in range(first_tier, len(self.tiers)):
+                try:
+                    output = self._call_tier(index, input, **kwargs)
+                    answered_by = index
+                except DeadlineExceeded as e:
+                    if output is None:
+                        raise e
+                    # out of time to escalate, keep the answer of the cheaper tier
+                    with self._lock:
+                        self.escalations["deadline"] += 1
+                    break
+                except Exception as e:
+                    # an outage of a cheaper model does not stop the run
+                    if index == len(self.tiers) - 1:
+                        raise e
+                    logger.warning(f"Escalating from {self.tiers[index][0]}: {e!r}")
+                    with self._lock:
+                        self.escalations["error"] += 1
+                    continue
+                if (validate_output is None) or (index == len(self.tiers) - 1):
+                    break
+                reason = self.escalation_reason(validate_output(output))
+                if reason is None:
+                    break
+                logger.info(f"Escalating from {self.tiers[index][0]}: {reason}")
+                with self._lock:
+                    self.escalations[reason] += 1
+            with self._lock:
+                self.answered[self.tiers[answered_by][0]] += 1
+                self.latencies.append(time.perf_counter() - start)
+            return output
+
+        return end_point
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "answered": dict(self.answered),
+                "escalations": dict(self.escalations),
+                "median_latency": median(self.latencies) if self.latencies else None,
+                "tier_median_latency": {
+                    name: median(i) if i else None
+                    for name, i in self.tier_latencies.items()
+                },
+            }
+
+    def __str__(self) -> str:
+        stats = self.as_dict()
+        tiers = ", ".join(
+            f"{name}: {stats['answered'].get(name, 0)} answered, "
+            f"median {latency if latency is None else f'{latency:.2f}s'}"
+            for name, latency in stats["tier_median_latency"].items()
+        )
+        median_latency = stats["median_latency"]
+        return (
+            f"{tiers}; escalations {stats['escalations']}; median latency "
+            f"{median_latency if median_latency is None else f'{median_latency:.2f}s'}"
+        )
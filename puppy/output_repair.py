@@ -0,0 +1,123 @@
+import re
+import ast
+import json
+from typing import Any, Dict, List, Tuple, Union
+
+_CODE_FENCE = re.compile(r"```[a-zA-Z]*\s*(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+DECISIONS = ("buy", "sell", "hold")
+
+
+def _outer_json_object(text: str) -> str:
+    # the first "{" to the last "}", drops any text the model wrapped around the json
+    start = text.find("{")
+    end = text.rfind("}")
+    if (start == -1) or (end <= start):
+        return text
+    return text[start : end + 1]
+
+
+def repair_json(text: str) -> Tuple[Union[Dict[str, Any], None], bool]:
+    """Parse a json object out of a raw LLM answer.
+
+    Strips code fences and surrounding text and removes trailing commas, python dict
+    literals (single quotes, True / None) are accepted as well.
+
+    Returns:
+        Tuple[Union[Dict[str, Any], None], bool]: the object, None if it can not be
+            parsed, and whether the text had to be repaired.
+    """
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            return parsed, False
+    except ValueError:
+        pass
+    fenced = _CODE_FENCE.search(text)
+    candidate = _outer_json_object(fenced.group(1) if fenced else text)
+    candidate = _TRAILING_COMMA.sub(r"\1", candidate)
+    try:
+        parsed = json.loads(candidate)
+    except ValueError:
+        try:
+            parsed = ast.literal_eval(candidate)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            return None, True
+    return (parsed, True) if isinstance(parsed, dict) else (None, True)
+
+
+def coerce_id(value: Any) -> Union[int, None]:
+    # 3, 3.0, "3", "3." or "id 3" are all memory 3
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        found = re.fullmatch(r"\D*?(-?\d+)(\.0*)?\D*", value.strip())
+        if found:
+            return int(found.group(1))
+    return None
+
+
+def coerce_memory_index_list(
+    value: Any, valid_ids: List[int], key: str = "memory_index"
+) -> Tuple[Union[List[Dict[str, int]], None], bool]:
+    """Normalize a memory id list to [{"memory_index": id}, ...] with valid ids only.
+
+    Bare ids, a single object instead of a list and numeric strings are accepted, ids
+    that are not in `valid_ids` are dropped.
+
+    Returns:
+        Tuple[Union[List[Dict[str, int]], None], bool]: the list, None if no valid id
+            is left, and whether anything had to be changed.
+    """
+    changed = False
+    if not isinstance(value, list):
+        value = [value]
+        changed = True
+    valid = set(valid_ids)
+    ret = []
+    for item in value:
+        raw = item.get(key) if isinstance(item, dict) else item
+        cur_id = coerce_id(raw)
+        if (cur_id is None) or (cur_id not in valid):
+            changed = True
+            continue
+        if (not isinstance(item, dict)) or (raw != cur_id) or (len(item) != 1):
+            changed = True
+        ret.append({key: cur_id})
+    return (ret or None), changed
+
+
+def coerce_decision(value: Any) -> Tuple[Union[str, None], bool]:
+    """Map near misses like "Buy.", "BUY" or "hold the stock" to buy / sell / hold."""
+    if not isinstance(value, str):
+        return None, True
+    if value in DECISIONS:
+        return value, False
+    words = set(re.findall(r"[a-z]+", value.lower()))
+    found = [i for i in DECISIONS if i in words]
+    if len(found) == 1:
+        return found[0], True
+    return None, True
+
+
+def coerce_confidence(value: Any) -> Union[float, None]:
+    # 0.8, "0.8", "80%" or 80 are all 0.8, 5 on a 1 to 10 scale is read as 1.0
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        found = re.search(r"-?\d+(\.\d+)?", value)
+        if not found:
+            return None
+        value = float(found.group(0)) / (100 if "%" in value else 1)
+    if not isinstance(value, (int, float)):
+        return None
+    value = float(value)
+    # only a number above 10 is a percentage, smaller ones overshoot a 0 to 1 or a
+    # 1 to 10 scale and must not become a few percent that escalates the answer
+    if 10 < value <= 100:
+        value /= 100
+    return min(max(value, 0.0), 1.0)
@@ -2,7 +2,7 @@ import polars as pl
 import numpy as np
 from datetime import date
 from annotated_types import Gt
-from typing import Dict, Annotated, Union
+from typing import Dict, Annotated, Union, List, Any, Iterable
 from pydantic import BaseModel
 
 
@@ -10,101 +10,291 @@ class PriceStructure(BaseModel):
     price: Annotated[float, Gt(0)]
 
 
+class GrowableArray:
+    # numpy buffer with capacity doubling, append is amortized O(1)
+    def __init__(self, dtype: Any, initial_capacity: int = 64) -> None:
+        self.dtype = np.dtype(dtype)
+        self._data = np.zeros(max(initial_capacity, 1), dtype=self.dtype)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, value: Any) -> None:
+        if self._size == len(self._data):
+            new_data = np.zeros(len(self._data) * 2, dtype=self.dtype)
+            new_data[: self._size] = self._data[: self._size]
+            self._data = new_data
+        self._data[self._size] = value
+        self._size += 1
+
+    def set_last(self, value: Any) -> None:
+        if self._size == 0:
+            raise IndexError("set_last on empty GrowableArray")
+        self._data[self._size - 1] = value
+
+    @property
+    def view(self) -> np.ndarray:
+        # read-only view of the filled part, no copy
+        ret = self._data[: self._size]
+        ret.flags.writeable = False
+        return ret
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, dtype: Any) -> "GrowableArray":
+        obj = cls(dtype=dtype, initial_capacity=len(array))
+        obj._data[: len(array)] = array
+        obj._size = len(array)
+        return obj
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # only pickle the filled part so checkpoints stay compact
+        return {"dtype": self.dtype, "data": self._data[: self._size].copy()}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.dtype = state["dtype"]
+        self._size = len(state["data"])
+        self._data = np.zeros(max(self._size, 1), dtype=self.dtype)
+        self._data[: self._size] = state["data"]
+
+
+class RollingWindowSum:
+    # trailing sums of several window lengths over one circular buffer
+    def __init__(self, windows: Iterable[int]) -> None:
+        self.windows = sorted(set(windows))
+        if (not self.windows) or (self.windows[0] < 1):
+            raise ValueError("windows must be positive integers")
+        self.capacity = self.windows[-1]
+        self._buffer = np.zeros(self.capacity, dtype=np.float64)
+        self._count = 0
+        self._sums = {w: 0.0 for w in self.windows}
+        self._abs_sums = {w: 0.0 for w in self.windows}
+        self._nonzero = {w: 0 for w in self.windows}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, value: float) -> None:
+        # O(number of windows), independent of the history length
+        for w in self.windows:
+            if self._count >= w:
+                old_value = self._buffer[(self._count - w) % self.capacity]
+                self._sums[w] -= old_value
+                self._abs_sums[w] -= abs(old_value)
+                self._nonzero[w] -= old_value != 0
+            self._sums[w] += value
+            self._abs_sums[w] += abs(value)
+            self._nonzero[w] += value != 0
+        self._buffer[self._count % self.capacity] = value
+        self._count += 1
+        # bound the drift of the running sums, amortized O(1)
+        if self._count % self.capacity == 0:
+            for w in self.windows:
+                self._sums[w] = self.exact_sum(w)
+                self._abs_sums[w] = float(np.abs(self._last(w)).sum())
+
+    def _last(self, window: int) -> np.ndarray:
+        n = min(window, self._count)
+        return self._buffer[np.arange(self._count - n, self._count) % self.capacity]
+
+    def exact_sum(self, window: int) -> float:
+        # summed in time order, same as np.cumsum over the window
+        values = self._last(window)
+        return float(np.cumsum(values)[-1]) if len(values) else 0.0
+
+    def sum(self, window: int) -> float:
+        if self._nonzero[window] == 0:
+            return 0.0
+        return self._sums[window]
+
+    def sign(self, window: int) -> int:
+        if self._nonzero[window] == 0:
+            return 0
+        cur_sum = self._sums[window]
+        # near zero the running sum could flip sign, fall back to the exact sum
+        if abs(cur_sum) <= 1e-12 * self._abs_sums[window]:
+            cur_sum = self.exact_sum(window)
+        return int(np.sign(cur_sum))
+
+
 class Portfolio:
-    def __init__(self, symbol: str, lookback_window_size: int = 7) -> None:
+    def __init__(
+        self,
+        symbol: str,
+        lookback_window_size: int = 7,
+        feedback_windows: Iterable[int] = (),
+        momentum_windows: Iterable[int] = (3,),
+    ) -> None:
         self.cur_date = None
         self.symbol = symbol
-        self.action_series = {}
         self.market_price = None
         self.day_count = 0
-        self.date_series = []
         self.holding_shares = 0
-        self.market_price_series = np.array([])
-        self.portfolio_share_series = np.array([])
         self.lookback_window_size = lookback_window_size
+        # one slot per market day
+        self._date_buffer = GrowableArray("datetime64[D]")
+        self._price_buffer = GrowableArray(np.float64)
+        self._action_buffer = GrowableArray(np.int8)
+        self._action_mask_buffer = GrowableArray(np.bool_)
+        # one slot per portfolio update
+        self._share_buffer = GrowableArray(np.float64)
+        # trailing realized pnl and price change sums
+        self._pnl_window = RollingWindowSum([lookback_window_size, *feedback_windows])
+        self._return_window = RollingWindowSum(momentum_windows)
+        self._pnl_count = 0
+
+    # array views for metrics
+    @property
+    def date_array(self) -> np.ndarray:
+        return self._date_buffer.view
+
+    @property
+    def market_price_series(self) -> np.ndarray:
+        return self._price_buffer.view
+
+    @property
+    def portfolio_share_series(self) -> np.ndarray:
+        return self._share_buffer.view
+
+    @property
+    def action_array(self) -> np.ndarray:
+        return self._action_buffer.view
+
+    @property
+    def action_mask(self) -> np.ndarray:
+        return self._action_mask_buffer.view
+
+    # legacy containers, built on demand
+    @property
+    def date_series(self) -> List[date]:
+        return self.date_array.astype(object).tolist()
+
+    @property
+    def action_series(self) -> Dict[date, int]:
+        return {
+            cur_date: int(cur_action)
+            for cur_date, cur_action in zip(
+                self.date_array[self.action_mask].astype(object).tolist(),
+                self.action_array[self.action_mask],
+            )
+        }
+
+    def _date_at(self, index: int) -> date:
+        return self.date_array[index].astype(object)
 
     def update_market_info(self, new_market_price_info: float, cur_date: date) -> None:
         PriceStructure.model_validate({"price": new_market_price_info})
         self.market_price = new_market_price_info
         self.cur_date = cur_date
-        self.date_series.append(cur_date)
         self.day_count += 1
-        self.market_price_series = np.append(
-            self.market_price_series, new_market_price_info
-        )
+        self._date_buffer.append(np.datetime64(cur_date, "D"))
+        self._price_buffer.append(new_market_price_info)
+        self._action_buffer.append(0)
+        self._action_mask_buffer.append(False)
+        if self.day_count > 1:
+            self._return_window.push(
+                self._price_buffer.view[-1] - self._price_buffer.view[-2]
+            )
+        self._push_realized_pnl()
 
     def record_action(self, action: Dict[str, int]) -> None:
+        if self.day_count == 0:
+            raise ValueError("update_market_info must be called before record_action")
         self.holding_shares += action["direction"]
-        self.action_series[self.cur_date] = action["direction"]
+        self._action_buffer.set_last(action["direction"])
+        self._action_mask_buffer.set_last(True)
 
     def get_action_df(self) -> pl.DataFrame:
-        temp_dict = {"date": [], "symbol": [], "direction": []}
-        for date in self.action_series:
-            temp_dict["date"].append(date)
-            temp_dict["symbol"].append(self.symbol)
-            temp_dict["direction"].append(self.action_series[date])
-        return pl.DataFrame(temp_dict)
+        mask = self.action_mask
+        return pl.DataFrame(
+            {
+                "date": self.date_array[mask].astype(object).tolist(),
+                "symbol": [self.symbol] * int(mask.sum()),
+                "direction": self.action_array[mask].astype(np.int64),
+            }
+        )
 
     def update_portfolio_series(self) -> None:
-        self.portfolio_share_series = np.append(
-            self.portfolio_share_series, self.holding_shares
-        )
+        self._share_buffer.append(self.holding_shares)
+        self._push_realized_pnl()
+
+    def _push_realized_pnl(self) -> None:
+        # pnl of day i is the holding after day i times the move to day i + 1,
+        # counted once the holding of day i + 1 is known as well
+        prices = self._price_buffer.view
+        shares = self._share_buffer.view
+        while self._pnl_count < min(len(prices) - 1, len(shares) - 1):
+            i = self._pnl_count
+            self._pnl_window.push((prices[i + 1] - prices[i]) * shares[i])
+            self._pnl_count += 1
+
+    def rolling_pnl(self, window: Union[int, None] = None) -> float:
+        return self._pnl_window.sum(window or self.lookback_window_size)
 
-    def get_feedback_response(self) -> Union[Dict[str, Union[int, date]], None]:
-        if self.day_count <= self.lookback_window_size:
+    def rolling_return(self, window: int = 3) -> float:
+        return self._return_window.sum(window)
+
+    def get_feedback_response(
+        self, window: Union[int, None] = None
+    ) -> Union[Dict[str, Union[int, date]], None]:
+        window = window or self.lookback_window_size
+        if self.day_count <= window:
             return None
-        if len(np.diff(self.market_price_series)) != len(
-            self.portfolio_share_series[:-1]
-        ):
-            temp = np.cumsum(
-                (
-                    np.diff(self.market_price_series)[:-1]
-                    * self.portfolio_share_series[:-1]
-                )[-self.lookback_window_size :]
-            )[-1]
-        else:
-            temp = np.cumsum(
-                (np.diff(self.market_price_series) * self.portfolio_share_series[:-1])[
-                    -self.lookback_window_size :
-                ]
-            )[-1]
-
-        if temp > 0:
-            return {
-                "feedback": 1,
-                "date": self.date_series[-self.lookback_window_size],
-            }
-        elif temp < 0:
-            return {
-                "feedback": -1,
-                "date": self.date_series[-self.lookback_window_size],
-            }
+        if window in self._pnl_window.windows:
+            feedback = self._pnl_window.sign(window)
         else:
-            return {
-                "feedback": 0,
-                "date": self.date_series[-self.lookback_window_size],
-            }
+            # window not tracked, compute it from the history
+            pnl = (
+                np.diff(self.market_price_series[: self._pnl_count + 1])
+                * self.portfolio_share_series[: self._pnl_count]
+            )[-window:]
+            feedback = int(np.sign(np.cumsum(pnl)[-1])) if len(pnl) else 0
+        return {"feedback": feedback, "date": self._date_at(-window)}
 
     def get_moment(self, moment_window: int = 3) -> Union[Dict[str, int], None]:
         if self.day_count <= moment_window:
             return None
-
-        temp = np.cumsum((np.diff(self.market_price_series))[-moment_window:])[-1]
-
-        if temp > 0:
-            return {
-                "moment": 1,
-                "date": self.date_series[-moment_window],
-            }
-
-        elif temp < 0:
-            return {
-                "moment": -1,
-                "date": self.date_series[-moment_window],
-            }
-
+        if moment_window in self._return_window.windows:
+            moment = self._return_window.sign(moment_window)
         else:
-            return {
-                "moment": 0,
-                "date": self.date_series[-moment_window],
-            }
+            moment = int(
+                np.sign(
+                    np.cumsum(np.diff(self.market_price_series)[-moment_window:])[-1]
+                )
+            )
+        return {"moment": moment, "date": self._date_at(-moment_window)}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        if "_price_buffer" in state:
+            self.__dict__.update(state)
+            return
+        # checkpoints written before the buffers were introduced
+        dates = state.pop("date_series")
+        action_series = state.pop("action_series")
+        market_price_series = state.pop("market_price_series")
+        portfolio_share_series = state.pop("portfolio_share_series")
+        self.__dict__.update(state)
+        date_array = np.array(
+            [np.datetime64(i, "D") for i in dates], dtype="datetime64[D]"
+        )
+        self._date_buffer = GrowableArray.from_array(date_array, "datetime64[D]")
+        self._price_buffer = GrowableArray.from_array(
+            np.asarray(market_price_series, dtype=np.float64), np.float64
+        )
+        self._share_buffer = GrowableArray.from_array(
+            np.asarray(portfolio_share_series, dtype=np.float64), np.float64
+        )
+        self._action_buffer = GrowableArray.from_array(
+            np.array([action_series.get(i, 0) for i in dates], dtype=np.int8),
+            np.int8,
+        )
+        self._action_mask_buffer = GrowableArray.from_array(
+            np.array([i in action_series for i in dates], dtype=np.bool_), np.bool_
+        )
+        # replay the history into the rolling windows
+        self._pnl_window = RollingWindowSum([self.lookback_window_size])
+        self._return_window = RollingWindowSum([3])
+        self._pnl_count = 0
+        for cur_change in np.diff(self.market_price_series):
+            self._return_window.push(cur_change)
+        self._push_realized_pnl()
@@ -0,0 +1,242 @@
+import os
+import fcntl
+import logging
+import tempfile
+import contextlib
+import numpy as np
+import polars as pl
+from datetime import date, datetime
+from typing import Dict, Iterator, Tuple, Union, Any
+
+DateLike = Union[str, date, datetime, np.datetime64]
+
+
+def _to_datetime64(value: Any) -> Union[np.datetime64, np.ndarray]:
+    if isinstance(value, (str, date, datetime, np.datetime64)):
+        if isinstance(value, str):
+            value = value[:10]
+        elif isinstance(value, datetime):
+            value = value.date()
+        return np.datetime64(value, "D")
+    # pandas series, lists of dates or timestamps
+    return np.asarray(value, dtype="datetime64[D]")
+
+
+class PriceStore:
+    """Daily close prices of many tickers on top of `price_data.parquet`.
+
+    Reads are served from per-ticker sorted arrays. A range that is not covered by the
+    file is downloaded from Yahoo Finance once and merged into the file under a lock,
+    so jobs that add different tickers at the same time keep each other's data.
+
+    Args:
+        path (str, optional): parquet path. Defaults to "data/03_primary/price_data.parquet".
+        download (bool, optional): download missing ranges. Defaults to True.
+        tolerance_days (int, optional): longest gap between stored dates inside a
+            range that still counts as covered, so weekends and holidays do not
+            trigger a download. The ends of the stored range only get a weekend.
+            Defaults to 7.
+    """
+
+    def __init__(
+        self,
+        path: str = os.path.join("data", "03_primary", "price_data.parquet"),
+        download: bool = True,
+        tolerance_days: int = 7,
+    ) -> None:
+        self.path = path
+        self.download = download
+        self.tolerance = np.timedelta64(tolerance_days, "D")
+        self.logger = logging.getLogger(__name__)
+        self._series: Union[Dict[str, Tuple[np.ndarray, np.ndarray]], None] = None
+        self._date_dtype = pl.Utf8
+        # ranges already tried, a range yahoo has no data for is only asked once
+        self._fetched = set()
+        # range of the last download per ticker, yahoo has no more days inside it
+        self._refreshed: Dict[str, Tuple[np.datetime64, np.datetime64]] = {}
+
+    @classmethod
+    def default(cls, **kwargs: Any) -> "PriceStore":
+        """The store in the data folder of the repo, wherever the script is run from."""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return cls(
+            os.path.join(root, "data", "03_primary", "price_data.parquet"), **kwargs
+        )
+
+    def _load(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        if self._series is not None:
+            return self._series
+        self._series = {}
+        if not os.path.exists(self.path):
+            return self._series
+        price_df = pl.read_parquet(self.path, columns=["est_time", "equity", "close"])
+        self._date_dtype = price_df.schema["est_time"]
+        price_df = price_df.with_columns(
+            pl.col("est_time").cast(pl.Utf8).str.slice(0, 10).str.to_date()
+        ).sort(["equity", "est_time"])
+        for (equity,), group in price_df.group_by(["equity"], maintain_order=True):
+            self._series[equity] = (
+                group["est_time"].to_numpy().astype("datetime64[D]"),
+                group["close"].to_numpy().astype(np.float64),
+            )
+        return self._series
+
+    def _resolve(self, ticker: str) -> str:
+        # result folders use 0700_HK for the 0700.HK ticker
+        series = self._load()
+        if (ticker not in series) and (ticker.replace("_", ".") in series):
+            return ticker.replace("_", ".")
+        return ticker
+
+    @property
+    def tickers(self) -> list:
+        return sorted(self._load())
+
+    def covers(self, ticker: str, start: DateLike, end: DateLike) -> bool:
+        ticker = self._resolve(ticker)
+        series = self._load().get(ticker)
+        if series is None or len(series[0]) == 0:
+            return False
+        dates = series[0]
+        start = _to_datetime64(start)
+        end = _to_datetime64(end)
+        # [start, end) may only reach past the stored dates by a weekend, or as far as
+        # the last download went
+        first = np.busday_offset(dates[0], -1, roll="backward") + np.timedelta64(1, "D")
+        last = np.busday_offset(dates[-1], 1, roll="forward")
+        if ticker in self._refreshed:
+            first = min(first, self._refreshed[ticker][0])
+            last = max(last, self._refreshed[ticker][1])
+        if (start < first) or (end > last):
+            return False
+        # two downloads that are not adjacent leave a gap in the middle, check the
+        # stored dates in the range and the ones right before and after it
+        left = max(np.searchsorted(dates, start, side="left") - 1, 0)
+        right = np.searchsorted(dates, end, side="left") + 1
+        return bool(np.all(np.diff(dates[left:right]) <= self.tolerance))
+
+    def get_prices(
+        self, ticker: str, start: DateLike, end: DateLike
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Dates and close prices of one ticker in [start, end), like `yf.download`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: datetime64[D] dates and float64 prices.
+        """
+        ticker = self._resolve(ticker)
+        if not self.covers(ticker, start, end):
+            self._fetch(ticker, start, end)
+        dates, prices = self._load().get(
+            ticker, (np.array([], dtype="datetime64[D]"), np.array([]))
+        )
+        left = np.searchsorted(dates, _to_datetime64(start), side="left")
+        right = np.searchsorted(dates, _to_datetime64(end), side="left")
+        return dates[left:right], prices[left:right]
+
+    def get_price_df(self, ticker: str, start: DateLike, end: DateLike) -> pl.DataFrame:
+        dates, prices = self.get_prices(ticker, start, end)
+        return pl.DataFrame({"date": dates, "close": prices})
+
+    def trading_days(self, ticker: str, start: DateLike, end: DateLike) -> np.ndarray:
+        return self.get_prices(ticker, start, end)[0]
+
+    def next_trading_day(
+        self, ticker: str, days: Any, start: DateLike, end: DateLike
+    ) -> np.ndarray:
+        """Shift every day to the first trading day on or after it.
+
+        Days after the last trading day in [start, end) become NaT.
+        """
+        trading_days = self.trading_days(ticker, start, end)
+        days = _to_datetime64(days)
+        pos = np.searchsorted(trading_days, days, side="left")
+        ret = np.full(days.shape, np.datetime64("NaT"), dtype="datetime64[D]")
+        found = pos < len(trading_days)
+        ret[found] = trading_days[pos[found]]
+        return ret
+
+    def _fetch(self, ticker: str, start: DateLike, end: DateLike) -> None:
+        if not self.download:
+            self.logger.warning(
+                f"Price data of {ticker} does not cover {start} to {end}"
+            )
+            return
+        if (ticker, str(start), str(end)) in self._fetched:
+            return
+        self._fetched.add((ticker, str(start), str(end)))
+        import yfinance as yf
+
+        self.logger.info(f"Downloading price data of {ticker} from {start} to {end}")
+        start_date = _to_datetime64(start)
+        end_date = _to_datetime64(end)
+        series = self._load()
+        # extend the stored range instead of leaving a gap next to it
+        if ticker in series and len(series[ticker][0]):
+            start_date = min(start_date, series[ticker][0][0])
+            end_date = max(end_date, series[ticker][0][-1] + np.timedelta64(1, "D"))
+        history = (
+            yf.Ticker(ticker)
+            .history(start=str(start_date), end=str(end_date))
+            .reset_index()
+        )
+        if history.shape[0] == 0 or "Close" not in history.columns:
+            self.logger.warning(f"No price data downloaded for {ticker}")
+            return
+        history = history.dropna(subset=["Date", "Close"])
+        new_dates = np.array([i.date() for i in history["Date"]], dtype="datetime64[D]")
+        new_prices = history["Close"].to_numpy(dtype=np.float64)
+        with self._file_lock():
+            # other jobs may have written the file since it was loaded, merge into
+            # their version instead of overwriting it
+            self._series = None
+            series = self._load()
+            if ticker in series:
+                old_dates, old_prices = series[ticker]
+                keep = ~np.isin(old_dates, new_dates)
+                new_dates = np.concatenate([old_dates[keep], new_dates])
+                new_prices = np.concatenate([old_prices[keep], new_prices])
+            order = np.argsort(new_dates, kind="stable")
+            series[ticker] = (new_dates[order], new_prices[order])
+            self._refreshed[ticker] = (start_date, end_date)
+            self._save()
+
+    @contextlib.contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _save(self) -> None:
+        series = self._load()
+        price_df = pl.DataFrame(
+            {
+                "est_time": np.concatenate([series[i][0] for i in series]),
+                "equity": np.concatenate(
+                    [np.repeat(i, len(series[i][0])) for i in series]
+                ),
+                "close": np.concatenate([series[i][1] for i in series]),
+            }
+        )
+        # keep the date column type of the existing file
+        if self._date_dtype == pl.Utf8:
+            price_df = price_df.with_columns(pl.col("est_time").dt.strftime("%Y-%m-%d"))
+        else:
+            price_df = price_df.with_columns(pl.col("est_time").cast(pl.Datetime))
+        # readers without the lock only ever see a complete file
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(self.path) or ".",
+            prefix=".price_data-",
+            suffix=".parquet",
+            delete=False,
+        ) as f:
+            tmp_path = f.name
+        try:
+            price_df.write_parquet(tmp_path)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,116 @@
+import heapq
+from typing import Callable, Dict, List, Tuple, Union
+
+# [chat] keys of the cross layer prompt budget
+PROMPT_BUDGET_KEYS = ("prompt_token_budget", "prompt_layer_min_tokens")
+LAYERS = ("short", "mid", "long", "reflection")
+
+# (memory id, text, score, token count) of a retrieved memory
+Candidate = Tuple[int, str, float, int]
+
+
+class PromptBudget:
+    """One token budget for the memories of all layers.
+
+    Every layer first gets its retrieved memories, best first, as long as they fit in
+    its minimum. The rest of the budget goes to the remaining memories of all layers by
+    score; the first memory that does not fit is truncated to fill the budget and the
+    allocation stops there. Reserved tokens a layer does not use go back to the pool.
+
+    Args:
+        total_tokens (int): tokens for the memories of all layers.
+        layer_min_tokens (Union[int, Dict[str, int], None], optional): tokens reserved
+            for each layer, one number for all layers or a table by layer. Defaults to
+            None, nothing reserved.
+    """
+
+    def __init__(
+        self,
+        total_tokens: int,
+        layer_min_tokens: Union[int, Dict[str, int], None] = None,
+    ) -> None:
+        if isinstance(layer_min_tokens, dict):
+            unknown = set(layer_min_tokens) - set(LAYERS)
+            if unknown:
+                raise ValueError(f"unknown memory layers: {', '.join(sorted(unknown))}")
+            layer_min_tokens = {i: layer_min_tokens.get(i, 0) for i in LAYERS}
+        else:
+            layer_min_tokens = {i: layer_min_tokens or 0 for i in LAYERS}
+        if sum(layer_min_tokens.values()) > total_tokens:
+            raise ValueError("the layer minimums add up to more than the total budget")
+        self.total_tokens = total_tokens
+        self.layer_min_tokens = layer_min_tokens
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Union["PromptBudget", None]:
+        if config.get("prompt_token_budget") is None:
+            return None
+        return cls(
+            total_tokens=config["prompt_token_budget"],
+            layer_min_tokens=config.get("prompt_layer_min_tokens"),
+        )
+
+    def allocate(
+        self,
+        candidates: Dict[str, List[Candidate]],
+        truncate: Callable[[str, int], Tuple[str, int]],
+    ) -> Tuple[Dict[str, List[Tuple[int, str]]], Dict[str, int]]:
+        """Pick the memories for the prompt.
+
+        Args:
+            candidates (Dict[str, List[Candidate]]): retrieved memories by layer.
+            truncate (Callable[[str, int], Tuple[str, int]]): cuts a text to at most
+                n tokens, returns the text and its token count.
+
+        Returns:
+            Tuple[Dict[str, List[Tuple[int, str]]], Dict[str, int]]: (id, text) of the
+                picked memories by layer, in retrieval order, and the tokens by layer.
+        """
+        ranked = {
+            layer: sorted(candidates.get(layer, []), key=lambda x: -x[2])
+            for layer in LAYERS
+        }
+        picked: Dict[str, Dict[int, str]] = {layer: {} for layer in LAYERS}
+        used = {layer: 0 for layer in LAYERS}
+        # minimums: best memories of each layer that fit in its reserve
+        next_index = {}
+        for layer in LAYERS:
+            i = 0
+            for memory_id, text, _, tokens in ranked[layer]:
+                if used[layer] + tokens > self.layer_min_tokens[layer]:
+                    break
+                picked[layer][memory_id] = text
+                used[layer] += tokens
+                i += 1
+            next_index[layer] = i
+        # the rest by score across layers, merging the ranked lists keeps it linear
+        remaining = self.total_tokens - sum(used.values())
+        for _, layer, memory_id, text, tokens in heapq.merge(
+            *(
+                [
+                    (-i[2], layer, i[0], i[1], i[3])
+                    for i in ranked[layer][next_index[layer] :]
+                ]
+                for layer in LAYERS
+            ),
+            key=lambda x: x[0],
+        ):
+            if tokens <= remaining:
+                picked[layer][memory_id] = text
+                used[layer] += tokens
+                remaining -= tokens
+                continue
+            if remaining > 0:
+                picked[layer][memory_id], tokens = truncate(text, remaining)
+                used[layer] += tokens
+            break
+        # retrieval order, as without a budget
+        ret = {
+            layer: [
+                (i[0], picked[layer][i[0]])
+                for i in candidates.get(layer, [])
+                if i[0] in picked[layer]
+            ]
+            for layer in LAYERS
+        }
+        return ret, used
@@ -27,6 +27,13 @@ test_momentum_explanation = """The information below provides a summary of stock
         Momentum is based on the idea that securities that have performed well in the past will continue to perform well, and conversely, securities that have performed poorly will continue to perform poorly.
         """
 
+# static prefix layout, the per-day information goes last
+static_prefix_memory_id_instruction = "Each memory_index must be one of the ids listed in the matching information section below."
+static_prefix_investment_info_header = "Here is the information:\n"
+
+# tiered model routing
+router_confidence_instruction = 'Also add a "confidence" field to the JSON object, a number between 0 and 1 for how sure you are about your answer.'
+
 # prompts
 train_prompt = """Given the following information, can you explain to me why the financial market fluctuation from current day to the next day behaves like this? Just summarize the reason of the decision。
     Your should provide a summary information and the id of the information to support your summary.
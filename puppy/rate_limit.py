@@ -0,0 +1,165 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Union
+
+# [chat] keys that configure rate limiting instead of the request payload
+RATE_LIMIT_KEYS = (
+    "max_concurrency",
+    "requests_per_minute",
+    "tokens_per_minute",
+    "max_retries",
+    "backoff_base",
+    "max_backoff",
+)
+
+
+class TokenBucket:
+    """Token bucket that never grants more than `limit_per_minute` in any minute.
+
+    The bucket holds at most `burst` units, no more than half the limit, and refills at
+    (limit - burst) per minute. Every request is charged in full and may leave the
+    bucket in debt; it goes through once the debt is paid off, so any 60 second window
+    sees at most burst + (limit - burst) = limit units.
+    """
+
+    def __init__(
+        self, limit_per_minute: float, burst: Union[float, None] = None
+    ) -> None:
+        if limit_per_minute <= 0:
+            raise ValueError("limit_per_minute must be positive")
+        burst = burst if burst is not None else max(1.0, limit_per_minute / 10)
+        self.capacity = min(burst, limit_per_minute / 2)
+        self.rate = (limit_per_minute - self.capacity) / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        # the lock keeps waiters in order, a large request is not starved by small ones
+        async with self._lock:
+            self._refill()
+            self.tokens -= amount
+            # asyncio may wake a little early, a rounding error is no debt
+            while self.tokens < -1e-9:
+                await asyncio.sleep(-self.tokens / self.rate)
+                self._refill()
+
+    def adjust(self, amount: float) -> None:
+        # correct an estimate once the real usage is known, may leave a debt
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ProviderLimiter:
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: Union[float, None] = None,
+        tokens_per_minute: Union[float, None] = None,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        # set on a 429, every request to the provider waits until then
+        self.blocked_until = 0.0
+
+    async def acquire(self, estimated_tokens: float) -> None:
+        wait = self.blocked_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket is not None:
+            await self.token_bucket.acquire(estimated_tokens)
+
+    def record_usage(
+        self, estimated_tokens: float, used_tokens: Union[int, None]
+    ) -> None:
+        if (self.token_bucket is not None) and (used_tokens is not None):
+            self.token_bucket.adjust(used_tokens - estimated_tokens)
+
+    def backoff(self, attempt: int, retry_after: Union[float, None] = None) -> float:
+        if retry_after is not None:
+            delay = min(retry_after, self.max_backoff)
+        else:
+            # full jitter
+            delay = random.uniform(
+                0, min(self.max_backoff, self.backoff_base * (2**attempt))
+            )
+        return delay
+
+    def block(self, delay: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+
+def parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# limiters are bound to the event loop they were created on
+_limiters = weakref.WeakKeyDictionary()
+_limiters_lock = threading.Lock()
+
+
+def get_provider_limiter(provider: str, **limit_config: Any) -> ProviderLimiter:
+    """Limiter shared by every caller of `provider` on the running event loop.
+
+    The first caller's settings win, the quota belongs to the provider not to an agent.
+    """
+    loop = asyncio.get_running_loop()
+    with _limiters_lock:
+        loop_limiters = _limiters.setdefault(loop, {})
+        if provider not in loop_limiters:
+            loop_limiters[provider] = ProviderLimiter(**limit_config)
+        return loop_limiters[provider]
+
+
+# one background loop per process, sync callers on any thread share its limiters
+_loop: Union[asyncio.AbstractEventLoop, None] = None
+_loop_pid: Union[int, None] = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_pid
+    with _loop_lock:
+        if (_loop is None) or (_loop_pid != os.getpid()) or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(
+                target=_loop.run_forever, name="puppy-llm-loop", daemon=True
+            ).start()
+        return _loop
+
+
+def run_sync(coro: Awaitable[Any]) -> Any:
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()  # type: ignore
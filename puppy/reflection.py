@@ -1,14 +1,25 @@
 # sourcery skip: dont-import-test-modules
 from rich import print
+import json
+import time
 import logging
+import threading
 import guardrails as gd
 from datetime import date
 from .run_type import RunMode
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from httpx import HTTPStatusError
 from guardrails.validators import ValidChoices
-from typing import List, Callable, Dict, Union, Any, Tuple
+from typing import List, Callable, Dict, Union, Any, Tuple, get_args
 from .chat import LongerThanContextError
+from .deadline import DeadlineExceeded, remaining_time, fallback_decision
+from .output_repair import (
+    DECISIONS,
+    repair_json,
+    coerce_decision,
+    coerce_memory_index_list,
+    coerce_confidence,
+)
 from .prompts import (
     short_memory_id_desc,
     mid_memory_id_desc,
@@ -25,6 +36,9 @@ from .prompts import (
     test_investment_info_prefix,
     test_sentiment_explanation,
     test_momentum_explanation,
+    static_prefix_memory_id_instruction,
+    static_prefix_investment_info_header,
+    router_confidence_instruction,
 )
 
 
@@ -245,7 +259,7 @@ def _add_momentum_info(momentum: int, investment_info: str) -> str:
     return investment_info
 
 
-def _train_response_model_invest_info(
+def _train_invest_info(
     cur_date: date,
     symbol: str,
     future_record: Dict[str, float | str],
@@ -258,13 +272,6 @@ def _train_response_model_invest_info(
     reflection_memory: List[str],
     reflection_memory_id: List[int],
 ):
-    # pydantic reflection model
-    response_model = _train_reflection_factory(
-        short_id_list=short_memory_id,
-        mid_id_list=mid_memory_id,
-        long_id_list=long_memory_id,
-        reflection_id_list=reflection_memory_id,
-    )
     # investment info + memories
     investment_info = train_investment_info_prefix.format(
         cur_date=cur_date, symbol=symbol, future_record=future_record
@@ -297,10 +304,10 @@ def _train_response_model_invest_info(
         )
         investment_info += "\n\n"
 
-    return response_model, investment_info
+    return investment_info
 
 
-def _test_response_model_invest_info(
+def _test_invest_info(
     cur_date: date,
     symbol: str,
     short_memory: List[str],
@@ -312,14 +319,8 @@ def _test_response_model_invest_info(
     reflection_memory: List[str],
     reflection_memory_id: List[int],
     momentum: Union[int, None] = None,
+    explanations: bool = True,
 ):
-    # pydantic reflection model
-    response_model = _test_reflection_factory(
-        short_id_list=short_memory_id,
-        mid_id_list=mid_memory_id,
-        long_id_list=long_memory_id,
-        reflection_id_list=reflection_memory_id,
-    )
     # investment info + memories
     investment_info = test_investment_info_prefix.format(
         symbol=symbol, cur_date=cur_date
@@ -329,7 +330,8 @@ def _test_response_model_invest_info(
         investment_info += "\n".join(
             [f"{i[0]}. {i[1].strip()}" for i in zip(short_memory_id, short_memory)]
         )
-        investment_info += test_sentiment_explanation
+        if explanations:
+            investment_info += test_sentiment_explanation
         investment_info += "\n\n"
     if mid_memory:
         investment_info += "The mid-term information:\n"
@@ -353,15 +355,285 @@ def _test_response_model_invest_info(
         )
         investment_info += "\n\n"
     if momentum:
-        investment_info += test_momentum_explanation
+        if explanations:
+            investment_info += test_momentum_explanation
         investment_info = _add_momentum_info(momentum, investment_info)
 
-    return response_model, investment_info
+    return investment_info
+
+
+class ReflectionStats:
+    """How the reflection answers were validated.
+
+    first_pass: valid as returned by the model.
+    repaired: valid after the local repair, no extra LLM call.
+    guardrails: handed to guardrails, which may re-ask the model.
+    failed: no valid answer, the fallback output was used.
+    deadline: the step time budget ran out, the deadline fallback policy was used.
+    reasks: extra LLM calls made by the guardrails re-asks.
+    skipped_reasks: re-asks left out because the step time budget would not cover them.
+    """
+
+    OUTCOMES = ("first_pass", "repaired", "guardrails", "failed", "deadline")
+    # class level default for stats of older checkpoints
+    skipped_reasks = 0
+
+    def __init__(self) -> None:
+        self.counts = {i: 0 for i in self.OUTCOMES}
+        self.reasks = 0
+        self.skipped_reasks = 0
+
+    @property
+    def calls(self) -> int:
+        return sum(self.counts.values())
+
+    def record(self, outcome: str, reasks: int = 0) -> None:
+        # .get, stats of older checkpoints do not count every outcome
+        self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        self.reasks += reasks
+
+    @property
+    def repair_rate(self) -> float:
+        return self.counts["repaired"] / self.calls if self.calls else 0.0
+
+    @property
+    def reask_rate(self) -> float:
+        return self.reasks / self.calls if self.calls else 0.0
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        return {
+            "calls": self.calls,
+            **self.counts,
+            "reasks": self.reasks,
+            "skipped_reasks": self.skipped_reasks,
+            "repair_rate": self.repair_rate,
+            "reask_rate": self.reask_rate,
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.calls} reflections, {self.counts['first_pass']} valid, "
+            f"{self.counts['repaired']} repaired, {self.counts['guardrails']} to guardrails, "
+            f"{self.counts['failed']} failed, {self.counts.get('deadline', 0)} out of time, "
+            f"repair rate {self.repair_rate:.1%}, "
+            f"re-ask rate {self.reask_rate:.1%}"
+        )
+
+
+def _fast_validate(
+    raw_output: str,
+    response_model: Any,
+    id_lists: Dict[str, List[int]],
+) -> Tuple[Union[Dict[str, Any], None], bool, Union[Dict[str, Any], None]]:
+    # repair and validate locally, returns (output, repaired, parsed json)
+    parsed, repaired = repair_json(raw_output)
+    if parsed is None:
+        return None, repaired, None
+    output = {}
+    for name in response_model.model_fields:
+        if name not in parsed:
+            return None, repaired, parsed
+        value = parsed[name]
+        if name in id_lists:
+            value, changed = coerce_memory_index_list(value, id_lists[name])
+        elif name == "investment_decision":
+            value, changed = coerce_decision(value)
+        else:
+            changed = False
+            if (not isinstance(value, str)) or (not value.strip()):
+                value = None
+        if value is None:
+            return None, repaired, parsed
+        output[name] = value
+        repaired = repaired or changed
+    try:
+        response_model.model_validate(output)
+    except ValidationError:
+        return None, repaired, parsed
+    return output, repaired, parsed
+
+
+_LAYER_KEYS = (
+    "short_memory_index",
+    "middle_memory_index",
+    "long_memory_index",
+    "reflection_memory_index",
+)
+
+
+def _build_guard(run_mode: RunMode, id_lists: Dict[str, List[int]]) -> gd.Guard:
+    factory = (
+        _train_reflection_factory
+        if run_mode == RunMode.Train
+        else _test_reflection_factory
+    )
+    response_model = factory(
+        short_id_list=id_lists["short_memory_index"],
+        mid_id_list=id_lists["middle_memory_index"],
+        long_id_list=id_lists["long_memory_index"],
+        reflection_id_list=id_lists["reflection_memory_index"],
+    )
+    return gd.Guard.from_pydantic(
+        output_class=response_model,
+        prompt=train_prompt if run_mode == RunMode.Train else test_prompt,
+        num_reasks=1,
+    )
+
+
+class ReflectionSchemaCache:
+    """Response models and guard prompts by the shape of the reflection request.
+
+    The shape is the run mode and which memory layers are present. The guard is built
+    once per shape with placeholder ids, the valid ids of a call are only written into
+    its rendered prompt. The response model is only used for the field types, the ids
+    are checked against the lists of the call.
+
+    A guard with the real ids is still built when guardrails has to re-ask, a Guard
+    keeps the state of its last call and is not shared between threads.
+
+    Prompt layouts:
+        default: the guardrails prompt, the schema with the valid ids follows the
+            per-day information.
+        static_prefix: instructions, explanations and schema first, without the ids,
+            the per-day information last, so provider and TGI prefix caches can reuse
+            everything before it.
+    """
+
+    LAYOUTS = ("default", "static_prefix")
+
+    def __init__(self) -> None:
+        self._entries: Dict[Tuple, Tuple[Any, Any, Dict[str, str]]] = {}
+        self._prefixes: Dict[Tuple, str] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _placeholder_ids(layer_index: int) -> List[int]:
+        # two ids, ValidChoices does not support a single choice
+        return [-9_000_001 - 2 * layer_index, -9_000_002 - 2 * layer_index]
+
+    def _entry(
+        self, run_mode: RunMode, id_lists: Dict[str, List[int]]
+    ) -> Tuple[Any, Any, Dict[str, str]]:
+        shape = (run_mode, tuple(bool(id_lists[k]) for k in _LAYER_KEYS))
+        with self._lock:
+            entry = self._entries.get(shape)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            placeholder_lists = {
+                k: (self._placeholder_ids(i) if present else [])
+                for i, (k, present) in enumerate(zip(_LAYER_KEYS, shape[1]))
+            }
+            guard = _build_guard(run_mode, placeholder_lists)
+            placeholders = {
+                k: f"choices={v}" for k, v in placeholder_lists.items() if v
+            }
+            entry = (guard.base_model, guard.prompt, placeholders)
+            self._entries[shape] = entry
+            return entry
+
+    def response_model(self, run_mode: RunMode, id_lists: Dict[str, List[int]]) -> Any:
+        return self._entry(run_mode, id_lists)[0]
+
+    def _static_prefix(self, run_mode: RunMode, id_lists: Dict[str, List[int]]) -> str:
+        shape = (run_mode, tuple(bool(id_lists[k]) for k in _LAYER_KEYS))
+        prefix = self._prefixes.get(shape)
+        if prefix is not None:
+            return prefix
+        _, prompt, placeholders = self._entry(run_mode, id_lists)
+        marker = "\x00investment_info\x00"
+        instructions, schema = prompt.format(investment_info=marker).source.split(
+            marker
+        )
+        # the ids are only listed with the memories
+        for placeholder in placeholders.values():
+            schema = schema.replace(f' format="valid-choices: {placeholder}"', "")
+        explanations = (
+            f"{test_sentiment_explanation}\n{test_momentum_explanation.rstrip()}\n\n"
+            if run_mode == RunMode.Test
+            else ""
+        )
+        prefix = (
+            f"{instructions.rstrip()}\n\n{explanations}{schema.strip()}\n\n"
+            f"{static_prefix_memory_id_instruction}\n\n{static_prefix_investment_info_header}"
+        )
+        with self._lock:
+            self._prefixes[shape] = prefix
+        return prefix
+
+    def render_prompt(
+        self,
+        run_mode: RunMode,
+        id_lists: Dict[str, List[int]],
+        prompt_params: Dict[str, Any],
+        layout: str = "default",
+    ) -> str:
+        if layout == "static_prefix":
+            return (
+                self._static_prefix(run_mode, id_lists)
+                + prompt_params["investment_info"].lstrip()
+            )
+        _, prompt, placeholders = self._entry(run_mode, id_lists)
+        source = prompt.format(**prompt_params).source
+        for key, placeholder in placeholders.items():
+            source = source.replace(placeholder, f"choices={id_lists[key]}")
+        return source
+
+    def json_schema(
+        self,
+        run_mode: RunMode,
+        id_lists: Dict[str, List[int]],
+        confidence: bool = False,
+    ) -> Dict[str, Any]:
+        """JSON schema of the response model with the valid ids of the call as enums.
+
+        Used for constrained decoding, the field descriptions are already in the prompt.
+        """
+        response_model = self.response_model(run_mode, id_lists)
+        properties: Dict[str, Any] = {}
+        for name, field in response_model.model_fields.items():
+            if name in id_lists:
+                memory_model = get_args(field.annotation)[0]
+                index_name = next(iter(memory_model.model_fields))
+                properties[name] = {
+                    "type": "array",
+                    "minItems": 1,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            index_name: {
+                                "type": "integer",
+                                "enum": sorted(set(id_lists[name])),
+                            }
+                        },
+                        "required": [index_name],
+                        "additionalProperties": False,
+                    },
+                }
+            elif name == "investment_decision":
+                properties[name] = {"type": "string", "enum": list(DECISIONS)}
+            else:
+                properties[name] = {"type": "string"}
+        if confidence:
+            properties["confidence"] = {"type": "number", "minimum": 0, "maximum": 1}
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False,
+        }
+
+
+# shared by every agent in the process
+_schema_cache = ReflectionSchemaCache()
 
 
 def trading_reflection(
     cur_date: date,
-    endpoint_func: Callable[[str], str],
+    endpoint_func: Callable[..., str],
     symbol: str,
     run_mode: RunMode,
     logger: logging.Logger,
@@ -375,6 +647,11 @@ def trading_reflection(
     long_memory_id: Union[List[int], None] = None,
     reflection_memory: Union[List[str], None] = None,
     reflection_memory_id: Union[List[int], None] = None,
+    stats: Union[ReflectionStats, None] = None,
+    schema_cache: Union["ReflectionSchemaCache", None] = None,
+    prompt_layout: str = "default",
+    ask_confidence: bool = False,
+    deadline_fallback: str = "hold",
 ) -> Dict[str, Any]:
     def _fallback_output(error_message: str) -> Dict[str, Any]:
         if run_mode == RunMode.Train:
@@ -394,6 +671,21 @@ def trading_reflection(
             "reflection_memory_index": None,
         }
 
+    def _deadline_output() -> Dict[str, Any]:
+        # out of time, a deterministic decision instead of the model's
+        stats.record("deadline")  # type: ignore
+        logger.info(
+            f"reflection out of time for {symbol}, {deadline_fallback} fallback"
+        )
+        output = _fallback_output(
+            f"Time budget exceeded, {deadline_fallback} fallback policy."
+        )
+        if run_mode == RunMode.Test:
+            output["investment_decision"] = fallback_decision(
+                deadline_fallback, momentum
+            )
+        return output
+
     # format memories
     (
         short_memory,
@@ -416,7 +708,7 @@ def trading_reflection(
     )
 
     if run_mode == RunMode.Train:
-        response_model, investment_info = _train_response_model_invest_info(
+        investment_info = _train_invest_info(
             cur_date=cur_date,
             symbol=symbol,
             future_record=future_record,  # type: ignore
@@ -429,9 +721,8 @@ def trading_reflection(
             reflection_memory=reflection_memory,
             reflection_memory_id=reflection_memory_id,
         )
-        cur_prompt = train_prompt
     else:
-        response_model, investment_info = _test_response_model_invest_info(
+        investment_info = _test_invest_info(
             cur_date=cur_date,
             symbol=symbol,
             short_memory=short_memory,
@@ -443,45 +734,109 @@ def trading_reflection(
             reflection_memory=reflection_memory,
             reflection_memory_id=reflection_memory_id,
             momentum=momentum,
+            explanations=prompt_layout != "static_prefix",
         )
-        cur_prompt = test_prompt
 
     # prompt + validated output
-    guard = gd.Guard.from_pydantic(
-        output_class=response_model, prompt=cur_prompt, num_reasks=1
+    id_lists = {
+        "short_memory_index": short_memory_id,
+        "middle_memory_index": mid_memory_id,
+        "long_memory_index": long_memory_id,
+        "reflection_memory_index": reflection_memory_id,
+    }
+    schema_cache = schema_cache if schema_cache is not None else _schema_cache
+    response_model = schema_cache.response_model(run_mode, id_lists)  # type: ignore
+    prompt_params = {"investment_info": investment_info}
+    stats = stats if stats is not None else ReflectionStats()
+
+    def _output_info(output: str) -> Dict[str, Any]:
+        # for routers that pick the model by the answer
+        checked, _, parsed = _fast_validate(output, response_model, id_lists)  # type: ignore
+        confidence = coerce_confidence((parsed or {}).get("confidence"))
+        return {
+            "valid": checked is not None,
+            "confidence": confidence,
+            "decision": (checked or {}).get("investment_decision"),
+            "momentum": momentum,
+        }
+
+    prompt = schema_cache.render_prompt(
+        run_mode, id_lists, prompt_params, prompt_layout  # type: ignore
     )
+    if ask_confidence:
+        prompt += f"\n\n{router_confidence_instruction}"
 
     try:
-        # , validated_output
-        validated_outcomes = guard(
-            endpoint_func,
-            prompt_params={"investment_info": investment_info},
+        # fast path: one call, local repair and validation
+        call_start = time.monotonic()
+        raw_output = endpoint_func(
+            prompt,
+            response_schema=schema_cache.json_schema(
+                run_mode, id_lists, confidence=ask_confidence  # type: ignore
+            ),
+            validate_output=_output_info,
         )
-        validated_output = None
-        if isinstance(validated_outcomes, tuple):
-            if len(validated_outcomes) >= 2:
-                validated_output = validated_outcomes[1]
+        validated_output, repaired, parsed = _fast_validate(
+            raw_output, response_model, id_lists  # type: ignore
+        )
+        raw_outputs = [raw_output]
+        reasks = 0
+        if validated_output is not None:
+            outcome = "repaired" if repaired else "first_pass"
         else:
-            validated_output = getattr(validated_outcomes, "validated_output", None)
+            # guardrails validates the answer and re-asks only when it is still invalid
+            outcome = "guardrails"
+            guard = _build_guard(run_mode, id_lists)  # type: ignore
+            # re-ask only when the rest of the budget covers another call like the first
+            budget = remaining_time()
+            num_reasks = (
+                1 if (budget is None) or (budget > time.monotonic() - call_start) else 0
+            )
+            stats.skipped_reasks += 1 - num_reasks
+            validated_outcomes = guard.parse(
+                json.dumps(parsed) if parsed is not None else raw_output,
+                llm_api=endpoint_func,
+                num_reasks=num_reasks,
+                prompt_params=prompt_params,
+            )
+            if isinstance(validated_outcomes, tuple):
+                validated_output = (
+                    validated_outcomes[1] if len(validated_outcomes) >= 2 else None
+                )
+            else:
+                validated_output = validated_outcomes
+            guard_history = guard.guard_state.most_recent_call
+            if guard_history is not None:
+                reasks = max(len(guard_history.history) - 1, 0)
+                raw_outputs.extend(
+                    i.llm_response.output
+                    for i in guard_history.history[1:]
+                    if i.llm_response is not None
+                )
 
         logger.info("Guardrails Raw LLM Outputs")
-        guard_history = getattr(guard, "history", None)
-        if guard_history and len(guard_history) > 0:
-            raw_outputs = getattr(guard_history[0], "raw_outputs", None)
-            if raw_outputs:
-                for i, o in enumerate(raw_outputs):
-                    logger.info(f"Reask {i}")
-                    logger.info(o)
-                    logger.info("\n\n")
+        for i, o in enumerate(raw_outputs):
+            logger.info(f"Reask {i}")
+            logger.info(o)
+            logger.info("\n\n")
         # print(guard.history.last.tree)
         if (validated_output is None) or (not isinstance(validated_output, dict)):
+            stats.record("failed", reasks)
             logger.info(f"reflection failed for {symbol}")
             return _fallback_output("JSON does not match schema")
+        stats.record(outcome, reasks)
         return _delete_placeholder_info(validated_output)
 
     except Exception as e:
-        if isinstance(e.__context__, LongerThanContextError):
+        if isinstance(e, LongerThanContextError) or isinstance(
+            e.__context__, LongerThanContextError
+        ):
             raise LongerThanContextError from e
+        if isinstance(e, DeadlineExceeded) or isinstance(
+            e.__context__, DeadlineExceeded
+        ):
+            return _deadline_output()
+        stats.record("failed")
         logger.info("Wrong again!!!!!")
         logger.error(e)
         return _delete_placeholder_info({})
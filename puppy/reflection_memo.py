@@ -0,0 +1,124 @@
+import copy
+from typing import Any, Dict, FrozenSet, List, Tuple, Union
+from .run_type import RunMode
+
+_LAYER_KEYS = (
+    "short_memory_index",
+    "middle_memory_index",
+    "long_memory_index",
+    "reflection_memory_index",
+)
+
+MemoKey = Tuple[RunMode, Any, FrozenSet[Tuple[str, int]]]
+
+
+class ReflectionMemo:
+    """Reuses the last reflection when the retrieved memories did not change.
+
+    The key of a reflection is the run mode, a bucket of the market state (the sign of
+    the next day record in train mode, the momentum in test mode) and the retrieved
+    memory ids of every layer.
+
+    Args:
+        mode (str, optional): "off", "reuse" to return the last reflection, or
+            "cheap_model" to ask the model in `end_point` / `model` instead. Defaults to "off".
+        min_similarity (float, optional): Jaccard similarity of the retrieved ids from
+            which two reflections count as the same, 1.0 means identical ids. Defaults to 1.0.
+        end_point (Union[str, None], optional): endpoint of the cheap model. Defaults to None.
+        model (Union[str, None], optional): the cheap model. Defaults to None.
+    """
+
+    MODES = ("off", "reuse", "cheap_model")
+
+    def __init__(
+        self,
+        mode: str = "off",
+        min_similarity: float = 1.0,
+        end_point: Union[str, None] = None,
+        model: Union[str, None] = None,
+    ) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {', '.join(self.MODES)}")
+        if not 0.0 <= min_similarity <= 1.0:
+            raise ValueError("min_similarity must be between 0 and 1")
+        if (mode == "cheap_model") and not (end_point and model):
+            raise ValueError("cheap_model needs end_point and model")
+        self.mode = mode
+        self.min_similarity = min_similarity
+        self.end_point = end_point
+        self.model = model
+        self._last: Dict[RunMode, Tuple[MemoKey, Dict[str, Any]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_calls = 0
+        self.cheap_calls = 0
+
+    @classmethod
+    def from_config(cls, config: Union[Dict[str, Any], None]) -> "ReflectionMemo":
+        config = config or {}
+        return cls(
+            mode=config.get("mode", "off"),
+            min_similarity=config.get("min_similarity", 1.0),
+            end_point=config.get("end_point"),
+            model=config.get("model"),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @staticmethod
+    def make_key(
+        run_mode: RunMode, id_lists: Dict[str, Union[List[int], None]], bucket: Any
+    ) -> MemoKey:
+        ids = frozenset(
+            (layer, i)
+            for layer, layer_ids in id_lists.items()
+            for i in (layer_ids or [])
+            if i != -1
+        )
+        return run_mode, bucket, ids
+
+    @staticmethod
+    def similarity(
+        ids: FrozenSet[Tuple[str, int]], other_ids: FrozenSet[Tuple[str, int]]
+    ) -> float:
+        if not (ids or other_ids):
+            return 1.0
+        return len(ids & other_ids) / len(ids | other_ids)
+
+    def lookup(self, key: MemoKey) -> Union[Dict[str, Any], None]:
+        """The last reflection of the run mode if it matches `key`, with only the ids
+        that were retrieved again."""
+        last = self._last.get(key[0])
+        if (
+            (last is None)
+            or (last[0][1] != key[1])
+            or (self.similarity(last[0][2], key[2]) < self.min_similarity)
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        result = copy.deepcopy(last[1])
+        for layer in _LAYER_KEYS:
+            if not isinstance(result.get(layer), list):
+                continue
+            kept = [
+                i
+                for i in result[layer]
+                if isinstance(i, dict) and (layer, i.get("memory_index")) in key[2]
+            ]
+            if kept:
+                result[layer] = kept
+            else:
+                del result[layer]
+        return result
+
+    def store(self, key: MemoKey, result: Dict[str, Any]) -> None:
+        self._last[key[0]] = (key, copy.deepcopy(result))
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses, {self.saved_calls} LLM calls saved, "
+            f"{self.cheap_calls} on the cheap model"
+        )
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Union
+
+# [chat] keys that configure the response cache instead of the request payload
+CACHE_KEYS = ("cache_mode", "cache_path")
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    """Persistent LLM response cache keyed by end point, model, parameters and prompt.
+
+    Modes:
+        record: always call the model and store the response, overwriting old entries.
+        replay: only answer from the cache, a miss raises CacheMissError.
+        read_through: answer from the cache, call the model and store on a miss.
+
+    Args:
+        path (str): sqlite file, can be shared by several processes.
+        mode (str, optional): "record", "replay" or "read_through". Defaults to "read_through".
+    """
+
+    MODES = ("record", "replay", "read_through")
+
+    def __init__(self, path: str, mode: str = "read_through") -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"cache_mode must be one of {', '.join(self.MODES)}")
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(__name__)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, "
+                "request TEXT, response TEXT, created REAL, end_point TEXT)"
+            )
+            # files written before the end point was part of the key
+            columns = [i[1] for i in conn.execute("PRAGMA table_info(responses)")]
+            if "end_point" not in columns:
+                conn.execute("ALTER TABLE responses ADD COLUMN end_point TEXT")
+
+    @classmethod
+    def from_config(cls, cache_config: Dict[str, Any]) -> Union["ResponseCache", None]:
+        mode = cache_config.get("cache_mode", "off")
+        if (not mode) or (mode == "off"):
+            return None
+        return cls(
+            path=cache_config.get(
+                "cache_path", os.path.join("data", "12_llm_cache", "responses.sqlite")
+            ),
+            mode=mode,
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def request_body(request: Dict[str, Any]) -> str:
+        # canonical json of the payload, independent of the key order
+        body = request["json"] if "json" in request else json.loads(request["content"])
+        return json.dumps(body, sort_keys=True, ensure_ascii=False)
+
+    @staticmethod
+    def make_key(end_point: str, model: str, body: str) -> str:
+        # tgi payloads do not name the model, two backends only differ by end point
+        return hashlib.sha256(
+            f"{end_point}\n{model}\n{body}".encode("utf-8")
+        ).hexdigest()
+
+    def lookup(
+        self, end_point: str, model: str, request: Dict[str, Any]
+    ) -> Union[str, None]:
+        if self.mode == "record":
+            return None
+        key = self.make_key(end_point, model, self.request_body(request))
+        row = (
+            self._connection()
+            .execute("SELECT response FROM responses WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is not None:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        if self.mode == "replay":
+            raise CacheMissError(
+                f"No cached response of {model} at {end_point} for key {key}"
+            )
+        return None
+
+    def store(
+        self, end_point: str, model: str, request: Dict[str, Any], response: str
+    ) -> str:
+        body = self.request_body(request)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, model, request, response, created, end_point) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.make_key(end_point, model, body),
+                    model,
+                    body,
+                    response,
+                    time.time(),
+                    end_point,
+                ),
+            )
+        return response
@@ -0,0 +1,436 @@
+import re
+import json
+import math
+import time
+import base64
+import random
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple, Union
+
+# guardrails renders the output schema of the reflection as xml in the prompt
+_STRING_FIELD = re.compile(r'<string name="(\w+)"([^>]*)/>')
+_INDEX_LIST_FIELD = re.compile(
+    r'<list name="(\w+)"[^>]*>\s*<object>\s*<integer name="(\w+)"[^>]*?'
+    r"choices=\[([^\]]*)\]",
+    re.DOTALL,
+)
+_CHOICES = re.compile(r"choices=\[([^\]]*)\]")
+# the static prefix layout lists the ids only with the memories
+_BARE_INDEX_LIST_FIELD = re.compile(
+    r'<list name="(\w+)"[^>]*>\s*<object>\s*<integer name="(\w+)"(?![^>]*choices=)'
+)
+_SECTION_NAMES = {
+    "short_memory_index": "short-term",
+    "middle_memory_index": "mid-term",
+    "long_memory_index": "long-term",
+    "reflection_memory_index": "reflection-term",
+}
+
+
+def _parse_choices(choices: str) -> List[Any]:
+    ret = []
+    for choice in choices.split(","):
+        choice = choice.strip().strip("'\"")
+        if choice:
+            ret.append(int(choice) if choice.lstrip("-").isdigit() else choice)
+    return ret
+
+
+def canned_response(prompt: str) -> str:
+    """Schema valid json answer to a reflection prompt.
+
+    The answer only depends on the prompt, so repeated runs make the same decisions
+    no matter how the requests are interleaved.
+    """
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+    if "<output>" not in prompt:
+        return json.dumps({"summary_reason": "Stub response."})
+    output = prompt[prompt.rfind("<output>") :]
+    response: Dict[str, Any] = {}
+    for name, attributes in _STRING_FIELD.findall(output):
+        choices = _CHOICES.search(attributes)
+        if choices:
+            response[name] = rng.choice(_parse_choices(choices.group(1)))
+        else:
+            response[name] = "Stub reason based on the provided memories."
+    index_lists = [
+        (name, inner_name, _parse_choices(choices))
+        for name, inner_name, choices in _INDEX_LIST_FIELD.findall(output)
+    ]
+    for name, inner_name in _BARE_INDEX_LIST_FIELD.findall(output):
+        section = re.search(
+            rf"The {_SECTION_NAMES.get(name, name)} information:\n(.*?)(?:\n\n|$)",
+            prompt,
+            re.DOTALL,
+        )
+        section_ids = (
+            [int(i) for i in re.findall(r"^(-?\d+)\. ", section.group(1), re.M)]
+            if section
+            else []
+        )
+        index_lists.append((name, inner_name, section_ids or [-1]))
+    for name, inner_name, ids in index_lists:
+        ids = sorted(set(ids))
+        picked = rng.sample(ids, k=min(len(ids), rng.randint(1, 2)))
+        response[name] = [{inner_name: i} for i in picked]
+    if '"confidence" field' in prompt:
+        response["confidence"] = round(rng.random(), 2)
+    return json.dumps(response)
+
+
+def stub_embedding(text: Any, dimension: int) -> np.ndarray:
+    # unit vector seeded by the input, equal texts get equal embeddings
+    seed = hashlib.sha256(json.dumps(text).encode("utf-8")).digest()
+    vector = np.random.default_rng(int.from_bytes(seed[:8], "little")).standard_normal(
+        dimension
+    )
+    return (vector / np.linalg.norm(vector)).astype("float32")
+
+
+def _count_tokens(text: str) -> int:
+    # about 4 characters per token
+    return max(1, len(text) // 4)
+
+
+class StubBehaviour:
+    """Latency and failures of the stub server.
+
+    Args:
+        latency (str, optional): "fixed", "uniform" or "lognormal". Defaults to "fixed".
+        latency_mean (float, optional): fixed latency, or the median of the lognormal
+            latency, in seconds. Defaults to 0.5.
+        latency_sigma (float, optional): sigma of the lognormal latency. Defaults to 0.5.
+        latency_min (float, optional): lower bound of the uniform latency. Defaults to 0.1.
+        latency_max (float, optional): upper bound of the uniform latency, also caps the
+            lognormal latency. Defaults to 2.0.
+        error_rate (float, optional): share of requests answered with 500. Defaults to 0.0.
+        rate_limit_rate (float, optional): share of requests answered with 429. Defaults to 0.0.
+        retry_after (Union[float, None], optional): Retry-After of the 429 responses,
+            None sends no header. Defaults to 1.0.
+        context_error_rate (float, optional): share of chat requests answered with the
+            tgi 422 longer than context error. Defaults to 0.0.
+        max_prompt_chars (Union[int, None], optional): chat prompts longer than this
+            always get the 422 error. Defaults to None.
+        max_concurrency (Union[int, None], optional): requests served at once, the
+            others queue like on a saturated server. Defaults to None, no limit.
+        embedding_dimension (int, optional): Defaults to 1536, as text-embedding-ada-002.
+        seed (Union[int, None], optional): seed of the latency and failure draws.
+            Defaults to None.
+    """
+
+    LATENCIES = ("fixed", "uniform", "lognormal")
+
+    def __init__(
+        self,
+        latency: str = "fixed",
+        latency_mean: float = 0.5,
+        latency_sigma: float = 0.5,
+        latency_min: float = 0.1,
+        latency_max: float = 2.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: Union[float, None] = 1.0,
+        context_error_rate: float = 0.0,
+        max_prompt_chars: Union[int, None] = None,
+        max_concurrency: Union[int, None] = None,
+        embedding_dimension: int = 1536,
+        seed: Union[int, None] = None,
+    ) -> None:
+        if latency not in self.LATENCIES:
+            raise ValueError(f"latency must be one of {', '.join(self.LATENCIES)}")
+        if error_rate + rate_limit_rate + context_error_rate > 1:
+            raise ValueError("The failure rates must add up to at most 1")
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.latency_min = latency_min
+        self.latency_max = latency_max
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.context_error_rate = context_error_rate
+        self.max_prompt_chars = max_prompt_chars
+        self.embedding_dimension = embedding_dimension
+        self.semaphore = (
+            threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        )
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self) -> float:
+        with self._lock:
+            if self.latency == "uniform":
+                return self._rng.uniform(self.latency_min, self.latency_max)
+            if self.latency == "lognormal":
+                return min(
+                    self.latency_max,
+                    self._rng.lognormvariate(
+                        math.log(self.latency_mean), self.latency_sigma
+                    ),
+                )
+            return self.latency_mean
+
+    def sample_failure(self, chat: bool) -> Union[str, None]:
+        with self._lock:
+            draw = self._rng.random()
+        if draw < self.error_rate:
+            return "error"
+        draw -= self.error_rate
+        if draw < self.rate_limit_rate:
+            return "rate_limit"
+        draw -= self.rate_limit_rate
+        if chat and (draw < self.context_error_rate):
+            return "context"
+        return None
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so pooled clients reuse their connections
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        self.server.logger.debug(format % args)
+
+    def _send_json(
+        self, status: int, body: Any, headers: Union[Dict[str, str], None] = None
+    ) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, e.g. its step deadline passed
+            self.close_connection = True
+            self.server.record("disconnected")
+            return
+        self.server.record(status)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") in {"", "/health"}:
+            self._send_json(200, {"status": "ok"})
+        elif self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        try:
+            payload = json.loads(
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            )
+        except ValueError:
+            self._send_json(400, {"error": "Request body is not valid json"})
+            return
+        # the wire format is told by the payload, any path works
+        if "messages" in payload:
+            wire_format = "openai"
+        elif "inputs" in payload:
+            wire_format = "tgi"
+        elif "contents" in payload:
+            wire_format = "gemini"
+        elif "input" in payload:
+            wire_format = "embeddings"
+        else:
+            self._send_json(400, {"error": "Unknown request format"})
+            return
+
+        behaviour = self.server.behaviour
+        if behaviour.semaphore is not None:
+            behaviour.semaphore.acquire()
+        try:
+            time.sleep(behaviour.sample_latency())
+        finally:
+            if behaviour.semaphore is not None:
+                behaviour.semaphore.release()
+
+        if wire_format == "embeddings":
+            prompt = ""
+        elif wire_format == "openai":
+            prompt = payload["messages"][-1]["content"]
+        elif wire_format == "tgi":
+            prompt = payload["inputs"]
+        else:
+            prompt = payload["contents"]["parts"]["text"]
+        failure = behaviour.sample_failure(chat=wire_format != "embeddings")
+        if (
+            (wire_format != "embeddings")
+            and (behaviour.max_prompt_chars is not None)
+            and (len(prompt) > behaviour.max_prompt_chars)
+        ):
+            failure = "context"
+        if failure == "error":
+            self._send_json(500, {"error": "Injected server error"})
+        elif failure == "rate_limit":
+            headers = (
+                {"Retry-After": str(behaviour.retry_after)}
+                if behaviour.retry_after is not None
+                else {}
+            )
+            self._send_json(
+                429,
+                {"error": {"message": "Injected rate limit", "type": "rate_limit"}},
+                headers,
+            )
+        elif failure == "context":
+            self._send_json(
+                422,
+                {
+                    "error": f"Input validation error: `inputs` must have less than {_count_tokens(prompt) - 1} tokens. Given: {_count_tokens(prompt)}",
+                    "error_type": "validation",
+                },
+            )
+        elif wire_format == "embeddings":
+            self._send_json(200, self._embeddings(payload))
+        else:
+            self._send_json(200, self._chat(wire_format, payload, prompt))
+
+    def _chat(self, wire_format: str, payload: Dict[str, Any], prompt: str) -> Any:
+        text = canned_response(prompt)
+        prompt_tokens = _count_tokens(prompt)
+        cached_tokens = self.server.cached_prompt_tokens(prompt)
+        completion_tokens = _count_tokens(text)
+        if wire_format == "tgi":
+            return {"generated_text": text}
+        if wire_format == "gemini":
+            return {
+                "candidates": [
+                    {
+                        "content": {"role": "model", "parts": [{"text": text}]},
+                        "finishReason": "STOP",
+                    }
+                ],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "cachedContentTokenCount": cached_tokens,
+                    "candidatesTokenCount": completion_tokens,
+                    "totalTokenCount": prompt_tokens + completion_tokens,
+                },
+            }
+        return {
+            "id": f"chatcmpl-stub-{hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def _embeddings(self, payload: Dict[str, Any]) -> Any:
+        inputs = payload["input"]
+        # a single string, or a single list of token ids
+        if isinstance(inputs, str) or (
+            isinstance(inputs, list) and inputs and isinstance(inputs[0], int)
+        ):
+            inputs = [inputs]
+        dimension = payload.get("dimensions", self.server.behaviour.embedding_dimension)
+        data = []
+        for i, text in enumerate(inputs):
+            vector = stub_embedding(text, dimension)
+            data.append(
+                {
+                    "object": "embedding",
+                    "index": i,
+                    # the openai client asks for base64 by default
+                    "embedding": (
+                        base64.b64encode(vector.tobytes()).decode("ascii")
+                        if payload.get("encoding_format") == "base64"
+                        else vector.tolist()
+                    ),
+                }
+            )
+        tokens = sum(
+            len(i) if isinstance(i, list) else _count_tokens(i) for i in inputs
+        )
+        return {
+            "object": "list",
+            "data": data,
+            "model": payload.get("model", "stub"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+
+class StubServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI, TGI and Gemini endpoints and OpenAI embeddings.
+
+    Every request sleeps for a sampled latency and may fail with an injected 500, 429
+    or 422, otherwise it gets a json answer that passes the reflection schema. Chat
+    answers report the prompt prefix seen in earlier requests as cached tokens. GET
+    /stats returns the number of responses by status code.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        behaviour: Union[StubBehaviour, None] = None,
+    ) -> None:
+        super().__init__((host, port), StubRequestHandler)
+        self.behaviour = behaviour or StubBehaviour()
+        self.logger = logging.getLogger(__name__)
+        self._status_counts: Counter = Counter()
+        self._stats_lock = threading.Lock()
+        # prefix blocks seen so far, to report cached prompt tokens like openai
+        self._prefix_blocks = set()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, status: Union[int, str]) -> None:
+        with self._stats_lock:
+            self._status_counts[str(status)] += 1
+
+    def cached_prompt_tokens(self, prompt: str, block_chars: int = 512) -> int:
+        # the longest run of leading blocks seen in an earlier prompt is cached
+        cached = 0
+        with self._stats_lock:
+            for end in range(block_chars, len(prompt) + 1, block_chars):
+                key = hashlib.sha1(prompt[:end].encode("utf-8")).digest()
+                if (key in self._prefix_blocks) and (cached == end - block_chars):
+                    cached = end
+                self._prefix_blocks.add(key)
+        return _count_tokens(prompt[:cached]) if cached else 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self._status_counts)
+
+
+def start_stub_server(
+    host: str = "127.0.0.1", port: int = 0, **behaviour_config: Any
+) -> Tuple[StubServer, threading.Thread]:
+    """Serve in a background thread, port 0 picks a free port, see `StubServer.url`.
+
+    Stop it with `server.shutdown()`.
+    """
+    server = StubServer(host, port, StubBehaviour(**behaviour_config))
+    thread = threading.Thread(
+        target=server.serve_forever, name="puppy-stub-server", daemon=True
+    )
+    thread.start()
+    return server, thread
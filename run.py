@@ -7,8 +7,8 @@ import warnings
 from tqdm import tqdm
 from dotenv import load_dotenv
 from datetime import datetime
-from typing import Union, List, Optional
-from puppy import MarketEnvironment, LLMAgent, RunMode
+from typing import Union, List, Optional, Dict, Any
+from puppy.response_cache import CACHE_KEYS
 
 
 # set up
@@ -17,6 +17,20 @@ app = typer.Typer(name="puppy")
 warnings.filterwarnings("ignore")
 
 
+def _cache_config(
+    config: Dict[str, Any],
+    llm_cache_mode: Union[str, None],
+    llm_cache_path: Union[str, None],
+) -> Dict[str, Any]:
+    # cache settings of this run, the options override [chat]
+    cache_config = {k: v for k, v in config["chat"].items() if k in CACHE_KEYS}
+    if llm_cache_mode is not None:
+        cache_config["cache_mode"] = llm_cache_mode
+    if llm_cache_path is not None:
+        cache_config["cache_path"] = llm_cache_path
+    return cache_config
+
+
 @app.command("sim", help="Start Simulation", rich_help_panel="Simulation")
 def sim_func(
     market_data_info_path: str = typer.Option(
@@ -58,6 +72,18 @@ def sim_func(
         "--trained-agent-path",
         help="Only used in test mode, the path of trained agent",
     ),
+    llm_cache_mode: Union[str, None] = typer.Option(
+        None,
+        "-lcm",
+        "--llm-cache-mode",
+        help="LLM response cache: off, record, replay or read_through, overrides cache_mode in [chat]",
+    ),
+    llm_cache_path: Union[str, None] = typer.Option(
+        None,
+        "-lcp",
+        "--llm-cache-path",
+        help="LLM response cache sqlite path, overrides cache_path in [chat]",
+    ),
     legacy_args: Optional[List[str]] = typer.Argument(
         None,
         help="Legacy positional mode: <market_data_path> <start_time> <end_time> <run_mode> <config_path> <checkpoint_path> <result_path> [trained_agent_path]",
@@ -81,6 +107,9 @@ def sim_func(
             legacy_args[7] if len(legacy_args) == 8 else trained_agent_path
         )
 
+    # the agent and its dependencies are imported by the commands that need them
+    from puppy import MarketEnvironment, LLMAgent, RunMode, DecisionCalendar
+
     # load config
     config = toml.load(config_path)
     # set up logging
@@ -114,10 +143,15 @@ def sim_func(
         start_date=datetime.strptime(start_time, "%Y-%m-%d").date(),
         end_date=datetime.strptime(end_time, "%Y-%m-%d").date(),
     )
+    cache_config = _cache_config(config, llm_cache_mode, llm_cache_path)
     if run_mode_var == RunMode.Train:
+        config["chat"].update(cache_config)
         the_agent = LLMAgent.from_config(config)
     else:
-        the_agent = LLMAgent.load_checkpoint(path=os.path.join(trained_agent_path, "agent_1"))  # type: ignore
+        the_agent = LLMAgent.load_checkpoint(path=os.path.join(trained_agent_path, "agent_1"), chat_config_update=cache_config)  # type: ignore
+    decision_calendar = DecisionCalendar.from_config(
+        config=config, trading_dates=environment.date_series_keep
+    )
     # start simulation
     pbar = tqdm(total=environment.simulation_length)
     while True:
@@ -128,13 +162,16 @@ def sim_func(
         logger.info(f"Record {market_info[-2]}")
         if market_info[-1]:  # if done break
             break
-            # only run agent step on Mondays
-        if market_info[0].weekday() == 0:
+        if decision_calendar.is_decision_day(market_info[0]):  # type: ignore
             the_agent.step(market_info=market_info, run_mode=run_mode_var)  # type: ignore
+            # save checkpoint every decision, openai api is not stable
+            the_agent.save_checkpoint(path=checkpoint_path, force=True)
+            environment.save_checkpoint(path=checkpoint_path, force=True)
+        else:
+            # only buffer news and filings, a resumed run replays these days
+            the_agent.ingest(market_info=market_info)  # type: ignore
         pbar.update(1)
-        # save checkpoint every time, openai api is not stable
-        the_agent.save_checkpoint(path=checkpoint_path, force=True)
-        environment.save_checkpoint(path=checkpoint_path, force=True)
+    the_agent.flush_pending_memories()
     # save result after finish
     the_agent.save_checkpoint(path=result_path, force=True)
     environment.save_checkpoint(path=result_path, force=True)
@@ -167,7 +204,22 @@ def sim_checkpoint(
     run_mode: str = typer.Option(
         "train", "-rm", "--run-model", help="Run mode: train or test"
     ),
+    llm_cache_mode: Union[str, None] = typer.Option(
+        None,
+        "-lcm",
+        "--llm-cache-mode",
+        help="LLM response cache: off, record, replay or read_through, overrides cache_mode in [chat]",
+    ),
+    llm_cache_path: Union[str, None] = typer.Option(
+        None,
+        "-lcp",
+        "--llm-cache-path",
+        help="LLM response cache sqlite path, overrides cache_path in [chat]",
+    ),
 ) -> None:
+    # the agent and its dependencies are imported by the commands that need them
+    from puppy import MarketEnvironment, LLMAgent, RunMode, DecisionCalendar
+
     # load config
     config = toml.load(config_path)
     # set up logging
@@ -196,7 +248,13 @@ def sim_checkpoint(
     environment = MarketEnvironment.load_checkpoint(
         path=os.path.join(checkpoint_path, "env")
     )
-    the_agent = LLMAgent.load_checkpoint(path=os.path.join(checkpoint_path, "agent_1"))
+    the_agent = LLMAgent.load_checkpoint(
+        path=os.path.join(checkpoint_path, "agent_1"),
+        chat_config_update=_cache_config(config, llm_cache_mode, llm_cache_path),
+    )
+    decision_calendar = DecisionCalendar.from_config(
+        config=config, trading_dates=environment.date_series_keep
+    )
     pbar = tqdm(total=environment.simulation_length)
     # run simulation
     while True:
@@ -205,17 +263,137 @@ def sim_checkpoint(
         market_info = environment.step()
         if market_info[-1]:
             break
-            # only run agent step on Mondays
-        if market_info[0].weekday() == 0:
+        if decision_calendar.is_decision_day(market_info[0]):  # type: ignore
             the_agent.step(market_info=market_info, run_mode=run_mode_var)  # type: ignore
+            # save checkpoint every decision, openai api is not stable
+            the_agent.save_checkpoint(path=checkpoint_path, force=True)
+            environment.save_checkpoint(path=checkpoint_path, force=True)
+        else:
+            # only buffer news and filings, a resumed run replays these days
+            the_agent.ingest(market_info=market_info)  # type: ignore
         pbar.update(1)
-        # save checkpoint every time, openai api is not stable
-        the_agent.save_checkpoint(path=checkpoint_path, force=True)
-        environment.save_checkpoint(path=checkpoint_path, force=True)
+    the_agent.flush_pending_memories()
     # save result after finish
     the_agent.save_checkpoint(path=result_path, force=True)
     environment.save_checkpoint(path=result_path, force=True)
 
 
+@app.command(
+    "stub-server",
+    help="Serve a local stand-in LLM and embedding endpoint for benchmarks",
+    rich_help_panel="Benchmark",
+)
+def stub_server(
+    host: str = typer.Option("127.0.0.1", "--host", help="Bind address"),
+    port: int = typer.Option(8000, "-p", "--port", help="Port"),
+    latency: str = typer.Option(
+        "fixed", "-l", "--latency", help="Latency: fixed, uniform or lognormal"
+    ),
+    latency_mean: float = typer.Option(
+        0.5, "--latency-mean", help="Fixed latency or lognormal median in seconds"
+    ),
+    latency_sigma: float = typer.Option(
+        0.5, "--latency-sigma", help="Sigma of the lognormal latency"
+    ),
+    latency_min: float = typer.Option(
+        0.1, "--latency-min", help="Lower bound of the uniform latency"
+    ),
+    latency_max: float = typer.Option(
+        2.0, "--latency-max", help="Upper bound of the uniform and lognormal latency"
+    ),
+    error_rate: float = typer.Option(
+        0.0, "--error-rate", help="Share of requests answered with 500"
+    ),
+    rate_limit_rate: float = typer.Option(
+        0.0, "--rate-limit-rate", help="Share of requests answered with 429"
+    ),
+    retry_after: float = typer.Option(
+        1.0, "--retry-after", help="Retry-After of the 429 responses in seconds"
+    ),
+    context_error_rate: float = typer.Option(
+        0.0,
+        "--context-error-rate",
+        help="Share of chat requests answered with the 422 longer than context error",
+    ),
+    max_prompt_chars: Union[int, None] = typer.Option(
+        None, "--max-prompt-chars", help="Longer chat prompts always get the 422 error"
+    ),
+    max_concurrency: Union[int, None] = typer.Option(
+        None, "--max-concurrency", help="Requests served at once, the others queue"
+    ),
+    seed: Union[int, None] = typer.Option(
+        None, "--seed", help="Seed of the latency and failure draws"
+    ),
+) -> None:
+    from puppy.stub_server import StubBehaviour, StubServer
+
+    server = StubServer(
+        host=host,
+        port=port,
+        behaviour=StubBehaviour(
+            latency=latency,
+            latency_mean=latency_mean,
+            latency_sigma=latency_sigma,
+            latency_min=latency_min,
+            latency_max=latency_max,
+            error_rate=error_rate,
+            rate_limit_rate=rate_limit_rate,
+            retry_after=retry_after,
+            context_error_rate=context_error_rate,
+            max_prompt_chars=max_prompt_chars,
+            max_concurrency=max_concurrency,
+            seed=seed,
+        ),
+    )
+    print(f"Stub server listening on {server.url}, GET {server.url}/stats for counts")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@app.command(
+    "import-time",
+    help="Check the import time of a module against a budget, e.g. before SLURM array runs",
+    rich_help_panel="Benchmark",
+)
+def import_time(
+    module: str = typer.Option("run", "-m", "--module", help="Module to import"),
+    budget: float = typer.Option(
+        1.0, "-b", "--budget", help="Allowed import time in seconds"
+    ),
+    repeat: int = typer.Option(3, "-n", "--repeat", help="Fresh interpreters to time"),
+) -> None:
+    import sys
+    import subprocess
+
+    # fastest of a few fresh interpreters, -X importtime reports in microseconds
+    runs = []
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        rows = []
+        for line in proc.stderr.splitlines():
+            parts = line.split("|")
+            if (len(parts) == 3) and parts[1].strip().isdigit():
+                # (self, cumulative, module), top level modules are indented by one space
+                rows.append((int(parts[0].split(":")[-1]), int(parts[1]), parts[2]))
+        total = sum(i[1] for i in rows if not i[2].startswith("  ")) / 1e6
+        runs.append((total, rows))
+    total, rows = min(runs, key=lambda x: x[0])
+    print(f"import {module}: {total:.2f}s (budget {budget:.2f}s)")
+    if total > budget:
+        print("slowest modules by self time:")
+        for self_time, cumulative, name in sorted(rows, reverse=True)[:10]:
+            print(f"{self_time / 1e6:8.3f}s {cumulative / 1e6:8.3f}s {name.strip()}")
+        raise typer.Exit(code=1)
+
+
 if __name__ == "__main__":
     app()